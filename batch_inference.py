@@ -0,0 +1,233 @@
+"""
+Bulk offline inference over JSONL files, text directories and OCR data
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+from collections import deque
+from multiprocessing import Pool
+import dill
+import pandas as pd
+import torch
+from inference import InferenceEngine, add_engine_arguments, engine_from_args, infer_config
+
+_featurizer = None
+
+
+def iter_documents(input_path, text_field="text", id_field="id"):
+    """
+    Streams documents from a JSONL file, a directory of text files or the pickle
+    saved by ocr-image.py
+    :param input_path: .jsonl file, .pkl file or directory
+    :param text_field: JSONL field with the raw text or list of words, defaults to text
+    :param id_field: JSONL field with the document id, defaults to id i.e. the line number if missing
+    :return: generator of (document id, raw text or list of words)
+    """
+    if os.path.isdir(input_path):
+        for root, _, filenames in sorted(os.walk(input_path)):
+            for filename in sorted(filenames):
+                if filename.lower().endswith(".txt"):
+                    path = os.path.join(root, filename)
+                    with open(path, "r", encoding="utf-8", errors="replace") as infile:
+                        yield os.path.relpath(path, input_path), infile.read()
+    elif input_path.lower().endswith(".pkl"):
+        data_df = pd.read_pickle(input_path)
+        for filepath, ocr_text in zip(data_df["filepath"], data_df["ocr_text"]):
+            yield str(filepath), ocr_text
+    else:
+        with open(input_path, "r", encoding="utf-8") as infile:
+            for line_num, line in enumerate(infile):
+                if line.strip():
+                    record = json.loads(line)
+                    yield str(record.get(id_field, line_num)), record[text_field]
+
+
+def completed_ids(output_path):
+    """
+    Ids already written by an earlier run. A partly written last line is dropped
+    so the output can be appended to
+    :param output_path:
+    :return: set of document ids
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "rb+") as outfile:
+        complete_bytes = 0
+        for line in outfile:
+            if not line.endswith(b"\n"):
+                break
+            done.add(json.loads(line)["id"])
+            complete_bytes += len(line)
+        outfile.truncate(complete_bytes)
+    return done
+
+
+def length_sorted_batches(documents, batch_size, chunk_size):
+    """
+    Sorts chunks of documents by length and cuts them into batches, so each batch
+    pads to similar lengths
+    :param documents: Iterable of (document id, list of words)
+    :param batch_size:
+    :param chunk_size: Documents sorted at a time
+    :return: generator of lists of (document id, list of words)
+    """
+    documents = iter(documents)
+    while True:
+        chunk = list(itertools.islice(documents, chunk_size))
+        if not chunk:
+            break
+        chunk.sort(key=lambda document: len(document[1]))
+        for i in range(0, len(chunk), batch_size):
+            yield chunk[i: i + batch_size]
+
+
+def _init_worker(featurizer_bytes):
+    global _featurizer
+    torch.set_num_threads(1)
+    _featurizer = dill.loads(featurizer_bytes)
+
+
+def _featurize_batch(batch):
+    ids = [doc_id for doc_id, _ in batch]
+    return ids, _featurizer([words for _, words in batch])
+
+
+def prefetch(pool, batches, max_pending):
+    """
+    Featurizes batches in the pool, in order, with at most max_pending batches in
+    flight so the input is streamed rather than read up front as Pool.imap does
+    :param pool: Pool initialized with _init_worker
+    :param batches: Iterable of batches
+    :param max_pending:
+    :return: generator of (document ids, featurized batch)
+    """
+    pending = deque()
+    for batch in batches:
+        pending.append(pool.apply_async(_featurize_batch, (batch,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def run_batch_inference(
+    engine, input_path, output_path, batch_size=64, workers=None, chunk_size=4096, text_field="text",
+    id_field="id", report_every=10,
+):
+    """
+    Tags every document not already in output_path and appends one JSON line
+    {"id": ..., "entities": {entity: [value, confidence]}} per document
+    :param engine: InferenceEngine
+    :param input_path: .jsonl file, .pkl file or directory, see iter_documents
+    :param output_path: JSONL output, resumed if it exists
+    :param batch_size: Documents per forward pass, defaults to 64
+    :param workers: Featurization processes, defaults to cpu count. 0 featurizes in process
+    :param chunk_size: Documents sorted by length at a time, defaults to 4096
+    :param text_field: defaults to text
+    :param id_field: defaults to id
+    :param report_every: Batches between progress reports, defaults to 10
+    :return: documents tagged, seconds taken
+    """
+    done = completed_ids(output_path)
+    if done:
+        print(f"Resuming, {len(done)} documents already tagged")
+
+    documents = (
+        (doc_id, InferenceEngine.tokenize(text) if isinstance(text, str) else [str(word) for word in text])
+        for doc_id, text in iter_documents(input_path, text_field, id_field)
+        if doc_id not in done
+    )
+    batches = length_sorted_batches(documents, batch_size, chunk_size)
+
+    global _featurizer
+    workers = os.cpu_count() if workers is None else workers
+    if workers:
+        pool = Pool(workers, initializer=_init_worker, initargs=(dill.dumps(engine.featurizer),))
+        featurized = prefetch(pool, batches, 2 * workers)
+    else:
+        pool = None
+        _featurizer = engine.featurizer
+        featurized = map(_featurize_batch, batches)
+
+    num_documents = 0
+    start = time.perf_counter()
+    try:
+        with open(output_path, "a", encoding="utf-8") as outfile:
+            for batch_num, (ids, (sentences, inputs)) in enumerate(featurized, 1):
+                for doc_id, entities in zip(ids, engine.predict_features(sentences, inputs)):
+                    outfile.write(json.dumps({"id": doc_id, "entities": entities}) + "\n")
+                outfile.flush()
+                num_documents += len(ids)
+                if batch_num % report_every == 0:
+                    elapsed = time.perf_counter() - start
+                    print(f"{num_documents} documents, {num_documents / elapsed:.1f} docs/sec")
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    return num_documents, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "--input",
+        dest="INPUT",
+        required=True,
+        type=str,
+        help="JSONL file, directory of .txt files or ocr_data.pkl from ocr-image.py",
+    )
+    parser.add_argument(
+        "--output",
+        dest="OUTPUT",
+        required=True,
+        type=str,
+        help="JSONL output, documents already in it are skipped",
+    )
+    add_engine_arguments(parser)
+    parser.add_argument(
+        "--batch-size",
+        dest="BATCH_SIZE",
+        default=infer_config.get("BATCH_SIZE", 64),
+        type=int,
+        help="Documents per forward pass",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="WORKERS",
+        default=os.cpu_count(),
+        type=int,
+        help="Featurization processes, 0 to featurize in process",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        dest="CHUNK_SIZE",
+        default=4096,
+        type=int,
+        help="Documents sorted by length at a time",
+    )
+    parser.add_argument(
+        "--text-field", dest="TEXT_FIELD", default="text", type=str, help="JSONL text field"
+    )
+    parser.add_argument(
+        "--id-field", dest="ID_FIELD", default="id", type=str, help="JSONL id field, line number if missing"
+    )
+    args = parser.parse_args()
+
+    engine = engine_from_args(args)
+    num_documents, seconds = run_batch_inference(
+        engine,
+        args.INPUT,
+        args.OUTPUT,
+        batch_size=args.BATCH_SIZE,
+        workers=args.WORKERS,
+        chunk_size=args.CHUNK_SIZE,
+        text_field=args.TEXT_FIELD,
+        id_field=args.ID_FIELD,
+    )
+    print(f"Tagged {num_documents} documents in {seconds:.1f}s, {num_documents / max(seconds, 1e-9):.1f} docs/sec")
+    engine.close()
@@ -0,0 +1,97 @@
+"""
+Length bucketed batching with per batch padding
+"""
+import random
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+# Keys of per word tensors, dimension 1 is the sentence length
+SEQUENCE_KEYS = (
+    "x_padded",
+    "x_char_padded",
+    "x_postag_padded",
+    "x_enriched_features",
+    "y_ner_padded",
+)
+
+
+def document_lengths(x_padded):
+    """
+    :param x_padded: Padded word ids N, L, 0 being padding
+    :return: Words in each document
+    """
+    return (x_padded > 0).sum(dim=1)
+
+
+def trim_batch(batch, length_key="x_padded"):
+    """
+    Trims per word tensors of a batch to its longest document
+    :param batch: Dictionary of batched tensors
+    :param length_key: Key of padded word ids, defaults to x_padded
+    :return: batch
+    """
+    max_len = max(int(document_lengths(batch[length_key]).max()), 1)
+    return {
+        key: value[:, :max_len] if key in SEQUENCE_KEYS and torch.is_tensor(value) else value
+        for key, value in batch.items()
+    }
+
+
+def trim_collate(samples):
+    """
+    Collates samples and pads the batch only up to its longest document
+    :param samples: list of dictionaries of tensors
+    :return: batch
+    """
+    return trim_batch(default_collate(samples))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches documents of similar length together. Indices are shuffled, split in
+    buckets of batch_size * bucket_size_multiplier, sorted by length within each
+    bucket and batched, then batch order is shuffled
+    """
+    def __init__(
+        self,
+        lengths,
+        batch_size,
+        shuffle=True,
+        bucket_size_multiplier=50,
+        seed=None,
+    ):
+        """
+
+        :param lengths: Length of each document
+        :param batch_size:
+        :param shuffle: Shuffle buckets and batches every epoch, defaults to True
+        :param bucket_size_multiplier: Batches per bucket, defaults to 50
+        :param seed: defaults to None
+        """
+        self.lengths = [int(length) for length in lengths]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = batch_size * bucket_size_multiplier
+        self.random = random.Random(seed)
+
+    def __iter__(self):
+        indices = list(range(len(self.lengths)))
+        if self.shuffle:
+            self.random.shuffle(indices)
+
+        batches = []
+        for start in range(0, len(indices), self.bucket_size):
+            bucket = sorted(
+                indices[start: start + self.bucket_size], key=lambda ind: self.lengths[ind]
+            )
+            batches.extend(
+                bucket[i: i + self.batch_size] for i in range(0, len(bucket), self.batch_size)
+            )
+
+        if self.shuffle:
+            self.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,902 @@
+"""
+Benchmarks for data preparation and model hot paths
+"""
+import os
+import sys
+import json
+import time
+import resource
+import multiprocessing
+import shutil
+import subprocess
+import threading
+import urllib.request
+import tempfile
+import random
+import string
+import argparse
+import asyncio
+import dill
+import nltk
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchcrf import CRF
+from torchnlp.datasets.dataset import Dataset
+from torchnlp.encoders.text import CharacterEncoder, StaticTokenizerEncoder, pad_tensor
+from batching import BucketBatchSampler, document_lengths, trim_collate
+from inference import InferenceEngine
+from inference_server import build_server
+from batch_inference import run_batch_inference
+from micro_batching import MicroBatcher
+from model_bundle import ModelBundle, export_run_bundle
+from vocabulary import Vocabulary
+from crf_decoding import (
+    bio_constraints,
+    crf_kbest_decode,
+    crf_viterbi_decode,
+    path_agreement,
+    tag_marginals,
+)
+from pos_tagging import POSTagger, POSTagCache, prepare_tokens
+from span_extraction import SpanExtractor
+from utils import get_entities_values_joint_probas, get_word_proba
+from train_cnn_rnn_crf import (
+    DECODE_LOSS,
+    LOSS,
+    build_char_matrix,
+    pos_input_for_model,
+    tokenize_character,
+)
+from tests.reference import (
+    baseline_checkpoint,
+    get_bio_entities_values_probas,
+    legacy_char_features,
+    legacy_tokenize_character,
+)
+from tests.synthetic import log_untrained_run, small_model, synthetic_documents, synthetic_feature_tensors
+
+
+def time_it(func, *args, repeat=3, **kwargs):
+    """
+    Best wall clock time of repeat runs
+    :param func:
+    :param repeat: defaults to 3
+    :return: seconds, result of last run
+    """
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def report(title, rows):
+    """
+    Prints a timing table, speedups are relative to the first row
+    :param title:
+    :param rows: list of (name, seconds)
+    :return:
+    """
+    print(f"\n{title}")
+    baseline = rows[0][1]
+    for name, seconds in rows:
+        print(f"  {name:<40} {seconds:>9.3f}s  x{baseline / seconds:.2f}")
+
+
+def benchmark_pos_tagging(args):
+    """
+    Per document nltk.pos_tag against the batched POSTagger, timings depend on the
+    nltk version
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(args.NUM_DOCUMENTS, seed=args.SEED)
+
+    per_document, _ = time_it(
+        lambda: [[tag for _, tag in nltk.pos_tag(prepare_tokens(doc))] for doc in documents],
+        repeat=1,
+    )
+    tagger = POSTagger()
+    batched, _ = time_it(tagger.tag_documents, documents, repeat=1)
+
+    tagger_load, _ = time_it(nltk.tag.PerceptronTagger, repeat=3)
+    print(f"Tagger load {tagger_load * 1000:.1f}ms")
+    report(
+        f"POS tagging, {len(documents)} documents",
+        [
+            ("nltk.pos_tag per document", per_document),
+            ("POSTagger batched", batched),
+        ],
+    )
+
+
+def benchmark_pos_cache(args):
+    """
+    Tagging with a cold and a warm POSTagCache
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(args.NUM_DOCUMENTS, seed=args.SEED)
+    tagger = POSTagger()
+
+    uncached, _ = time_it(tagger.tag_documents, documents, repeat=1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache = POSTagCache(os.path.join(tmp_dir, "pos_cache.sqlite"))
+        cold, _ = time_it(tagger.tag_documents, documents, cache=cache, repeat=1)
+        warm, _ = time_it(tagger.tag_documents, documents, cache=cache, repeat=1)
+        stats = cache.stats()
+        cache.close()
+
+    report(
+        f"POS tag cache, {len(documents)} documents",
+        [("no cache", uncached), ("cold cache", cold), ("warm cache", warm)],
+    )
+    print(f"  cache stats {stats}")
+
+
+def benchmark_char_matrix(args):
+    """
+    Per word character encoding loops against build_char_matrix
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(args.NUM_DOCUMENTS, seed=args.SEED)
+    split = int(len(documents) * 0.8)
+    train, test = documents[:split], documents[split:]
+
+    loops, _ = time_it(legacy_tokenize_character, train, test, args.MAX_SENTENCE_LEN, repeat=1)
+    lookup, _ = time_it(tokenize_character, train, test, args.MAX_SENTENCE_LEN, repeat=1)
+
+    report(
+        f"Character matrix, {len(documents)} documents padded to {args.MAX_SENTENCE_LEN} words",
+        [("per word encode + pad loops", loops), ("build_char_matrix", lookup)],
+    )
+
+
+def _train_epoch_worker(queue, args, bucketed, model_kwargs=None, metric_every=1):
+    """
+    Trains one epoch over synthetic tensors, puts seconds, tokens, padded positions and
+    peak RSS growth in MB on the queue. Runs in its own process so peak memory is per variant.
+    Every metric_every-th batch is decoded as well, None for loss only
+    """
+    torch.manual_seed(args.SEED)
+    tensors = synthetic_feature_tensors(args.NUM_DOCUMENTS, args.MAX_SENTENCE_LEN, seed=args.SEED)
+    dataset = Dataset(
+        [{key: value[i] for key, value in tensors.items()} for i in range(args.NUM_DOCUMENTS)]
+    )
+    if bucketed:
+        dataloader = DataLoader(
+            dataset,
+            batch_sampler=BucketBatchSampler(
+                document_lengths(tensors["x_padded"]), args.BATCH_SIZE, seed=args.SEED
+            ),
+            collate_fn=trim_collate,
+        )
+    else:
+        dataloader = DataLoader(dataset, batch_size=args.BATCH_SIZE, shuffle=True)
+
+    model = small_model(**(model_kwargs or {}))
+    optimizer = torch.optim.Adam(model.parameters())
+    model.train()
+
+    def step(data, decode=True):
+        optimizer.zero_grad()
+        mask = (data["x_padded"] > 0).type(torch.uint8)
+        _, _, loss = model(
+            data["x_padded"],
+            data["x_postag_padded"],
+            data["x_char_padded"],
+            data["x_enriched_features"],
+            mask,
+            data["y_ner_padded"],
+            mode=DECODE_LOSS if decode else LOSS,
+        )
+        loss.backward()
+        optimizer.step()
+
+    # Warm up on one short document so library initialisation is not counted
+    step(trim_collate([dataset[int(document_lengths(tensors["x_padded"]).argmin())]]))
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    positions = 0
+    start = time.perf_counter()
+    for batch_num, data in enumerate(dataloader):
+        positions += data["x_padded"].numel()
+        step(data, decode=metric_every is not None and batch_num % metric_every == 0)
+    seconds = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_rss
+    queue.put(
+        (seconds, int(document_lengths(tensors["x_padded"]).sum()), positions, peak_rss / 1024)
+    )
+
+
+def _compare_train_epochs(args, title, variants):
+    """
+    Runs _train_epoch_worker for each variant in its own process and reports
+    :param args:
+    :param title:
+    :param variants: list of (name, bucketed, model_kwargs), optionally followed by metric_every
+    :return:
+    """
+    rows = []
+    for name, bucketed, model_kwargs, *metric_every in variants:
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(
+            target=_train_epoch_worker, args=(queue, args, bucketed, model_kwargs, *metric_every)
+        )
+        process.start()
+        seconds, tokens, positions, peak_mb = queue.get()
+        process.join()
+        rows.append((name, seconds))
+        print(
+            f"{name:<40} {tokens / seconds:>9.0f} tokens/s  {tokens / positions:>6.1%} of positions "
+            f"are tokens  peak RSS growth {peak_mb:>7.1f}MB"
+        )
+
+    report(
+        f"{title}, {args.NUM_DOCUMENTS} documents, batch size {args.BATCH_SIZE}", rows
+    )
+
+
+def benchmark_dynamic_padding(args):
+    """
+    One training epoch padded to max sentence length against bucketed batches
+    padded to their longest document
+    :param args:
+    :return:
+    """
+    _compare_train_epochs(
+        args,
+        "Training epoch",
+        [
+            (f"padded to {args.MAX_SENTENCE_LEN}", False, {"pack_sequences": False}),
+            ("length buckets, per batch padding", True, {"pack_sequences": False}),
+        ],
+    )
+
+
+def benchmark_packed_rnn(args):
+    """
+    Training epoch with the RNN over padded against packed sequences
+    :param args:
+    :return:
+    """
+    variants = []
+    for rnn_type in ("LSTM", "GRU"):
+        for bucketed, batching in ((False, f"padded to {args.MAX_SENTENCE_LEN}"), (True, "bucketed")):
+            for pack_sequences in (False, True):
+                variants.append(
+                    (
+                        f"{rnn_type} {batching}, {'packed' if pack_sequences else 'padded'} RNN",
+                        bucketed,
+                        {"rnn_type": rnn_type, "pack_sequences": pack_sequences},
+                    )
+                )
+    _compare_train_epochs(args, "Training epoch", variants)
+
+
+def benchmark_char_cnn(args):
+    """
+    Char CNN forward + backward over all word positions against real words only,
+    documents filling 10-20% of max sentence length
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    model = small_model(char_dedup=False)
+    rng = np.random.default_rng(args.SEED)
+    lengths = rng.integers(
+        int(0.1 * args.MAX_SENTENCE_LEN), int(0.2 * args.MAX_SENTENCE_LEN) + 1, args.BATCH_SIZE
+    )
+    mask = torch.from_numpy(np.arange(args.MAX_SENTENCE_LEN) < lengths[:, None]).type(torch.uint8)
+    x_char = torch.randint(1, 80, (args.BATCH_SIZE, args.MAX_SENTENCE_LEN, 12))
+    model.train()
+
+    def step(char_features):
+        model.zero_grad()
+        (char_features() * mask.unsqueeze(-1)).sum().backward()
+
+    full, _ = time_it(step, lambda: legacy_char_features(model, x_char), repeat=5)
+    masked, _ = time_it(step, lambda: model._char_features(x_char, mask), repeat=5)
+    report(
+        f"Char CNN forward + backward, batch of {args.BATCH_SIZE} documents of "
+        f"{lengths.min()}-{lengths.max()} words padded to {args.MAX_SENTENCE_LEN}",
+        [("all word positions", full), ("real words only", masked)],
+    )
+
+
+def benchmark_char_dedup(args):
+    """
+    Char CNN forward + backward once per word occurrence against once per unique
+    word of the batch, on resume like documents
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    documents = synthetic_documents(args.BATCH_SIZE, seed=args.SEED)
+    max_sentence_len = max(len(document) for document in documents)
+    x_char_encoder = CharacterEncoder(sample=[" ".join(doc) for doc in documents], append_eos=False)
+    x_char, _ = build_char_matrix(documents, x_char_encoder, max_sentence_len, max_word_length=12)
+    lengths = np.array([len(document) for document in documents])
+    mask = torch.from_numpy(np.arange(max_sentence_len) < lengths[:, None]).type(torch.uint8)
+    words = x_char.reshape(-1, x_char.size(-1))[mask.reshape(-1).bool()]
+    unique_words = torch.unique(words, dim=0).size(0)
+
+    model = small_model().train()
+
+    def step(char_dedup):
+        model.char_dedup = char_dedup
+        model.zero_grad()
+        model._char_features(x_char, mask).pow(2).sum().backward()
+
+    every_word, _ = time_it(step, False, repeat=5)
+    unique_only, _ = time_it(step, True, repeat=5)
+    report(
+        f"Char CNN forward + backward, {len(documents)} documents, {len(words)} words, "
+        f"{unique_words} unique",
+        [("every word", every_word), ("unique words", unique_only)],
+    )
+
+
+def benchmark_decode_modes(args):
+    """
+    Training epoch decoding every batch for train metrics against decoding sampled
+    batches and computing the CRF loss only
+    :param args:
+    :return:
+    """
+    _compare_train_epochs(
+        args,
+        "Training epoch, bucketed",
+        [
+            ("decode every batch", True, None, 1),
+            ("decode every 10th batch", True, None, 10),
+            ("loss only", True, None, None),
+        ],
+    )
+
+
+def benchmark_viterbi(args):
+    """
+    torchcrf decode against the batched tensor Viterbi of crf_decoding, documents of
+    50-100% of max sentence length
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    num_tags = 16
+    crf = CRF(num_tags, batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -1, 1)
+    emissions = torch.randn(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, num_tags)
+    lengths = torch.randint(args.MAX_SENTENCE_LEN // 2, args.MAX_SENTENCE_LEN + 1, (args.BATCH_SIZE,))
+    mask = (torch.arange(args.MAX_SENTENCE_LEN) < lengths.unsqueeze(1)).type(torch.uint8)
+
+    with torch.no_grad():
+        def list_decode_to_tensor():
+            decoded = crf.decode(emissions, mask)
+            padded = torch.zeros(mask.shape, dtype=torch.long)
+            for row, tags in enumerate(decoded):
+                padded[row, :len(tags)] = torch.LongTensor(tags)
+            return padded
+
+        list_decode, _ = time_it(crf.decode, emissions, mask, repeat=5)
+        list_decode_tensor, _ = time_it(list_decode_to_tensor, repeat=5)
+        tensor_decode, _ = time_it(crf_viterbi_decode, crf, emissions, mask, repeat=5)
+    report(
+        f"CRF decode, batch of {args.BATCH_SIZE} documents of {lengths.min()}-{lengths.max()} "
+        f"words padded to {args.MAX_SENTENCE_LEN}, {num_tags} tags",
+        [
+            ("torchcrf decode", list_decode),
+            ("torchcrf decode, padded to a tensor", list_decode_tensor),
+            ("crf_decoding tensor Viterbi", tensor_decode),
+        ],
+    )
+
+
+def benchmark_marginals(args):
+    """
+    utils.get_word_proba against forward-backward marginals of the decoded tags
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    num_tags = 16
+    crf = CRF(num_tags, batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -1, 1)
+    emissions = torch.randn(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, num_tags)
+    lengths = torch.randint(args.MAX_SENTENCE_LEN // 2, args.MAX_SENTENCE_LEN + 1, (args.BATCH_SIZE,))
+    mask = (torch.arange(args.MAX_SENTENCE_LEN) < lengths.unsqueeze(1)).type(torch.uint8)
+
+    with torch.no_grad():
+        tags, _ = crf_viterbi_decode(crf, emissions, mask)
+        local, _ = time_it(
+            get_word_proba, emissions, crf.transitions, tags, 0, repeat=1
+        )
+        exact, _ = time_it(tag_marginals, crf, emissions, tags, mask, repeat=5)
+    report(
+        f"Decoded tag probabilities, batch of {args.BATCH_SIZE} documents padded to "
+        f"{args.MAX_SENTENCE_LEN}, {num_tags} tags",
+        [("utils.get_word_proba", local), ("forward-backward marginals", exact)],
+    )
+
+
+def benchmark_kbest(args):
+    """
+    Viterbi against k best decoding with path agreement
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    num_tags = 16
+    crf = CRF(num_tags, batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -1, 1)
+
+    emissions = torch.randn(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, num_tags)
+    lengths = torch.randint(args.MAX_SENTENCE_LEN // 2, args.MAX_SENTENCE_LEN + 1, (args.BATCH_SIZE,))
+    mask = (torch.arange(args.MAX_SENTENCE_LEN) < lengths.unsqueeze(1)).type(torch.uint8)
+
+    def kbest_with_agreement(k):
+        tags, scores = crf_kbest_decode(crf, emissions, mask, k=k)
+        return path_agreement(tags, scores, mask, outside_tag=1)
+
+    rows = []
+    with torch.no_grad():
+        rows.append(("Viterbi", time_it(crf_viterbi_decode, crf, emissions, mask, repeat=5)[0]))
+        for k in (1, 3, 5):
+            rows.append(
+                (f"{k} best with path agreement", time_it(kbest_with_agreement, k, repeat=5)[0])
+            )
+    report(
+        f"CRF decode, batch of {args.BATCH_SIZE} documents padded to "
+        f"{args.MAX_SENTENCE_LEN}, {num_tags} tags",
+        rows,
+    )
+
+
+def benchmark_bio_constraints(args):
+    """
+    Unconstrained decoding with span fixups against BIO constrained decoding with a
+    single pass span extraction
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    labels = ["<unk>", "O"] + [f"{entity}-{suffix}" for entity in ("ORG", "PER", "LOC", "DATE") for suffix in "BI"]
+    constraints = bio_constraints(labels)
+    crf = CRF(len(labels), batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -2, 2)
+
+    def is_valid(path):
+        return (
+            bool(constraints.start[path[0]]) and bool(constraints.end[path[-1]])
+            and all(bool(constraints.transitions[a, b]) for a, b in zip(path, path[1:]))
+        )
+
+    emissions = torch.randn(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, len(labels))
+    mask = torch.ones(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, dtype=torch.uint8)
+    words = [f"w{i}" for i in range(args.MAX_SENTENCE_LEN)]
+
+    def extract(constrained):
+        tags, _ = crf_viterbi_decode(crf, emissions, mask, constraints=constraints if constrained else None)
+        proba = tag_marginals(crf, emissions, tags, mask, constraints if constrained else None).tolist()
+        results = [[labels[tag] for tag in row] for row in tags.tolist()]
+        if constrained:
+            return tags, [
+                get_bio_entities_values_probas(result, words, doc_proba)
+                for result, doc_proba in zip(results, proba)
+            ]
+        return tags, [
+            get_entities_values_joint_probas(result, words, doc_proba)
+            for result, doc_proba in zip(results, proba)
+        ]
+
+    with torch.no_grad():
+        free_tags, _ = extract(False)
+        invalid = sum(not is_valid(row) for row in free_tags.tolist())
+        print(f"{invalid} of {args.BATCH_SIZE} unconstrained paths have invalid BIO spans")
+        unconstrained, _ = time_it(extract, False, repeat=3)
+        constrained, _ = time_it(extract, True, repeat=3)
+    report(
+        f"Decode, marginals and span extraction, batch of {args.BATCH_SIZE} documents of "
+        f"{args.MAX_SENTENCE_LEN} words, {len(labels)} tags",
+        [("unconstrained, span fixups", unconstrained), ("BIO constrained, single pass", constrained)],
+    )
+
+
+def benchmark_span_extraction(args):
+    """
+    Per token string span extraction against SpanExtractor on BIO constrained tags
+    :param args:
+    :return:
+    """
+    torch.manual_seed(args.SEED)
+    labels = ["<unk>", "O"] + [f"{entity}-{suffix}" for entity in ("ORG", "PER", "LOC", "DATE") for suffix in "BI"]
+    crf = CRF(len(labels), batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -2, 2)
+    emissions = torch.randn(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, len(labels))
+    # Mostly O, as in real documents
+    emissions[:, :, 1] += 3
+    lengths = torch.randint(args.MAX_SENTENCE_LEN // 2, args.MAX_SENTENCE_LEN + 1, (args.BATCH_SIZE,))
+    mask = (torch.arange(args.MAX_SENTENCE_LEN) < lengths.unsqueeze(1)).type(torch.uint8)
+    constraints = bio_constraints(labels)
+    with torch.no_grad():
+        tags, _ = crf_viterbi_decode(crf, emissions, mask, constraints=constraints)
+        proba = tag_marginals(crf, emissions, tags, mask, constraints)
+    sentences = [[f"w{i}" for i in range(length)] for length in lengths.tolist()]
+    extractor = SpanExtractor(labels)
+
+    def string_spans(extract):
+        results = [
+            [labels[tag] for tag in row[:length]] for row, length in zip(tags.tolist(), lengths.tolist())
+        ]
+        return [
+            extract(result, sentence, doc_proba)
+            for result, sentence, doc_proba in zip(results, sentences, proba.tolist())
+        ]
+
+    joint_probas, _ = time_it(string_spans, get_entities_values_joint_probas, repeat=5)
+    single_pass, _ = time_it(string_spans, get_bio_entities_values_probas, repeat=5)
+    tensors, found = time_it(extractor.entities, tags, proba, sentences, mask, repeat=5)
+    report(
+        f"Span extraction, batch of {args.BATCH_SIZE} documents padded to {args.MAX_SENTENCE_LEN}, "
+        f"{sum(len(doc) for doc in found)} spans",
+        [
+            ("utils.get_entities_values_joint_probas", joint_probas),
+            ("single pass reference", single_pass),
+            ("SpanExtractor", tensors),
+        ],
+    )
+
+
+def benchmark_legacy_checkpoint(args):
+    """
+    A checkpoint pickled before pos tag embeddings, token features, packed sequences
+    and char dedup against the model it was saved from, predict of both
+    :param args:
+    :return:
+    """
+    tensors = synthetic_feature_tensors(args.BATCH_SIZE, args.MAX_SENTENCE_LEN, seed=args.SEED)
+    mask = tensors["x_padded"] > 0
+    x_enrich = torch.rand(tensors["x_padded"].shape + (7,))
+    model = small_model(
+        num_pos_tags=None, tag_embed_dim=40, token_feature_dims=None, enrich_dim=7, pack_sequences=False,
+        char_dedup=False,
+    ).eval()
+    legacy = baseline_checkpoint(model)
+
+    def predict(entity_extraction):
+        with torch.no_grad():
+            return entity_extraction.predict(
+                tensors["x_padded"], pos_input_for_model(entity_extraction, tensors["x_postag_padded"]),
+                tensors["x_char_padded"], x_enrich, mask,
+            )
+
+    model_time, _ = time_it(predict, model)
+    legacy_time, _ = time_it(predict, legacy)
+    report(
+        f"predict of {args.BATCH_SIZE} documents, one hot pos tags",
+        [("EntityExtraction", model_time), ("pre pos tag embedding checkpoint", legacy_time)],
+    )
+
+
+def benchmark_server(args):
+    """
+    Latency of one inference.py invocation per request, which loads the run every
+    time, against requests to a warm inference_server
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(200, min_len=20, max_len=args.MAX_SENTENCE_LEN, seed=args.SEED)
+    texts = [" ".join(doc) for doc in documents[:args.BATCH_SIZE]]
+    work_dir = tempfile.mkdtemp()
+    try:
+        experiment_id, run_id = log_untrained_run(
+            os.path.join(work_dir, "mlruns"), documents, args.MAX_SENTENCE_LEN
+        )
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "inference.py")
+        env = dict(os.environ, MLFLOW_TRACKING_URI=f"file:{os.path.join(work_dir, 'mlruns')}")
+
+        def cold(text):
+            output = subprocess.run(
+                [sys.executable, script, "--experiment-id", experiment_id, "--run-id", run_id, "--data-text", text],
+                env=env, check=True, capture_output=True, text=True,
+            ).stdout
+            return output.split("Output:\n")[1].splitlines()[0]
+
+        # The POS cache is opened here and used from the server's handler threads
+        engine = InferenceEngine(experiment_id, run_id, pos_cache_path=os.path.join(work_dir, "pos_cache.sqlite"))
+        server = build_server(engine, port=0, run_id=run_id)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}/predict"
+
+        def warm(text):
+            request = urllib.request.Request(
+                url, data=json.dumps({"text": text}).encode("utf-8"), headers={"Content-Type": "application/json"}
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.loads(response.read())["entities"][0]
+
+        warm(texts[0])
+        cold_time, _ = time_it(lambda: [cold(text) for text in texts[:3]], repeat=1)
+        warm_time, _ = time_it(lambda: [warm(text) for text in texts], repeat=3)
+        in_process_time, _ = time_it(lambda: [engine.predict([text]) for text in texts], repeat=3)
+        server.shutdown()
+        server.server_close()
+        engine.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(
+        f"Per request latency, documents of up to {args.MAX_SENTENCE_LEN} words",
+        [
+            ("inference.py per invocation (cold)", cold_time / 3),
+            ("inference_server POST /predict (warm)", warm_time / len(texts)),
+            ("InferenceEngine.predict in process", in_process_time / len(texts)),
+        ],
+    )
+
+
+async def generate_load(batcher, documents, concurrency):
+    """
+    Local load generator, concurrency clients each sending one document at a time
+    :param batcher: MicroBatcher
+    :param documents: Documents to send, split between the clients
+    :param concurrency:
+    :return: results in document order, latency of each request in seconds
+    """
+    results = [None] * len(documents)
+    latencies = [None] * len(documents)
+
+    async def client(indices):
+        for i in indices:
+            start = time.perf_counter()
+            results[i] = await batcher.predict(documents[i])
+            latencies[i] = time.perf_counter() - start
+
+    await asyncio.gather(*(client(range(c, len(documents), concurrency)) for c in range(concurrency)))
+    return results, latencies
+
+
+def benchmark_micro_batching(args):
+    """
+    Many small concurrent documents through MicroBatcher, one forward pass per
+    request (max batch size 1) against adaptive batches
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(args.NUM_DOCUMENTS, min_len=5, max_len=60, seed=args.SEED)
+    work_dir = tempfile.mkdtemp()
+    try:
+        experiment_id, run_id = log_untrained_run(
+            os.path.join(work_dir, "mlruns"), documents, args.MAX_SENTENCE_LEN
+        )
+        engine = InferenceEngine(experiment_id, run_id)
+        engine.predict(documents[:2])
+
+        async def run(max_batch_size):
+            batcher = MicroBatcher(engine.predict, max_batch_size=max_batch_size, max_wait=0.005)
+            start = time.perf_counter()
+            _, latencies = await generate_load(batcher, documents, args.CONCURRENCY)
+            elapsed = time.perf_counter() - start
+            await batcher.close()
+            return elapsed, latencies, batcher.stats()
+
+        rows = []
+        for max_batch_size in (1, 8, args.BATCH_SIZE):
+            elapsed, latencies, stats = asyncio.run(run(max_batch_size))
+            latencies = sorted(latencies)
+            print(
+                f"max batch size {max_batch_size}: p50 {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+                f"p99 {latencies[int(len(latencies) * .99)] * 1000:.1f}ms, batch sizes {stats['batch_size']}, "
+                f"queue depths {stats['queue_depth']}"
+            )
+            rows.append((f"max batch size {max_batch_size}, per request", elapsed / len(documents)))
+
+        engine.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(f"{len(documents)} documents of 5 to 60 words from {args.CONCURRENCY} concurrent clients", rows)
+
+
+def benchmark_batch_inference(args):
+    """
+    One InferenceEngine.predict call per document against batch_inference over a
+    JSONL corpus
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(args.NUM_DOCUMENTS, min_len=20, max_len=args.MAX_SENTENCE_LEN, seed=args.SEED)
+    work_dir = tempfile.mkdtemp()
+    try:
+        experiment_id, run_id = log_untrained_run(
+            os.path.join(work_dir, "mlruns"), documents[:200], args.MAX_SENTENCE_LEN
+        )
+        engine = InferenceEngine(experiment_id, run_id)
+        input_path = os.path.join(work_dir, "documents.jsonl")
+        with open(input_path, "w") as outfile:
+            for i, doc in enumerate(documents):
+                outfile.write(json.dumps({"id": f"doc-{i}", "text": " ".join(doc)}) + "\n")
+
+        per_document, _ = time_it(
+            lambda: [engine.predict([" ".join(doc)])[0] for doc in documents], repeat=1
+        )
+        output_path = os.path.join(work_dir, "entities.jsonl")
+        batched, _ = time_it(
+            run_batch_inference, engine, input_path, output_path, batch_size=args.BATCH_SIZE,
+            workers=args.PROCESSES, report_every=10 ** 9, repeat=1,
+        )
+        engine.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(
+        f"{len(documents)} documents of up to {args.MAX_SENTENCE_LEN} words, docs/sec "
+        f"{len(documents) / per_document:.1f} per document, {len(documents) / batched:.1f} batched",
+        [
+            ("InferenceEngine.predict per document", per_document),
+            (f"batch_inference, {args.PROCESSES} workers", batched),
+        ],
+    )
+
+
+def benchmark_bundle(args):
+    """
+    Loading an InferenceEngine from a run (mlflow model, dill encoders, params files)
+    against from a model bundle, for a GloVe sized word vocabulary
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(200, min_len=20, max_len=args.MAX_SENTENCE_LEN, seed=args.SEED)
+    work_dir = tempfile.mkdtemp()
+    try:
+        experiment_id, run_id = log_untrained_run(
+            os.path.join(work_dir, "mlruns"), documents, args.MAX_SENTENCE_LEN, extra_words=args.NUM_DOCUMENTS,
+            word_embed_dim=300, rnn_hidden_size=512, rnn_stack_size=2,
+        )
+        bundle_path = export_run_bundle(experiment_id, run_id, os.path.join(work_dir, "model.nerb"))
+
+        from_run, _ = time_it(InferenceEngine, experiment_id, run_id)
+        from_bundle, _ = time_it(InferenceEngine, bundle_path=bundle_path)
+        open_bundle, bundle = time_it(ModelBundle, bundle_path)
+        size = os.path.getsize(bundle_path) / 2 ** 20
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report(
+        f"Inference engine load, {bundle.hyperparameters['word_vocab_size']} word vocabulary, {size:.0f} MB bundle",
+        [
+            ("InferenceEngine from run", from_run),
+            ("InferenceEngine from bundle", from_bundle),
+            ("ModelBundle open", open_bundle),
+        ],
+    )
+
+
+def benchmark_vocabulary(args):
+    """
+    torchnlp encoders against Vocabulary: loading from dill against npz, and
+    encoding a batch word by word against encode_batch
+    :param args:
+    :return:
+    """
+    documents = synthetic_documents(1000, min_len=20, max_len=args.MAX_SENTENCE_LEN, seed=args.SEED)
+    rng = random.Random(args.SEED)
+    vocab_sample = [[word.lower() for word in doc] for doc in documents] + [
+        ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 12))) for _ in range(1000)]
+        for _ in range(args.NUM_DOCUMENTS // 1000)
+    ]
+    x_encoder = StaticTokenizerEncoder(sample=vocab_sample, append_eos=False, tokenize=lambda x: x)
+    x_char_encoder = CharacterEncoder(sample=[" ".join(doc) for doc in documents], append_eos=False)
+    x_vocabulary = Vocabulary.from_encoder(x_encoder)
+    x_char_vocabulary = Vocabulary.from_encoder(x_char_encoder)
+
+    batch = documents[:args.BATCH_SIZE]
+    X_text_list = [[word.lower() for word in doc] for doc in batch]
+
+    def encode_torchnlp():
+        return torch.stack([pad_tensor(x_encoder.encode(text), args.MAX_SENTENCE_LEN) for text in X_text_list])
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        dill_path = os.path.join(work_dir, "x_encoder")
+        with open(dill_path, "wb") as outfile:
+            dill.dump(x_encoder, outfile)
+        npz_path = x_vocabulary.save(os.path.join(work_dir, "x_encoder.npz"))
+
+        def load_dill():
+            with open(dill_path, "rb") as infile:
+                return dill.load(infile)
+
+        load_dill_time, _ = time_it(load_dill)
+        load_npz_time, _ = time_it(Vocabulary.load, npz_path)
+        dill_size = os.path.getsize(dill_path) / 2 ** 20
+        npz_size = os.path.getsize(npz_path) / 2 ** 20
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    encode_time, _ = time_it(encode_torchnlp)
+    encode_batch_time, _ = time_it(x_vocabulary.encode_batch, X_text_list, args.MAX_SENTENCE_LEN)
+    char_time, _ = time_it(build_char_matrix, batch, x_char_encoder, args.MAX_SENTENCE_LEN, pad_word=None)
+    char_batch_time, _ = time_it(build_char_matrix, batch, x_char_vocabulary, args.MAX_SENTENCE_LEN, pad_word=None)
+
+    report(
+        f"Word vocabulary load, {len(x_vocabulary)} words, dill {dill_size:.1f} MB, npz {npz_size:.1f} MB",
+        [("dill StaticTokenizerEncoder", load_dill_time), ("npz Vocabulary", load_npz_time)],
+    )
+    report(
+        f"Word ids of {len(batch)} documents",
+        [("StaticTokenizerEncoder.encode", encode_time), ("Vocabulary.encode_batch", encode_batch_time)],
+    )
+    report(
+        f"build_char_matrix of {len(batch)} documents",
+        [("CharacterEncoder", char_time), ("Vocabulary", char_batch_time)],
+    )
+
+
+BENCHMARKS = {
+    "pos": benchmark_pos_tagging,
+    "pos-cache": benchmark_pos_cache,
+    "char": benchmark_char_matrix,
+    "padding": benchmark_dynamic_padding,
+    "packed-rnn": benchmark_packed_rnn,
+    "char-cnn": benchmark_char_cnn,
+    "char-dedup": benchmark_char_dedup,
+    "decode-modes": benchmark_decode_modes,
+    "viterbi": benchmark_viterbi,
+    "marginals": benchmark_marginals,
+    "kbest": benchmark_kbest,
+    "bio-constraints": benchmark_bio_constraints,
+    "spans": benchmark_span_extraction,
+    "server": benchmark_server,
+    "micro-batching": benchmark_micro_batching,
+    "batch-inference": benchmark_batch_inference,
+    "bundle": benchmark_bundle,
+    "vocabulary": benchmark_vocabulary,
+    "legacy-checkpoint": benchmark_legacy_checkpoint,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "benchmark",
+        choices=sorted(BENCHMARKS.keys()),
+        help="Benchmark to run",
+    )
+    parser.add_argument(
+        "--num-documents",
+        dest="NUM_DOCUMENTS",
+        default=10000,
+        type=int,
+        help="Number of synthetic documents",
+    )
+    parser.add_argument(
+        "--processes",
+        dest="PROCESSES",
+        default=4,
+        type=int,
+        help="Worker processes for parallel benchmarks",
+    )
+    parser.add_argument(
+        "--max-sentence-len",
+        dest="MAX_SENTENCE_LEN",
+        default=700,
+        type=int,
+        help="Sentence length documents are padded to",
+    )
+    parser.add_argument(
+        "--batch-size", dest="BATCH_SIZE", default=16, type=int, help="Batch size"
+    )
+    parser.add_argument(
+        "--seed", dest="SEED", default=0, type=int, help="Random seed"
+    )
+    parser.add_argument(
+        "--concurrency", dest="CONCURRENCY", default=32, type=int, help="Concurrent clients of load generators"
+    )
+
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
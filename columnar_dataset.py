@@ -0,0 +1,347 @@
+"""
+Memory-mapped columnar dataset format
+"""
+import os
+import json
+import pickle
+import argparse
+from array import array
+from itertools import islice
+from collections.abc import Sequence
+import numpy as np
+
+COLUMNAR_FORMAT = "columnar-ner"
+COLUMNAR_VERSION = 1
+
+
+class StringTable(Sequence):
+    """
+    Read only string table backed by a flat utf-8 byte array and offsets.
+    Strings are decoded lazily on first access
+    """
+    def __init__(self, data, offsets):
+        """
+
+        :param data: uint8 array of concatenated utf-8 strings
+        :param offsets: int64 array of string boundaries, len(strings) + 1
+        """
+        self._data = data
+        self._offsets = offsets
+        self._cache = dict()
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        index = int(index)
+        try:
+            return self._cache[index]
+        except KeyError:
+            string = bytes(
+                self._data[self._offsets[index]: self._offsets[index + 1]]
+            ).decode("utf-8")
+            self._cache[index] = string
+            return string
+
+
+class RemappedStringTable(Sequence):
+    """
+    String table view where each id is first mapped through remap array
+    """
+    def __init__(self, table, remap):
+        self._table = table
+        self._remap = remap
+
+    def __len__(self):
+        return len(self._remap)
+
+    def __getitem__(self, index):
+        return self._table[self._remap[int(index)]]
+
+
+class DocumentView(Sequence):
+    """
+    A single document as a view over the flat id array, slicing returns a view
+    """
+    def __init__(self, ids, table):
+        """
+
+        :param ids: id array slice for this document
+        :param table: table to resolve ids to values
+        """
+        self._ids = ids
+        self._table = table
+
+    @property
+    def ids(self):
+        return self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return DocumentView(self._ids[index], self._table)
+        return self._table[self._ids[index]]
+
+    def __iter__(self):
+        table = self._table
+        for ind in self._ids.tolist():
+            yield table[ind]
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, DocumentView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return f"DocumentView({list(self)!r})"
+
+
+class DocumentList(Sequence):
+    """
+    List of documents over flat ids + offsets, no document is materialised
+    """
+    def __init__(self, ids, offsets, table):
+        self._ids = ids
+        self._offsets = offsets
+        self._table = table
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[ind] for ind in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("document index out of range")
+        return DocumentView(
+            self._ids[self._offsets[index]: self._offsets[index + 1]], self._table
+        )
+
+
+class ColumnarDataset:
+    """
+    Opens a columnar dataset directory. All arrays are memory-mapped so opening
+    costs the same irrespective of corpus size
+    """
+    def __init__(self, dir_path):
+        """
+
+        :param dir_path: Directory written by write_columnar_dataset
+        """
+        self.dir_path = dir_path
+        with open(os.path.join(dir_path, "meta.json"), "r") as infile:
+            self.meta = json.load(infile)
+
+        if self.meta.get("format") != COLUMNAR_FORMAT:
+            raise ValueError(f"{dir_path} is not a {COLUMNAR_FORMAT} directory")
+
+        self.tokens = self._load("tokens.npy")
+        self.labels = self._load("labels.npy")
+        self.offsets = self._load("offsets.npy")
+        self.lower = self._load("lower.npy")
+        self.strings = StringTable(
+            self._load("strings.npy"), self._load("string_offsets.npy")
+        )
+        self.label_names = self.meta["labels"]
+
+    def _load(self, filename):
+        return np.load(os.path.join(self.dir_path, filename), mmap_mode="r")
+
+    def __len__(self):
+        return self.meta["num_documents"]
+
+    def words(self, lower=False):
+        """
+        Documents as lists of words
+        :param lower: Return lower cased words, defaults to False
+        :return: DocumentList
+        """
+        table = RemappedStringTable(self.strings, self.lower) if lower else self.strings
+        return DocumentList(self.tokens, self.offsets, table)
+
+    def ner_labels(self):
+        """
+        Documents as lists of labels
+        :return: DocumentList
+        """
+        return DocumentList(self.labels, self.offsets, self.label_names)
+
+    def document_lengths(self):
+        """
+        :return: Token count for each document
+        """
+        return np.diff(self.offsets)
+
+
+def is_columnar_dataset(path):
+    """
+    Checks if the path is a columnar dataset directory
+    :param path:
+    :return: bool
+    """
+    return os.path.isdir(path) and os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def write_columnar_dataset(documents, dir_path):
+    """
+    Writes documents to columnar format
+    :param documents: Iterable of documents, each a sequence of (word, label) tuples
+    :param dir_path: Directory to write to, created if it does not exist
+    :return: dir_path
+    """
+    os.makedirs(dir_path, exist_ok=True)
+
+    string_to_index = dict()
+    label_to_index = dict()
+    tokens = array("q")
+    labels = array("q")
+    offsets = array("q", [0])
+
+    for document in documents:
+        for word, label in document:
+            string_index = string_to_index.get(word)
+            if string_index is None:
+                string_index = string_to_index[word] = len(string_to_index)
+            label_index = label_to_index.get(label)
+            if label_index is None:
+                label_index = label_to_index[label] = len(label_to_index)
+            tokens.append(string_index)
+            labels.append(label_index)
+        offsets.append(len(tokens))
+
+    # Lower cased forms share the string table
+    strings = list(string_to_index.keys())
+    lower = array("q")
+    ind = 0
+    while ind < len(strings):
+        lower_string = strings[ind].lower()
+        lower_index = string_to_index.get(lower_string)
+        if lower_index is None:
+            lower_index = string_to_index[lower_string] = len(strings)
+            strings.append(lower_string)
+        lower.append(lower_index)
+        ind += 1
+
+    encoded = [string.encode("utf-8") for string in strings]
+    string_offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(string) for string in encoded], out=string_offsets[1:])
+
+    label_dtype = np.int16 if len(label_to_index) < np.iinfo(np.int16).max else np.int32
+    np.save(os.path.join(dir_path, "tokens.npy"), np.asarray(tokens, dtype=np.int32))
+    np.save(os.path.join(dir_path, "labels.npy"), np.asarray(labels, dtype=label_dtype))
+    np.save(os.path.join(dir_path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    np.save(os.path.join(dir_path, "lower.npy"), np.asarray(lower, dtype=np.int32))
+    np.save(
+        os.path.join(dir_path, "strings.npy"),
+        np.frombuffer(b"".join(encoded), dtype=np.uint8),
+    )
+    np.save(os.path.join(dir_path, "string_offsets.npy"), string_offsets)
+
+    with open(os.path.join(dir_path, "meta.json"), "w") as outfile:
+        json.dump(
+            {
+                "format": COLUMNAR_FORMAT,
+                "version": COLUMNAR_VERSION,
+                "num_documents": len(offsets) - 1,
+                "num_tokens": len(tokens),
+                "num_strings": len(strings),
+                "labels": list(label_to_index.keys()),
+            },
+            outfile,
+        )
+    return dir_path
+
+
+def write_columnar_shards(documents, dir_path, shard_size=10000):
+    """
+    Writes documents as a directory of columnar shards of shard_size documents each
+    :param documents: Iterable of documents, each a sequence of (word, label) tuples
+    :param dir_path: Directory to write shard directories to
+    :param shard_size: Documents per shard, defaults to 10000
+    :return: List of shard paths
+    """
+    shard_paths = []
+    documents = iter(documents)
+    while True:
+        shard = list(islice(documents, shard_size))
+        if len(shard) == 0:
+            break
+        shard_paths.append(
+            write_columnar_dataset(
+                shard, os.path.join(dir_path, f"shard-{len(shard_paths):05d}")
+            )
+        )
+    return shard_paths
+
+
+def list_columnar_shards(path):
+    """
+    Lists shards of a sharded columnar dataset, a single columnar dataset is one shard
+    :param path: Columnar dataset or directory of columnar shards
+    :return: Sorted list of shard paths
+    """
+    if is_columnar_dataset(path):
+        return [path]
+    if not os.path.isdir(path):
+        return []
+    return [
+        os.path.join(path, name)
+        for name in sorted(os.listdir(path))
+        if is_columnar_dataset(os.path.join(path, name))
+    ]
+
+
+def convert_pickle_to_columnar(pickle_path, dir_path, shard_size=None):
+    """
+    Converts data_ready_list.pkl style pickle to columnar format
+    :param pickle_path: Pickled list of tuples of (word, label) tuples
+    :param dir_path: Directory to write to
+    :param shard_size: Write shards of shard_size documents, defaults to None i.e. single dataset
+    :return: dir_path
+    """
+    with open(pickle_path, "rb") as in_file:
+        dataset_ready = pickle.load(in_file)
+    if shard_size:
+        write_columnar_shards(dataset_ready, dir_path, shard_size)
+        return dir_path
+    return write_columnar_dataset(dataset_ready, dir_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "--data-path",
+        dest="DATA_PATH",
+        default="data/data_ready_list.pkl",
+        type=str,
+        help="Data file path - pickle format",
+    )
+
+    parser.add_argument(
+        "--save-dir-path",
+        dest="SAVE_DIR_PATH",
+        default="data/data_ready_columnar",
+        type=str,
+        help="Directory path to save columnar dataset",
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        dest="SHARD_SIZE",
+        default=0,
+        type=int,
+        help="Documents per shard for streaming training, defaults to 0 i.e. no sharding",
+    )
+
+    args = parser.parse_args()
+    convert_pickle_to_columnar(args.DATA_PATH, args.SAVE_DIR_PATH, args.SHARD_SIZE)
@@ -0,0 +1,353 @@
+"""
+Batched CRF decoding on tensors
+"""
+from collections import namedtuple
+import torch
+
+# Bool masks of allowed first tags C, last tags C and transitions C, C
+TransitionConstraints = namedtuple("TransitionConstraints", ["start", "end", "transitions"])
+
+
+def parse_bio_label(label):
+    """
+    :param label: e.g. ORG-B
+    :return: entity and suffix B or I, (None, None) for O, padding and other labels
+    """
+    entity, _, suffix = str(label).rpartition("-")
+    if entity and suffix in ("B", "I"):
+        return entity, suffix
+    return None, None
+
+
+def bio_constraints(labels, outside_label="O", pad_index=0):
+    """
+    Allowed transitions of <entity>-B / <entity>-I labels. An <entity>-I only follows
+    <entity>-B or <entity>-I of the same entity, documents never start with an
+    <entity>-I and the padding tag is never decoded
+    :param labels: Tag index to label, e.g. y_ner_encoder.index_to_token
+    :param outside_label: defaults to O
+    :param pad_index: defaults to 0
+    :return: TransitionConstraints
+    """
+    num_tags = len(labels)
+    entities = []
+    is_inside = torch.zeros(num_tags, dtype=torch.bool)
+    for index, label in enumerate(labels):
+        entity, suffix = parse_bio_label(label)
+        entities.append(entity)
+        is_inside[index] = suffix == "I"
+
+    same_entity = torch.tensor(
+        [[a is not None and a == b for b in entities] for a in entities], dtype=torch.bool
+    )
+    allowed = ~is_inside.unsqueeze(0) | same_entity
+    start = ~is_inside
+    end = torch.ones(num_tags, dtype=torch.bool)
+
+    allowed[:, pad_index] = False
+    allowed[pad_index, :] = False
+    start[pad_index] = False
+    end[pad_index] = False
+    return TransitionConstraints(start, end, allowed)
+
+
+def crf_parameters(crf, constraints=None):
+    """
+    :param crf: torchcrf.CRF
+    :param constraints: TransitionConstraints, disallowed transitions score -inf.
+                        Defaults to None
+    :return: start transitions C, end transitions C, transitions C, C
+    """
+    parameters = (crf.start_transitions, crf.end_transitions, crf.transitions)
+    if constraints is None:
+        return parameters
+    return tuple(
+        parameter.masked_fill(~allowed.to(parameter.device), float("-inf"))
+        for parameter, allowed in zip(parameters, constraints)
+    )
+
+
+def viterbi_decode(
+    emissions,
+    mask=None,
+    start_transitions=None,
+    end_transitions=None,
+    transitions=None,
+    pad_tag=0,
+):
+    """
+    Viterbi decoding of a whole batch. The recursion and the backtrace are tensor ops
+    over the batch, looping over positions only. Padded positions keep the score of
+    the last word and point back to their own tag, so the backtrace runs from the
+    last position for every document
+    :param emissions: N, L, C emission scores
+    :param mask: N, L, 0 for padding. The first position of every document is taken
+                 as a word, as in torchcrf. Defaults to None, no padding
+    :param start_transitions: C, defaults to zeros
+    :param end_transitions: C, defaults to zeros
+    :param transitions: C, C score of moving from tag i to tag j, defaults to zeros
+    :param pad_tag: Tag of padded positions in the output, defaults to 0
+    :return: best tags N, L LongTensor, best path scores N
+    """
+    batch_size, max_len, num_tags = emissions.shape
+    if mask is None:
+        mask = emissions.new_ones((batch_size, max_len), dtype=torch.bool)
+    mask = mask.bool()
+    zeros = emissions.new_zeros(num_tags)
+    start_transitions = zeros if start_transitions is None else start_transitions
+    end_transitions = zeros if end_transitions is None else end_transitions
+    transitions = emissions.new_zeros(num_tags, num_tags) if transitions is None else transitions
+
+    score = start_transitions + emissions[:, 0]  # N, C
+    own_tag = torch.arange(num_tags, device=emissions.device).expand(batch_size, num_tags)
+    history = []
+    for position in range(1, max_len):
+        # N, C previous, C next
+        next_score, indices = (
+            score.unsqueeze(2) + transitions + emissions[:, position].unsqueeze(1)
+        ).max(dim=1)
+        is_word = mask[:, position].unsqueeze(1)
+        score = torch.where(is_word, next_score, score)
+        history.append(torch.where(is_word, indices, own_tag))
+
+    best_scores, best_tag = (score + end_transitions).max(dim=1)
+
+    tags = emissions.new_empty((batch_size, max_len), dtype=torch.long)
+    tags[:, -1] = best_tag
+    for position in range(max_len - 2, -1, -1):
+        best_tag = history[position].gather(1, best_tag.unsqueeze(1)).squeeze(1)
+        tags[:, position] = best_tag
+
+    mask = mask.clone()
+    mask[:, 0] = True
+    return tags.masked_fill(~mask, pad_tag), best_scores
+
+
+def crf_viterbi_decode(crf, emissions, mask=None, pad_tag=0, constraints=None):
+    """
+    Drop-in for torchcrf.CRF.decode returning tensors
+    :param crf: batch first torchcrf.CRF
+    :param emissions: N, L, C
+    :param mask: N, L, defaults to None
+    :param pad_tag: defaults to 0
+    :param constraints: TransitionConstraints, defaults to None
+    :return: best tags N, L LongTensor, best path scores N
+    """
+    start_transitions, end_transitions, transitions = crf_parameters(crf, constraints)
+    return viterbi_decode(
+        emissions, mask, start_transitions, end_transitions, transitions, pad_tag=pad_tag
+    )
+
+
+def forward_backward(
+    emissions,
+    mask=None,
+    start_transitions=None,
+    end_transitions=None,
+    transitions=None,
+):
+    """
+    Exact CRF posterior marginals of a whole batch, forward-backward in log space.
+    Padded positions carry the forward score of the last word and the end
+    transitions backwards, so every document ends at the last position
+    :param emissions: N, L, C emission scores
+    :param mask: N, L, 0 for padding. Defaults to None, no padding
+    :param start_transitions: C, defaults to zeros
+    :param end_transitions: C, defaults to zeros
+    :param transitions: C, C, defaults to zeros
+    :return: marginals N, L, C with 0 at padded positions, log partition N
+    """
+    batch_size, max_len, num_tags = emissions.shape
+    if mask is None:
+        mask = emissions.new_ones((batch_size, max_len), dtype=torch.bool)
+    mask = mask.bool().clone()
+    mask[:, 0] = True
+    zeros = emissions.new_zeros(num_tags)
+    start_transitions = zeros if start_transitions is None else start_transitions
+    end_transitions = zeros if end_transitions is None else end_transitions
+    transitions = emissions.new_zeros(num_tags, num_tags) if transitions is None else transitions
+
+    alphas = [start_transitions + emissions[:, 0]]
+    for position in range(1, max_len):
+        alpha = torch.logsumexp(
+            alphas[-1].unsqueeze(2) + transitions, dim=1
+        ) + emissions[:, position]
+        alphas.append(torch.where(mask[:, position].unsqueeze(1), alpha, alphas[-1]))
+
+    betas = [end_transitions.expand(batch_size, num_tags)]
+    for position in range(max_len - 1, 0, -1):
+        beta = torch.logsumexp(
+            transitions + (emissions[:, position] + betas[-1]).unsqueeze(1), dim=2
+        )
+        betas.append(torch.where(mask[:, position].unsqueeze(1), beta, betas[-1]))
+    betas.reverse()
+
+    log_partition = torch.logsumexp(alphas[-1] + end_transitions, dim=1)
+    log_marginals = torch.stack(alphas, dim=1) + torch.stack(betas, dim=1)
+    # alpha + beta of every position log-sum-exps to the log partition, normalizing
+    # per position instead keeps float32 rounding of long documents out
+    marginals = torch.exp(log_marginals - torch.logsumexp(log_marginals, dim=2, keepdim=True))
+    return marginals * mask.unsqueeze(2).type(marginals.dtype), log_partition
+
+
+def crf_marginals(crf, emissions, mask=None, constraints=None):
+    """
+    :param crf: batch first torchcrf.CRF
+    :param emissions: N, L, C
+    :param mask: N, L, defaults to None
+    :param constraints: TransitionConstraints, defaults to None
+    :return: marginals N, L, C with 0 at padded positions
+    """
+    marginals, _ = forward_backward(emissions, mask, *crf_parameters(crf, constraints))
+    return marginals
+
+
+def tag_marginals(crf, emissions, tags, mask=None, constraints=None):
+    """
+    Posterior probability of each given tag, e.g. of the decoded tags
+    :param crf: batch first torchcrf.CRF
+    :param emissions: N, L, C
+    :param tags: N, L LongTensor
+    :param mask: N, L, defaults to None
+    :param constraints: TransitionConstraints, defaults to None
+    :return: probabilities N, L, 0 at padded positions
+    """
+    marginals = crf_marginals(crf, emissions, mask, constraints)
+    return marginals.gather(2, tags.to(marginals.device).unsqueeze(2)).squeeze(2)
+
+
+def _shift(x, steps):
+    """
+    :param x: N, L bool tensor
+    :param steps: Positive shifts right, negative left, filling with False
+    :return: N, L
+    """
+    filler = torch.zeros_like(x[:, :abs(steps)])
+    if steps > 0:
+        return torch.cat((filler, x[:, :-steps]), dim=1)
+    return torch.cat((x[:, -steps:], filler), dim=1)
+
+
+def kbest_viterbi_decode(
+    emissions,
+    mask=None,
+    start_transitions=None,
+    end_transitions=None,
+    transitions=None,
+    k=5,
+    pad_tag=0,
+):
+    """
+    k best paths of a whole batch. Every tag keeps its k best partial paths, each
+    step takes the top k of C * k candidates per tag. Padded positions keep their
+    scores and point back to their own tag and rank, as in viterbi_decode
+    :param emissions: N, L, C emission scores
+    :param mask: N, L, 0 for padding. Defaults to None, no padding
+    :param start_transitions: C, defaults to zeros
+    :param end_transitions: C, defaults to zeros
+    :param transitions: C, C, defaults to zeros
+    :param k: Number of paths, defaults to 5. Documents with fewer possible paths
+              get -inf scored fillers
+    :param pad_tag: Tag of padded positions in the output, defaults to 0
+    :return: tags N, k, L LongTensor best first, path scores N, k
+    """
+    batch_size, max_len, num_tags = emissions.shape
+    if mask is None:
+        mask = emissions.new_ones((batch_size, max_len), dtype=torch.bool)
+    mask = mask.bool().clone()
+    mask[:, 0] = True
+    zeros = emissions.new_zeros(num_tags)
+    start_transitions = zeros if start_transitions is None else start_transitions
+    end_transitions = zeros if end_transitions is None else end_transitions
+    transitions = emissions.new_zeros(num_tags, num_tags) if transitions is None else transitions
+
+    # N, C, k partial path scores, only rank 0 exists at the first position
+    score = emissions.new_full((batch_size, num_tags, k), float("-inf"))
+    score[:, :, 0] = start_transitions + emissions[:, 0]
+    # Flat previous (tag, rank) index of staying on the same tag and rank
+    own_state = torch.arange(num_tags * k, device=emissions.device).view(1, num_tags, k)
+    history = []
+    for position in range(1, max_len):
+        # N, C previous * k, C next
+        candidates = (
+            score.unsqueeze(3) + transitions.unsqueeze(1) + emissions[:, position, None, None]
+        ).reshape(batch_size, num_tags * k, num_tags)
+        next_score, indices = candidates.topk(k, dim=1)
+        next_score, indices = next_score.transpose(1, 2), indices.transpose(1, 2)
+        is_word = mask[:, position].view(-1, 1, 1)
+        score = torch.where(is_word, next_score, score)
+        history.append(torch.where(is_word, indices, own_state))
+
+    best_scores, state = (score + end_transitions.view(1, -1, 1)).reshape(batch_size, -1).topk(k, dim=1)
+
+    tags = emissions.new_empty((batch_size, k, max_len), dtype=torch.long)
+    tags[:, :, -1] = state // k
+    for position in range(max_len - 2, -1, -1):
+        state = history[position].reshape(batch_size, -1).gather(1, state)
+        tags[:, :, position] = state // k
+
+    return tags.masked_fill(~mask.unsqueeze(1), pad_tag), best_scores
+
+
+def crf_kbest_decode(crf, emissions, mask=None, k=5, pad_tag=0, constraints=None):
+    """
+    :param crf: batch first torchcrf.CRF
+    :param emissions: N, L, C
+    :param mask: N, L, defaults to None
+    :param k: defaults to 5
+    :param pad_tag: defaults to 0
+    :param constraints: TransitionConstraints, defaults to None
+    :return: tags N, k, L LongTensor best first, path scores N, k
+    """
+    return kbest_viterbi_decode(
+        emissions, mask, *crf_parameters(crf, constraints), k=k, pad_tag=pad_tag
+    )
+
+
+def path_agreement(kbest_tags, kbest_scores, mask=None, outside_tag=None):
+    """
+    Confidence of each tag of the best path from the agreement of the k best paths,
+    weighted by their scores normalized over the k paths. Tags of a span, a run of
+    tags other than outside_tag, get the weight of paths that have the same tags over
+    the whole span and its two neighbours, so paths with a longer, shorter or
+    differently labelled span do not count
+    :param kbest_tags: N, k, L from kbest_viterbi_decode
+    :param kbest_scores: N, k
+    :param mask: N, L, defaults to None
+    :param outside_tag: Tag outside of spans, e.g. O. Defaults to None, every tag
+                        is scored on its own
+    :return: agreement N, L in [0, 1], 0 at padded positions
+    """
+    batch_size, k, max_len = kbest_tags.shape
+    if mask is None:
+        mask = torch.ones((batch_size, max_len), dtype=torch.bool, device=kbest_tags.device)
+    mask = mask.bool()
+    best = kbest_tags[:, 0]
+    weights = torch.softmax(kbest_scores, dim=1).unsqueeze(2)  # N, k, 1
+    disagree = (kbest_tags != best.unsqueeze(1)) & mask.unsqueeze(1)  # N, k, L
+
+    token_agreement = (weights * ~disagree).sum(dim=1)
+    if outside_tag is None:
+        return token_agreement * mask
+
+    positions = torch.arange(max_len, device=kbest_tags.device).expand(batch_size, max_len)
+    in_span = (best != outside_tag) & mask
+    previous_in_span = _shift(in_span, 1)
+    next_in_span = _shift(in_span, -1)
+    # First and last position of the span of every position, widened by one
+    span_start = positions.masked_fill(~(in_span & ~previous_in_span), 0).cummax(dim=1).values
+    span_end = (
+        positions.masked_fill(~(in_span & ~next_in_span), max_len - 1)
+        .flip(1).cummin(dim=1).values.flip(1)
+    )
+    low = (span_start - 1).clamp(min=0)
+    high = (span_end + 1).clamp(max=max_len - 1)
+
+    # Disagreements over [low, high] from a cumulative sum with a leading 0
+    cumulative = torch.nn.functional.pad(disagree.long().cumsum(dim=2), (1, 0))
+    disagreements = cumulative.gather(
+        2, (high + 1).unsqueeze(1).expand(-1, k, -1)
+    ) - cumulative.gather(2, low.unsqueeze(1).expand(-1, k, -1))
+    span_agreement = (weights * (disagreements == 0)).sum(dim=1)
+
+    return torch.where(in_span, span_agreement, token_agreement) * mask
@@ -1,37 +1,50 @@
 import os
+import argparse
 import torch
 import ast
-import dill
 import yaml
 from torchnlp.encoders.text import pad_tensor
 from torchnlp.datasets.dataset import Dataset
 from torch.utils.data import DataLoader
 import mlflow.pytorch
-from utils import (
-    get_word_proba,
-    get_entities_values_joint_probas,
-    get_one_value_each_entity,
-)
+from utils import get_one_value_each_entity
 from train_cnn_rnn_crf import (
+    attach_char_cache,
+    attach_transition_constraints,
+    build_char_matrix,
     load_data,
     get_POS_tags,
     trim_list_of_lists_upto_max_len,
     tokenize_pos_tags,
-    pad_and_stack_list_of_list,
-    enrich_data,
+    pos_input_for_model,
 )
+from batching import BucketBatchSampler, document_lengths, trim_collate
+from crf_decoding import crf_viterbi_decode, tag_marginals
+from inference import run_paths
+from pos_tagging import POSTagCache
+from span_extraction import SpanExtractor
+from streaming_dataset import load_test_documents
+from token_features import TokenFeatureSpec, token_features_for_model
+from vocabulary import CHAR_WORDS, load_run_vocabularies
 
 with open("inference_config.yml", "r") as fh:
     infer_config = yaml.safe_load(fh)
 
+parser = argparse.ArgumentParser(description="Get Input Values")
+parser.add_argument(
+    "--data-path",
+    dest="DATA_PATH",
+    default=None,
+    type=str,
+    help="Data the run was trained on - pickle format, columnar dataset directory or directory of "
+         "columnar shards. Defaults to the run's DATA_PATH param",
+)
+args = parser.parse_args()
+
 EXPERIMENT_ID = infer_config["EXPERIMENT_ID"]
 RUN_ID = infer_config["RUN_ID"]
 
-experiment = mlflow.get_experiment(str(EXPERIMENT_ID))
-artifacts_uri = experiment.artifact_location
-artifcats_location = f"{artifacts_uri}/{RUN_ID}/artifacts/files"
-model_location = f"{artifacts_uri}/{RUN_ID}/artifacts/model"
-params_location =f"{artifacts_uri.replace('file:///','')}/{RUN_ID}/params"
+params_location, files_location, model_location = run_paths(EXPERIMENT_ID, RUN_ID)
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 with open(os.path.join(params_location, 'MAX_SENTENCE_LEN'), 'r') as infile:
@@ -40,95 +53,77 @@ with open(os.path.join(params_location, 'MAX_SENTENCE_LEN'), 'r') as infile:
 with open(os.path.join(params_location, 'MAX_WORD_LENGTH'), 'r') as infile:
     max_word_length = ast.literal_eval(infile.read())
 
-with open(os.path.join(params_location, 'TEST_INDEX'), 'r') as infile:
-    TEST_INDEX = ast.literal_eval(infile.read())
+STREAMING = False
+if os.path.isfile(os.path.join(params_location, 'STREAMING')):
+    with open(os.path.join(params_location, 'STREAMING'), 'r') as infile:
+        STREAMING = ast.literal_eval(infile.read())
+
+DATA_PATH = args.DATA_PATH
+if DATA_PATH is None:
+    with open(os.path.join(params_location, 'DATA_PATH'), 'r') as infile:
+        DATA_PATH = infile.read()
+
+if STREAMING:
+    # Streaming runs hold out documents of every shard, rebuilt from the split settings
+    with open(os.path.join(params_location, 'TEST_SPLIT'), 'r') as infile:
+        TEST_SPLIT = ast.literal_eval(infile.read())
+    with open(os.path.join(params_location, 'SPLIT_SEED'), 'r') as infile:
+        SPLIT_SEED = ast.literal_eval(infile.read())
+else:
+    with open(os.path.join(params_location, 'TEST_INDEX'), 'r') as infile:
+        TEST_INDEX = ast.literal_eval(infile.read())
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 model = mlflow.pytorch.load_model(model_location).to(device)
 
-# X Encoder load
-with open(f"mlruns/{EXPERIMENT_ID}/{RUN_ID}/artifacts/files/x_encoder", "rb") as infile:
-    x_encoder = dill.load(infile)
+# Migrated from the dill artifacts for runs saved before vocabularies
+vocabularies, tag_to_index = load_run_vocabularies(files_location)
+x_encoder = vocabularies["x_encoder"]
+x_char_encoder = vocabularies["x_char_encoder"]
+y_ner_encoder = vocabularies["y_ner_encoder"]
+# Runs saved before char_words only have the lowercased training words
+char_words = vocabularies.get(CHAR_WORDS, x_encoder)
+
+char_cache = attach_char_cache(
+    model,
+    infer_config.get("CHAR_CACHE_SIZE", 100000),
+    prewarm_words=char_words.vocab if ast.literal_eval(str(infer_config.get("CHAR_CACHE_PREWARM", False))) else None,
+    x_char_encoder=x_char_encoder,
+    max_word_length=max_word_length,
+)
 
-with open(f"mlruns/{EXPERIMENT_ID}/{RUN_ID}/artifacts/files/x_char_encoder", "rb") as infile:
-    x_char_encoder = dill.load(infile)
+constraints = None
+if ast.literal_eval(str(infer_config.get("BIO_CONSTRAINTS", True))):
+    constraints = attach_transition_constraints(model, y_ner_encoder)
 
-with open(f"mlruns/{EXPERIMENT_ID}/{RUN_ID}/artifacts/files/y_ner_encoder", "rb") as infile:
-    y_ner_encoder = dill.load(infile)
+span_extractor = SpanExtractor(y_ner_encoder.index_to_token)
 
-with open(f"mlruns/{EXPERIMENT_ID}/{RUN_ID}/artifacts/files/tag_to_index", "rb") as infile:
-    tag_to_index = dill.load(infile)
+token_feature_spec = TokenFeatureSpec.load(files_location)
 
-X_text_list_as_is, X_text_list, y_ner_list = load_data()
-X_tags, tag_to_index_eval = get_POS_tags(X_text_list)
+if STREAMING:
+    X_text_list_as_is, X_text_list, y_ner_list = load_test_documents(DATA_PATH, TEST_SPLIT, SPLIT_SEED)
+    TEST_INDEX = list(range(len(X_text_list)))
+else:
+    X_text_list_as_is, X_text_list, y_ner_list = load_data(DATA_PATH)
+pos_cache = POSTagCache(infer_config["POS_CACHE_PATH"]) if infer_config.get("POS_CACHE_PATH") else None
+X_tags, _ = get_POS_tags(X_text_list, cache=pos_cache, tag_to_index=tag_to_index)
+if pos_cache is not None:
+    print(f"POS cache - {pos_cache.stats()}")
+    pos_cache.close()
 X_text_list = trim_list_of_lists_upto_max_len(X_text_list, max_sentence_len)
 X_text_list_as_is = trim_list_of_lists_upto_max_len(X_text_list_as_is, max_sentence_len)
 y_ner_list = trim_list_of_lists_upto_max_len(y_ner_list, max_sentence_len)
 X_tags = trim_list_of_lists_upto_max_len(X_tags, max_sentence_len)
 
-alnum, numeric, alpha, digit, lower, title, ascii = enrich_data(X_text_list_as_is)
-
-alnum = pad_and_stack_list_of_list(
-    alnum,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-numeric = pad_and_stack_list_of_list(
-    numeric,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-alpha = pad_and_stack_list_of_list(
-    alpha,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-digit = pad_and_stack_list_of_list(
-    digit,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-lower = pad_and_stack_list_of_list(
-    lower,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-title = pad_and_stack_list_of_list(
-    title,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-ascii = pad_and_stack_list_of_list(
-    ascii,
-    max_sentence_len=max_sentence_len,
-    pad_value=-1,
-    tensor_type=torch.FloatTensor,
-)
-
-x_enriched_features = torch.stack(
-    (alnum, numeric, alpha, digit, lower, title, ascii), dim=2
-)
+x_enriched_features = token_feature_spec.featurize(X_text_list_as_is, max_sentence_len=max_sentence_len)
 
 
-x_encoded = [x_encoder.encode(text) for text in X_text_list]
-x_padded = [pad_tensor(tensor, max_sentence_len) for tensor in x_encoded]
-x_padded = torch.LongTensor(torch.stack(x_padded))
+x_padded = x_encoder.encode_batch(X_text_list, max_sentence_len)
 
-x_char_padded = [
-    [pad_tensor(x_char_encoder.encode(char[:max_word_length]), max_word_length) for char in word]
-    for word in X_text_list_as_is
-]
-x_char_padded = [
-    pad_tensor(torch.stack(lst), max_sentence_len) for lst in x_char_padded
-]
-x_char_padded = torch.stack(x_char_padded).type(torch.LongTensor)
+x_char_padded, _ = build_char_matrix(
+    X_text_list_as_is, x_char_encoder, max_sentence_len, max_word_length, pad_word=None
+)
 
 x_postag_padded = tokenize_pos_tags(
     X_tags, tag_to_index=tag_to_index, max_sen_len=max_sentence_len
@@ -160,7 +155,12 @@ dataset_infer = Dataset(
     ]
 )
 
-dataloader_infer = DataLoader(dataset=dataset_infer, batch_size=2, shuffle=True)
+dataloader_infer = DataLoader(
+    dataset=dataset_infer,
+    batch_sampler=BucketBatchSampler(document_lengths(x_padded), batch_size=2, shuffle=True),
+    # Same padding as inference, packed RNNs skip it
+    collate_fn=trim_collate if getattr(model, "pack_sequences", False) else None,
+)
 
 for i, data_infer in enumerate(dataloader_infer):
     with torch.no_grad():
@@ -171,30 +171,31 @@ for i, data_infer in enumerate(dataloader_infer):
         )
         out, decoded, crf_loss = model.predict(
             data_infer["x_padded"].to(device),
-            data_infer["x_postag_padded"].to(device),
+            pos_input_for_model(model, data_infer["x_postag_padded"]).to(device),
             data_infer["x_char_padded"].to(device),
-            data_infer["x_enriched_features"].to(device),
+            token_features_for_model(
+                model, token_feature_spec, data_infer["x_enriched_features"], mask
+            ).to(device),
             mask.to(device),
         )
-
-    out_proba, softmax_scores = get_word_proba(emmision_matrix=out,
-                               transition_matrix=model.crf.transitions,
-                               decoded_out=decoded,
-                               o_index=y_ner_encoder.token_to_index['O'])
-
-    sentence_y = [[x_encoder.index_to_token[ind] for ind in x_p] for x_p in data_infer["x_padded"]]
+        if not torch.is_tensor(decoded):
+            # Models trained before crf_decoding return lists and decode unconstrained
+            decoded, _ = crf_viterbi_decode(model.crf, out, mask.to(device), constraints=constraints)
+        decoded = decoded.to("cpu")
+        # Posterior probability of each decoded tag
+        out_proba = tag_marginals(model.crf, out, decoded, mask.to(device), constraints).to("cpu")
+    lengths = mask.sum(dim=1).tolist()
+
+    sentence_y = [[x_encoder.index_to_token[ind] for ind in x_p[:length]]
+                  for x_p, length in zip(data_infer["x_padded"].tolist(), lengths)]
     true_y = [[y_ner_encoder.index_to_token[word] for word in true] for true in data_infer['y_ner_padded']]
-    result_y = [[y_ner_encoder.index_to_token[word] for word in prediction] for prediction in decoded]
-    proba_y = [[proba.item() for proba in proba_list] for proba_list in out_proba]
-
-    final_out_list = []
-    for j in range(len(sentence_y)):
-        final_out_list.append(get_entities_values_joint_probas(result=result_y[j],
-                                                               sentence=sentence_y[j],
-                                                               proba=proba_y[j],
-                                                               log_score=False,
-                                                               add_factor=0.5,
-                                                               restrict_if_no_begining=True))
+
+    final_out_list = span_extractor.entities(
+        decoded, out_proba, sentence_y, mask, restrict_if_no_begining=True, add_factor=0.5
+    )
 
     final_out_dict = get_one_value_each_entity(final_out_list)
     break
+
+if char_cache is not None:
+    print(f"Char cache - {char_cache.stats()}")
@@ -0,0 +1,116 @@
+"""
+Persistent store for featurized training tensors
+"""
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import torch
+import dill
+
+# Bump whenever featurization output changes so that old entries are not reused
+FEATURE_STORE_VERSION = 5
+
+
+def hash_data_path(path, chunk_size=1 << 20):
+    """
+    Content hash of a data file or every file of a data directory
+    :param path: Pickle file or columnar dataset directory
+    :param chunk_size: defaults to 1MB
+    :return: hex digest
+    """
+    if os.path.isdir(path):
+        filepaths = sorted(
+            os.path.join(root, filename)
+            for root, _, filenames in os.walk(path)
+            for filename in filenames
+        )
+    else:
+        filepaths = [path]
+
+    sha = hashlib.sha256()
+    for filepath in filepaths:
+        sha.update(os.path.relpath(filepath, path).encode("utf-8"))
+        with open(filepath, "rb") as infile:
+            for chunk in iter(lambda: infile.read(chunk_size), b""):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def feature_cache_key(data_path, settings):
+    """
+    Cache key from data content and featurization settings
+    :param data_path:
+    :param settings: Dictionary of json serializable settings
+    :return: hex digest
+    """
+    sha = hashlib.sha256()
+    sha.update(hash_data_path(data_path).encode("utf-8"))
+    sha.update(
+        json.dumps(
+            dict(settings, FEATURE_STORE_VERSION=FEATURE_STORE_VERSION), sort_keys=True
+        ).encode("utf-8")
+    )
+    return sha.hexdigest()
+
+
+class FeatureStore:
+    """
+    Directory of featurized datasets, one sub directory per cache key. Tensors are
+    saved as .npy and memory-mapped on load, everything else is dill pickled
+    """
+    def __init__(self, cache_dir):
+        """
+
+        :param cache_dir: Root directory of the store
+        """
+        self.cache_dir = cache_dir
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self.path(key), "objects.dill"))
+
+    def save(self, key, tensors, objects):
+        """
+        Saves an entry atomically, a partially written entry is never visible
+        :param key: Cache key
+        :param tensors: Dictionary of tensors
+        :param objects: Dictionary of any other dill serializable objects
+        :return: Entry path
+        """
+        entry_path = self.path(key)
+        tmp_path = f"{entry_path}.tmp{os.getpid()}"
+        os.makedirs(tmp_path, exist_ok=True)
+
+        for name, tensor in tensors.items():
+            np.save(os.path.join(tmp_path, f"{name}.npy"), tensor.numpy())
+
+        # objects.dill is written last and marks the entry complete
+        with open(os.path.join(tmp_path, "objects.dill"), "wb") as outfile:
+            dill.dump(dict(objects, tensor_names=list(tensors.keys())), outfile)
+
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path)
+        os.replace(tmp_path, entry_path)
+        return entry_path
+
+    def load(self, key):
+        """
+        Loads an entry, tensors are copy-on-write memory maps of the saved arrays
+        :param key: Cache key
+        :return: tensors, objects
+        """
+        entry_path = self.path(key)
+        with open(os.path.join(entry_path, "objects.dill"), "rb") as infile:
+            objects = dill.load(infile)
+
+        tensors = {
+            name: torch.from_numpy(
+                np.load(os.path.join(entry_path, f"{name}.npy"), mmap_mode="c")
+            )
+            for name in objects.pop("tensor_names")
+        }
+        return tensors, objects
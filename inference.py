@@ -3,78 +3,338 @@ Inference code
 """
 import argparse
 import os
+import threading
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 import torch
 import ast
-import dill
-from torchnlp.encoders.text import pad_tensor
 import mlflow.pytorch
 import yaml
 from utils import (
     clean_text,
-    get_word_proba,
-    get_entities_values_joint_probas,
     get_one_value_each_entity,
 )
 from train_cnn_rnn_crf import (
+    attach_char_cache,
+    attach_transition_constraints,
+    build_char_matrix,
     get_POS_tags,
     trim_list_of_lists_upto_max_len,
     tokenize_pos_tags,
-    pad_and_stack_list_of_list,
-    enrich_data,
+    pos_input_for_model,
 )
+from batching import trim_batch
+from crf_decoding import crf_kbest_decode, crf_viterbi_decode, path_agreement, tag_marginals
+from model_bundle import ModelBundle
+from pos_tagging import POSTagCache
+from span_extraction import SpanExtractor
+from token_features import TokenFeatureSpec, token_features_for_model
+from vocabulary import CHAR_WORDS, load_run_vocabularies
 
 with open("inference_config.yml", "r") as fh:
     infer_config = yaml.safe_load(fh)
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-def predict(model, x_padded, x_postag_padded, x_char_padded, x_enriched_features, restrict_if_no_begining=True):
+def predict(model, x_padded, x_postag_padded, x_char_padded, x_enriched_features, restrict_if_no_begining=True,
+            token_feature_spec=None, n_best=1, span_extractor=None, sentences=None, y_ner_encoder=None):
+    """
+    Entities of each document with their confidence
+    :param restrict_if_no_begining: Drop spans without a <label>-B tag, defaults to True. Not
+                                    needed for models with attach_transition_constraints
+    :param token_feature_spec: TokenFeatureSpec of the run
+    :param n_best: Decode the n best paths and score spans by their agreement instead
+                   of CRF marginals, defaults to 1
+    :param span_extractor: SpanExtractor of y_ner_encoder, built if None
+    :param sentences: Words of each document as is
+    :param y_ner_encoder:
+    :return: list of dictionaries entity -> (value, confidence)
+    """
+    if getattr(model, "pack_sequences", False):
+        # Packed RNNs skip padding, pad only up to the longest document. Padded RNNs read it,
+        # so they keep the max sentence length padding they were trained with
+        batch = trim_batch(
+            {
+                "x_padded": x_padded,
+                "x_postag_padded": x_postag_padded,
+                "x_char_padded": x_char_padded,
+                "x_enriched_features": x_enriched_features,
+            }
+        )
+        x_padded = batch["x_padded"]
+        x_postag_padded = batch["x_postag_padded"]
+        x_char_padded = batch["x_char_padded"]
+        x_enriched_features = batch["x_enriched_features"]
+
     mask = torch.where(x_padded > 0,
                        torch.Tensor([1]).type(torch.uint8),
                        torch.Tensor([0]).type(torch.uint8),
                        )
 
+    constraints = getattr(model, "transition_constraints", None)
     with torch.no_grad():
         out, decoded, crf_loss = model.predict(
             x_padded.to(device),
-            x_postag_padded.to(device),
+            pos_input_for_model(model, x_postag_padded).to(device),
             x_char_padded.to(device),
-            x_enriched_features.to(device),
+            token_features_for_model(model, token_feature_spec, x_enriched_features, mask).to(device),
             mask.to(device),
         )
-
-    out_proba, softmax_scores = get_word_proba(emmision_matrix=out,
-                                               transition_matrix=model.crf.transitions,
-                                               decoded_out=decoded,
-                                               o_index=y_ner_encoder.token_to_index['O'])
-
-    result_y = [[y_ner_encoder.index_to_token[word] for word in prediction] for prediction in decoded][:len(X_text_list_as_is)]
-    proba_y = [[proba.item() for proba in proba_list] for proba_list in out_proba]
-
-    final_out_list = []
-    for j in range(len(X_text_list_as_is)):
-        final_out_list.append(
-            get_entities_values_joint_probas(result=result_y[j],
-                                             sentence=X_text_list_as_is[j],
-                                             proba=proba_y[j],
-                                             log_score=False,
-                                             add_factor=0.5,
-                                             restrict_if_no_begining=restrict_if_no_begining))
+        if n_best > 1:
+            # Score spans by the agreement of the n best paths
+            kbest_tags, kbest_scores = crf_kbest_decode(
+                model.crf, out, mask.to(device), k=n_best, constraints=constraints
+            )
+            decoded = kbest_tags[:, 0].to("cpu")
+            out_proba = path_agreement(
+                kbest_tags, kbest_scores, mask.to(device), outside_tag=y_ner_encoder.token_to_index['O']
+            ).to("cpu")
+        else:
+            if not torch.is_tensor(decoded):
+                # Models trained before crf_decoding return lists and decode unconstrained
+                decoded, _ = crf_viterbi_decode(model.crf, out, mask.to(device), constraints=constraints)
+            decoded = decoded.to("cpu")
+            # Posterior probability of each decoded tag
+            out_proba = tag_marginals(model.crf, out, decoded, mask.to(device), constraints).to("cpu")
+
+    if span_extractor is None:
+        span_extractor = SpanExtractor(y_ner_encoder.index_to_token)
+    final_out_list = span_extractor.entities(
+        decoded, out_proba, sentences, mask, restrict_if_no_begining, add_factor=0.5
+    )
 
     final_out_dict = get_one_value_each_entity(final_out_list)
     return final_out_dict
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Get Input Values")
-    parser.add_argument(
-        "--data-text",
-        dest="DATA_TEXT",
-        default=infer_config["DATA_TEXT"],
-        type=str,
-        help="Text",
+def run_paths(experiment_id, run_id):
+    """
+    Local directories of a run of the file tracking store
+    :param experiment_id:
+    :param run_id:
+    :return: params directory, artifacts files directory, model directory
+    """
+    artifacts_uri = mlflow.get_experiment(str(experiment_id)).artifact_location
+    parsed = urlparse(artifacts_uri)
+    experiment_dir = url2pathname(parsed.path) if parsed.scheme == "file" else artifacts_uri
+    run_dir = os.path.join(experiment_dir, str(run_id))
+    return (
+        os.path.join(run_dir, "params"),
+        os.path.join(run_dir, "artifacts", "files"),
+        os.path.join(run_dir, "artifacts", "model"),
     )
 
+
+class InferenceFeaturizer:
+    """
+    Model inputs of documents from the encoders and feature spec of a run. Holds
+    no model, so it can be shipped to worker processes
+    """
+    def __init__(
+        self, x_encoder, x_char_encoder, tag_to_index, token_feature_spec, max_sentence_len, max_word_length
+    ):
+        """
+
+        :param x_encoder: Vocabulary
+        :param x_char_encoder: Vocabulary
+        :param tag_to_index:
+        :param token_feature_spec: TokenFeatureSpec
+        :param max_sentence_len:
+        :param max_word_length:
+        """
+        self.x_encoder = x_encoder
+        self.x_char_encoder = x_char_encoder
+        self.tag_to_index = tag_to_index
+        self.token_feature_spec = token_feature_spec
+        self.max_sentence_len = max_sentence_len
+        self.max_word_length = max_word_length
+
+    def __call__(self, documents, pos_cache=None):
+        """
+        :param documents: Words of each document as is
+        :param pos_cache: POSTagCache, defaults to None
+        :return: Words trimmed to max sentence length, dictionary of model inputs
+        """
+        X_text_list_as_is = trim_list_of_lists_upto_max_len(documents, self.max_sentence_len)
+        X_text_list = [[word.lower() for word in lst] for lst in X_text_list_as_is]
+        X_tags, _ = get_POS_tags(X_text_list, cache=pos_cache, tag_to_index=self.tag_to_index)
+
+        x_padded = self.x_encoder.encode_batch(X_text_list, self.max_sentence_len)
+        x_char_padded, _ = build_char_matrix(
+            X_text_list_as_is, self.x_char_encoder, self.max_sentence_len, self.max_word_length, pad_word=None
+        )
+        return X_text_list_as_is, {
+            "x_padded": x_padded,
+            "x_postag_padded": tokenize_pos_tags(
+                X_tags, tag_to_index=self.tag_to_index, max_sen_len=self.max_sentence_len
+            ),
+            "x_char_padded": x_char_padded,
+            "x_enriched_features": self.token_feature_spec.featurize(
+                X_text_list_as_is, max_sentence_len=self.max_sentence_len
+            ),
+        }
+
+
+class InferenceEngine:
+    """
+    Loads the model, encoders, params and feature spec of a run or bundle once and tags
+    documents with them. predict is serialized with a lock, the model caches and
+    the POS tag cache are not thread safe
+    """
+    def __init__(
+        self,
+        experiment_id=None,
+        run_id=None,
+        restrict_if_no_begining=True,
+        bio_constraints=True,
+        n_best=1,
+        pos_cache_path=None,
+        char_cache_size=100000,
+        char_cache_prewarm=False,
+        bundle_path=None,
+    ):
+        """
+
+        :param experiment_id:
+        :param run_id: MLFLOW Run Id
+        :param restrict_if_no_begining: defaults to True
+        :param bio_constraints: Decode valid BIO spans only, defaults to True
+        :param n_best: defaults to 1
+        :param pos_cache_path: SQLite POS tag cache, defaults to None
+        :param char_cache_size: defaults to 100000
+        :param char_cache_prewarm: Fill the char cache with the training words as is, defaults to False
+        :param bundle_path: Model bundle to load instead of the run, see model_bundle.py. Defaults to None
+        """
+        self.restrict_if_no_begining = restrict_if_no_begining
+        self.n_best = n_best
+        if bundle_path:
+            self._load_bundle(bundle_path)
+        else:
+            self._load_run(experiment_id, run_id)
+        self.model.eval()
+
+        self.char_cache = attach_char_cache(
+            self.model,
+            char_cache_size,
+            prewarm_words=self.char_words.vocab if char_cache_prewarm else None,
+            x_char_encoder=self.x_char_encoder,
+            max_word_length=self.max_word_length,
+        )
+        if bio_constraints:
+            attach_transition_constraints(self.model, self.y_ner_encoder)
+        self.span_extractor = SpanExtractor(self.y_ner_encoder.index_to_token)
+        self.featurizer = InferenceFeaturizer(
+            self.x_encoder,
+            self.x_char_encoder,
+            self.tag_to_index,
+            self.token_feature_spec,
+            self.max_sentence_len,
+            self.max_word_length,
+        )
+        self.pos_cache = POSTagCache(pos_cache_path) if pos_cache_path else None
+        self.lock = threading.Lock()
+
+    def _load_run(self, experiment_id, run_id):
+        params_location, files_location, model_location = run_paths(experiment_id, run_id)
+
+        with open(os.path.join(params_location, 'MAX_SENTENCE_LEN'), 'r') as infile:
+            self.max_sentence_len = ast.literal_eval(infile.read())
+
+        with open(os.path.join(params_location, 'MAX_WORD_LENGTH'), 'r') as infile:
+            self.max_word_length = ast.literal_eval(infile.read())
+
+        self.model = mlflow.pytorch.load_model(model_location).to(device)
+
+        # Migrated from the dill artifacts for runs saved before vocabularies
+        vocabularies, self.tag_to_index = load_run_vocabularies(files_location)
+        self.x_encoder = vocabularies["x_encoder"]
+        self.x_char_encoder = vocabularies["x_char_encoder"]
+        self.y_ner_encoder = vocabularies["y_ner_encoder"]
+        # Runs saved before char_words only have the lowercased training words
+        self.char_words = vocabularies.get(CHAR_WORDS, self.x_encoder)
+
+        self.token_feature_spec = TokenFeatureSpec.load(files_location)
+
+    def _load_bundle(self, bundle_path):
+        bundle = ModelBundle(bundle_path)
+        self.max_sentence_len = bundle.params["MAX_SENTENCE_LEN"]
+        self.max_word_length = bundle.params["MAX_WORD_LENGTH"]
+        self.model = bundle.model().to(device)
+        self.x_encoder = bundle.encoder("x_encoder")
+        self.x_char_encoder = bundle.encoder("x_char_encoder")
+        self.y_ner_encoder = bundle.encoder("y_ner_encoder")
+        self.char_words = bundle.char_words() or self.x_encoder
+        self.tag_to_index = bundle.tag_to_index()
+        self.token_feature_spec = bundle.token_feature_spec()
+
+    @staticmethod
+    def tokenize(text):
+        """
+        :param text: Raw text
+        :return: Words as is
+        """
+        return clean_text(text).split(' ')
+
+    def featurize(self, documents):
+        """
+        :param documents: Words of each document as is
+        :return: Words trimmed to max sentence length, dictionary of model inputs
+        """
+        return self.featurizer(documents, pos_cache=self.pos_cache)
+
+    def predict(self, documents):
+        """
+        :param documents: Raw text strings or lists of words
+        :return: list of dictionaries entity -> (value, confidence), one per document
+        """
+        documents = [
+            self.tokenize(document) if isinstance(document, str) else [str(word) for word in document]
+            for document in documents
+        ]
+        with self.lock:
+            return self.predict_features(*self.featurize(documents))
+
+    def predict_features(self, sentences, inputs):
+        """
+        Runs the model on documents featurized by featurize or InferenceFeaturizer
+        :param sentences: Words of each document trimmed to max sentence length
+        :param inputs: Dictionary of model inputs
+        :return: list of dictionaries entity -> (value, confidence), one per document
+        """
+        return predict(
+            self.model,
+            inputs["x_padded"],
+            inputs["x_postag_padded"],
+            inputs["x_char_padded"],
+            inputs["x_enriched_features"],
+            self.restrict_if_no_begining,
+            self.token_feature_spec,
+            self.n_best,
+            self.span_extractor,
+            sentences,
+            self.y_ner_encoder,
+        )
+
+    def stats(self):
+        """
+        :return: Dictionary of cache stats
+        """
+        return {
+            "char_cache": self.char_cache.stats() if self.char_cache is not None else None,
+            "pos_cache": self.pos_cache.stats() if self.pos_cache is not None else None,
+        }
+
+    def close(self):
+        if self.pos_cache is not None:
+            self.pos_cache.close()
+
+
+def add_engine_arguments(parser):
+    """
+    Run and decoding arguments shared by the inference scripts
+    :param parser: argparse.ArgumentParser
+    :return: parser
+    """
     parser.add_argument(
         "--experiment-id",
         dest="EXPERIMENT_ID",
@@ -90,6 +350,14 @@ if __name__ == "__main__":
         help="MLFLOW Run Id",
     )
 
+    parser.add_argument(
+        "--bundle",
+        dest="BUNDLE",
+        default=infer_config.get("BUNDLE_PATH", ""),
+        type=str,
+        help="Model bundle from model_bundle.py to load instead of the run",
+    )
+
     parser.add_argument(
         "--restrict-if-no-beg",
         dest="RESTRICT_IF_NO_BEG",
@@ -98,113 +366,57 @@ if __name__ == "__main__":
         help="Do not include prediction, if no beginning tag found",
     )
 
-    args = parser.parse_args()
-
-    experiment = mlflow.get_experiment(args.EXPERIMENT_ID)
-    artifacts_uri = experiment.artifact_location
-    artifcats_location = f"{artifacts_uri}/{args.RUN_ID}/artifacts/files"
-    model_location = f"{artifacts_uri}/{args.RUN_ID}/artifacts/model"
-    params_location = f"{artifacts_uri.replace('file:///', '')}/{args.RUN_ID}/params"
-
-    with open(os.path.join(params_location, 'MAX_SENTENCE_LEN'), 'r') as infile:
-        max_sentence_len = ast.literal_eval(infile.read())
-
-    with open(os.path.join(params_location, 'MAX_WORD_LENGTH'), 'r') as infile:
-        max_word_length = ast.literal_eval(infile.read())
-
-    with open(os.path.join(params_location, 'TEST_INDEX'), 'r') as infile:
-        TEST_INDEX = ast.literal_eval(infile.read())
-
-    model = mlflow.pytorch.load_model(model_location).to(device)
-
-    with open(f"mlruns/{args.EXPERIMENT_ID}/{args.RUN_ID}/artifacts/files/x_encoder", "rb") as infile:
-        x_encoder = dill.load(infile)
-
-    with open(f"mlruns/{args.EXPERIMENT_ID}/{args.RUN_ID}/artifacts/files/x_char_encoder", "rb") as infile:
-        x_char_encoder = dill.load(infile)
-
-    with open(f"mlruns/{args.EXPERIMENT_ID}/{args.RUN_ID}/artifacts/files/y_ner_encoder", "rb") as infile:
-        y_ner_encoder = dill.load(infile)
-
-    with open(f"mlruns/{args.EXPERIMENT_ID}/{args.RUN_ID}/artifacts/files/tag_to_index", "rb") as infile:
-        tag_to_index = dill.load(infile)
-
-    X_text = clean_text(args.DATA_TEXT)
-    X_text_list_as_is = [X_text.split(' ')]
-    X_text_list = [[word.lower() for word in lst] for lst in X_text_list_as_is]
-
-    X_tags, tag_to_index_infer = get_POS_tags(X_text_list)
-    X_text_list = trim_list_of_lists_upto_max_len(X_text_list, max_sentence_len)
-    X_text_list_as_is = trim_list_of_lists_upto_max_len(X_text_list_as_is, max_sentence_len)
-    X_tags = trim_list_of_lists_upto_max_len(X_tags, max_sentence_len)
-
-    alnum, numeric, alpha, digit, lower, title, ascii = enrich_data(X_text_list_as_is)
-
-    alnum = pad_and_stack_list_of_list(
-        alnum,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    numeric = pad_and_stack_list_of_list(
-        numeric,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    alpha = pad_and_stack_list_of_list(
-        alpha,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    digit = pad_and_stack_list_of_list(
-        digit,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    lower = pad_and_stack_list_of_list(
-        lower,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    title = pad_and_stack_list_of_list(
-        title,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
-    )
-    ascii = pad_and_stack_list_of_list(
-        ascii,
-        max_sentence_len=max_sentence_len,
-        pad_value=-1,
-        tensor_type=torch.FloatTensor,
+    parser.add_argument(
+        "--no-bio-constraints",
+        dest="BIO_CONSTRAINTS",
+        default=ast.literal_eval(str(infer_config.get("BIO_CONSTRAINTS", True))),
+        action='store_false',
+        help="Decode without restricting the CRF to valid BIO spans",
     )
 
-    x_enriched_features = torch.stack(
-        (alnum, numeric, alpha, digit, lower, title, ascii), dim=2
+    parser.add_argument(
+        "--n-best",
+        dest="N_BEST",
+        default=infer_config.get("N_BEST", 1),
+        type=int,
+        help="Score entities by the agreement of the n best CRF paths, 1 for CRF marginals",
+    )
+    return parser
+
+
+def engine_from_args(args):
+    """
+    :param args: Parsed add_engine_arguments arguments
+    :return: InferenceEngine
+    """
+    return InferenceEngine(
+        args.EXPERIMENT_ID,
+        args.RUN_ID,
+        restrict_if_no_begining=args.RESTRICT_IF_NO_BEG,
+        bio_constraints=args.BIO_CONSTRAINTS,
+        n_best=args.N_BEST,
+        pos_cache_path=infer_config.get("POS_CACHE_PATH"),
+        char_cache_size=infer_config.get("CHAR_CACHE_SIZE", 100000),
+        char_cache_prewarm=ast.literal_eval(str(infer_config.get("CHAR_CACHE_PREWARM", False))),
+        bundle_path=args.BUNDLE,
     )
-
-    x_encoded = [x_encoder.encode(text) for text in X_text_list]
-    x_padded = [pad_tensor(tensor, max_sentence_len) for tensor in x_encoded]
-    x_padded = torch.LongTensor(torch.stack(x_padded))
-
-    x_char_padded = [
-        [pad_tensor(x_char_encoder.encode(char[:max_word_length]), max_word_length) for char in word]
-        for word in X_text_list_as_is
-    ]
-    x_char_padded = [
-        pad_tensor(torch.stack(lst), max_sentence_len) for lst in x_char_padded
-    ]
-    x_char_padded = torch.stack(x_char_padded).type(torch.LongTensor)
 
 
-    x_postag_padded = tokenize_pos_tags(
-        X_tags, tag_to_index=tag_to_index, max_sen_len=max_sentence_len
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "--data-text",
+        dest="DATA_TEXT",
+        default=infer_config["DATA_TEXT"],
+        type=str,
+        help="Text",
     )
+    add_engine_arguments(parser)
+    args = parser.parse_args()
 
-    out_tuple = predict(model, x_padded, x_postag_padded, x_char_padded, x_enriched_features, args.RESTRICT_IF_NO_BEG)
+    engine = engine_from_args(args)
+    out_tuple = engine.predict([args.DATA_TEXT])
     print("\nOutput:")
     print(out_tuple[0])
+    print(f"Caches - {engine.stats()}")
+    engine.close()
@@ -0,0 +1,154 @@
+"""
+Local HTTP inference service, loads a run once and keeps it warm
+"""
+import json
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from inference import add_engine_arguments, engine_from_args, infer_config
+from micro_batching import ThreadedMicroBatcher
+
+
+def parse_documents(payload):
+    """
+    :param payload: {"text": str}, {"texts": [str, ...]} or {"documents": [[word, ...], ...]}
+    :return: list of raw texts or lists of words
+    """
+    if not isinstance(payload, dict):
+        raise ValueError("Expected a JSON object")
+    if "text" in payload:
+        documents = [payload["text"]]
+    elif "texts" in payload:
+        documents = payload["texts"]
+    elif "documents" in payload:
+        documents = payload["documents"]
+    else:
+        raise ValueError("Expected one of text, texts or documents")
+
+    if not isinstance(documents, list) or not all(
+        isinstance(document, str)
+        or (isinstance(document, list) and all(isinstance(word, str) for word in document))
+        for document in documents
+    ):
+        raise ValueError("Documents must be strings or lists of strings")
+    return documents
+
+
+class InferenceRequestHandler(BaseHTTPRequestHandler):
+    """
+    POST /predict returns {"entities": [{entity: [value, confidence]}, ...]}, one
+    dictionary per document, or {"error": ...} with status 400 for bad input and 500
+    if prediction fails. GET /health returns run, cache and batching stats
+    """
+    engine = None
+    batcher = None
+    run_id = None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        self._send_json(200, {
+            "status": "ok",
+            "run_id": self.run_id,
+            "caches": self.engine.stats(),
+            "batching": self.batcher.stats() if self.batcher is not None else None,
+        })
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            documents = parse_documents(json.loads(self.rfile.read(length) or b"null"))
+        except ValueError as error:
+            self._send_json(400, {"error": str(error)})
+            return
+
+        predictor = self.batcher if self.batcher is not None else self.engine
+        try:
+            entities = predictor.predict(documents) if documents else []
+        except Exception as error:
+            self._send_json(500, {"error": f"{type(error).__name__}: {error}"})
+            return
+        self._send_json(200, {"entities": entities})
+
+    def log_message(self, format, *args):
+        # Quiet per request logging
+        pass
+
+
+def build_server(engine, host="127.0.0.1", port=8125, run_id=None, batcher=None):
+    """
+    :param engine: InferenceEngine
+    :param host: defaults to 127.0.0.1
+    :param port: 0 for any free port, defaults to 8125
+    :param run_id: Reported on /health, defaults to None
+    :param batcher: ThreadedMicroBatcher over engine.predict that concurrent requests
+                    are batched with, defaults to None i.e. one forward pass per request
+    :return: ThreadingHTTPServer, call serve_forever to start
+    """
+    handler = type(
+        "BoundInferenceRequestHandler",
+        (InferenceRequestHandler,),
+        {"engine": engine, "batcher": batcher, "run_id": run_id},
+    )
+    return ThreadingHTTPServer((host, port), handler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    add_engine_arguments(parser)
+    parser.add_argument(
+        "--host",
+        dest="HOST",
+        default=infer_config.get("SERVER_HOST", "127.0.0.1"),
+        type=str,
+        help="Address to listen on",
+    )
+    parser.add_argument(
+        "--port",
+        dest="PORT",
+        default=infer_config.get("SERVER_PORT", 8125),
+        type=int,
+        help="Port to listen on",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        dest="MAX_BATCH_SIZE",
+        default=infer_config.get("MAX_BATCH_SIZE", 32),
+        type=int,
+        help="Most documents of concurrent requests run in one forward pass, 1 to disable batching",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        dest="MAX_WAIT_MS",
+        default=infer_config.get("MAX_WAIT_MS", 5),
+        type=float,
+        help="Milliseconds a request waits for a batch to fill",
+    )
+    args = parser.parse_args()
+
+    engine = engine_from_args(args)
+    batcher = ThreadedMicroBatcher(
+        engine.predict, args.MAX_BATCH_SIZE, args.MAX_WAIT_MS / 1000
+    ) if args.MAX_BATCH_SIZE > 1 else None
+    server = build_server(engine, args.HOST, args.PORT, run_id=args.RUN_ID, batcher=batcher)
+    print(f"Serving run {args.RUN_ID} at http://{args.HOST}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if batcher is not None:
+            batcher.close()
+        engine.close()
@@ -0,0 +1,184 @@
+"""
+Adaptive micro-batching of concurrent inference requests
+"""
+import asyncio
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+class MicroBatcher:
+    """
+    asyncio request queue in front of a batch predict function. Requests are
+    collected until max_batch_size documents are waiting or max_wait has passed
+    since the first one, then run as one padded batch and the results split back
+    to each caller. While a batch runs new requests queue up, so batches grow with load
+    """
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.005, executor=None):
+        """
+
+        :param predict_fn: Takes a list of documents, returns one result per document,
+                           e.g. InferenceEngine.predict
+        :param max_batch_size: defaults to 32
+        :param max_wait: Seconds to wait for a batch to fill, defaults to 0.005
+        :param executor: Executor predict_fn runs on, defaults to a single thread
+        """
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.executor = executor if executor is not None else ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.worker = None
+        self.batch_sizes = Counter()
+        self.queue_depths = Counter()
+
+    async def start(self):
+        """
+        Starts the batching loop on the running event loop
+        """
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self._run())
+
+    async def predict(self, document):
+        """
+        :param document: One document as accepted by predict_fn
+        :return: Its result
+        """
+        if self.worker is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        depth = self.queue.qsize()
+        self.queue_depths[1 << (depth.bit_length() - 1) if depth else 0] += 1
+        self.queue.put_nowait((document, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        # A pending get is kept across waits, cancelling it could drop a request
+        getter = None
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(self.queue.get())
+            item = await getter
+            getter = None
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                if not self.queue.empty():
+                    item = self.queue.get_nowait()
+                else:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    getter = asyncio.ensure_future(self.queue.get())
+                    done, _ = await asyncio.wait({getter}, timeout=timeout)
+                    if not done:
+                        break
+                    item = getter.result()
+                    getter = None
+                if item is None:
+                    self.queue.put_nowait(None)
+                    break
+                batch.append(item)
+
+            self.batch_sizes[len(batch)] += 1
+            documents = [document for document, _ in batch]
+            try:
+                results = await loop.run_in_executor(self.executor, self.predict_fn, documents)
+            except Exception as error:
+                if len(batch) == 1:
+                    _, future = batch[0]
+                    if not future.done():
+                        future.set_exception(error)
+                else:
+                    # One bad document must not fail the others, retry them one by one
+                    await self._run_one_by_one(loop, batch)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _run_one_by_one(self, loop, batch):
+        """
+        Runs each request of a failed batch alone so only the failing ones get the error
+        :param loop: Running event loop
+        :param batch: list of (document, future)
+        """
+        for document, future in batch:
+            try:
+                result, = await loop.run_in_executor(self.executor, self.predict_fn, [document])
+            except Exception as error:
+                if not future.done():
+                    future.set_exception(error)
+                continue
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self):
+        """
+        :return: Dictionary of request and batch counts, batch size histogram and histogram
+                 of queue depth seen by arriving requests in power of two buckets keyed
+                 by their lower bound
+        """
+        return {
+            "requests": sum(size * count for size, count in self.batch_sizes.items()),
+            "batches": sum(self.batch_sizes.values()),
+            "batch_size": dict(sorted(self.batch_sizes.items())),
+            "queue_depth": dict(sorted(self.queue_depths.items())),
+        }
+
+    async def close(self):
+        """
+        Finishes queued requests and stops the batching loop
+        """
+        if self.worker is not None:
+            self.queue.put_nowait(None)
+            await self.worker
+            self.worker = None
+        self.executor.shutdown(wait=True)
+
+
+class ThreadedMicroBatcher:
+    """
+    MicroBatcher on an event loop of its own thread, for callers that are not
+    async such as the threads of inference_server. Same predict and stats as
+    InferenceEngine
+    """
+    def __init__(self, predict_fn, max_batch_size=32, max_wait=0.005):
+        """
+
+        :param predict_fn: Takes a list of documents, returns one result per document
+        :param max_batch_size: defaults to 32
+        :param max_wait: Seconds to wait for a batch to fill, defaults to 0.005
+        """
+        self.batcher = MicroBatcher(predict_fn, max_batch_size, max_wait)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(self.batcher.start(), self.loop).result()
+
+    def predict(self, documents):
+        """
+        Each document is queued as its own request
+        :param documents: list of documents
+        :return: list of results, one per document
+        """
+        async def gather():
+            return await asyncio.gather(*(self.batcher.predict(document) for document in documents))
+
+        return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
+
+    def stats(self):
+        async def stats():
+            return self.batcher.stats()
+
+        return asyncio.run_coroutine_threadsafe(stats(), self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.batcher.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
@@ -0,0 +1,325 @@
+"""
+Single file model bundle: weights, vocabularies, label maps, feature spec and
+hyperparameters of a run, loaded without unpickling
+"""
+import argparse
+import ast
+import json
+import os
+import struct
+import numpy as np
+import torch
+from torch import nn
+from vocabulary import CHAR_WORDS, ENCODER_KINDS, Vocabulary, load_run_vocabularies
+
+BUNDLE_MAGIC = b"NERBUNDL"
+BUNDLE_VERSION = 2
+# Tensors start at multiples of this, so each memory-maps to an aligned array
+BUNDLE_ALIGNMENT = 64
+BUNDLE_DTYPES = {
+    "float16": torch.float16,
+    "float32": torch.float32,
+    "float64": torch.float64,
+    "int32": torch.int32,
+    "int64": torch.int64,
+    "uint8": torch.uint8,
+    "bool": torch.bool,
+}
+_TORCH_TO_BUNDLE_DTYPE = {dtype: name for name, dtype in BUNDLE_DTYPES.items()}
+ENCODER_NAMES = ("x_encoder", "x_char_encoder", "y_ner_encoder")
+# Unsigned vocabulary arrays are stored as the signed type of the same width
+_VOCABULARY_VIEWS = {"code_points": (np.int32, np.uint32), "hashes": (np.int64, np.uint64)}
+
+
+def model_hyperparameters(model):
+    """
+    EntityExtraction constructor arguments of a model, read from its attributes and
+    layers so models pickled before they were recorded can be exported
+    :param model: EntityExtraction
+    :return: dictionary of JSON serializable keyword arguments
+    """
+    token_feature_dims = getattr(model, "token_feature_dims", None)
+    # Models without a pos tag embedding take one hot pos tags, num_pos_tags None rebuilds them so
+    pos_embed = getattr(model, "pos_embed", None)
+    return {
+        "num_classes": model.num_classes,
+        "rnn_hidden_size": model.rnn_hidden_size,
+        "rnn_stack_size": model.rnn_stack_size,
+        "rnn_bidirectional": model.rnn_bidirectional,
+        "word_embed_dim": model.word_embed.embedding_dim,
+        "tag_embed_dim": model.tag_embed_dim,
+        "num_pos_tags": pos_embed.num_embeddings if pos_embed is not None else None,
+        "char_embed_dim": model.char_embed_dim,
+        "rnn_type": "GRU" if isinstance(model.lstm_ner, nn.GRU) else "LSTM",
+        "rnn_embed_dim": model.rnn_embed_dim,
+        "enrich_dim": model.enrich_dim,
+        "token_feature_dims": list(token_feature_dims) if token_feature_dims is not None else None,
+        "char_cnn_out_dim": model.char_cnn_out_dim,
+        "dropout_ratio": model.dropout_ratio,
+        "pack_sequences": getattr(model, "pack_sequences", False),
+        "char_dedup": getattr(model, "char_dedup", False),
+        "word_vocab_size": model.word_embed.num_embeddings,
+        "char_vocab_size": model.char_embed.num_embeddings,
+    }
+
+
+def _string_table(strings):
+    """
+    :param strings: list of str
+    :return: int64 end offsets, uint8 utf-8 bytes
+    """
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = np.cumsum([len(data) for data in encoded], dtype=np.int64)
+    data = np.frombuffer(b"".join(encoded) or b"\0", dtype=np.uint8).copy()
+    return torch.from_numpy(offsets), torch.from_numpy(data)
+
+
+def _read_string_table(offsets, data):
+    data = data.numpy().tobytes()
+    ends = offsets.tolist()
+    starts = [0] + ends[:-1]
+    if data.isascii():
+        # Byte offsets are character offsets, decode once
+        data = data.decode("ascii")
+        return [data[start:end] for start, end in zip(starts, ends)]
+    return [data[start:end].decode("utf-8") for start, end in zip(starts, ends)]
+
+
+def export_bundle(
+    path, model, x_encoder, x_char_encoder, y_ner_encoder, tag_to_index, token_feature_spec, params, source=None,
+    char_words=None,
+):
+    """
+    Writes a bundle: BUNDLE_MAGIC, little endian uint64 header length, JSON header,
+    then every tensor at a BUNDLE_ALIGNMENT aligned offset of the data section
+    :param path: Output file
+    :param model: EntityExtraction
+    :param x_encoder: Vocabulary or torchnlp encoder
+    :param x_char_encoder: Vocabulary or torchnlp encoder
+    :param y_ner_encoder: Vocabulary or torchnlp encoder
+    :param tag_to_index:
+    :param token_feature_spec: TokenFeatureSpec
+    :param params: Run params, MAX_SENTENCE_LEN and MAX_WORD_LENGTH are required
+    :param source: Where the bundle was exported from, e.g. experiment and run ids
+    :param char_words: Training words as is or Vocabulary of them, defaults to None i.e. not exported
+    :return: path
+    """
+    tensors = {f"model.{name}": tensor for name, tensor in model.state_dict().items()}
+    tensors["class_weights"] = model.class_weights
+    encoders = {}
+    vocabularies = dict(zip(ENCODER_NAMES, (x_encoder, x_char_encoder, y_ner_encoder)))
+    if char_words is not None:
+        vocabularies[CHAR_WORDS] = char_words if isinstance(char_words, Vocabulary) else Vocabulary.from_tokens(char_words)
+    for name, encoder in vocabularies.items():
+        if not isinstance(encoder, Vocabulary):
+            encoder = Vocabulary.from_encoder(encoder, ENCODER_KINDS[name])
+        for array_name, array in encoder.arrays().items():
+            if array_name in _VOCABULARY_VIEWS:
+                array = array.view(_VOCABULARY_VIEWS[array_name][0])
+            tensors[f"{name}.{array_name}"] = torch.from_numpy(np.ascontiguousarray(array))
+        encoders[name] = encoder.metadata()
+    tags = sorted(tag_to_index, key=tag_to_index.get)
+    tensors["tag_to_index.offsets"], tensors["tag_to_index.data"] = _string_table(tags)
+    tensors["tag_to_index.index"] = torch.LongTensor([tag_to_index[tag] for tag in tags])
+    if params.get("TEST_INDEX") is not None:
+        tensors["params.TEST_INDEX"] = torch.LongTensor(list(params["TEST_INDEX"]))
+
+    entries = {}
+    offset = 0
+    for name, tensor in tensors.items():
+        tensor = tensor.detach().to("cpu").contiguous()
+        tensors[name] = tensor
+        nbytes = tensor.numel() * tensor.element_size()
+        entries[name] = {
+            "dtype": _TORCH_TO_BUNDLE_DTYPE[tensor.dtype], "shape": list(tensor.shape), "offset": offset,
+            "nbytes": nbytes,
+        }
+        offset += -(-nbytes // BUNDLE_ALIGNMENT) * BUNDLE_ALIGNMENT
+
+    header = json.dumps({
+        "version": BUNDLE_VERSION,
+        "hyperparameters": model_hyperparameters(model),
+        "params": {key: params[key] for key in ("MAX_SENTENCE_LEN", "MAX_WORD_LENGTH")},
+        "encoders": encoders,
+        "feature_spec": token_feature_spec.to_dict(),
+        "source": source,
+        "tensors": entries,
+    }).encode("utf-8")
+    # Pad the header so the data section starts aligned
+    header += b" " * (-(len(BUNDLE_MAGIC) + 8 + len(header)) % BUNDLE_ALIGNMENT)
+
+    with open(path, "wb") as outfile:
+        outfile.write(BUNDLE_MAGIC)
+        outfile.write(struct.pack("<Q", len(header)))
+        outfile.write(header)
+        for name, tensor in tensors.items():
+            data = (tensor.to(torch.uint8) if tensor.dtype == torch.bool else tensor).numpy().tobytes()
+            outfile.write(data)
+            outfile.write(b"\0" * (-len(data) % BUNDLE_ALIGNMENT))
+    return path
+
+
+def read_bundle_header(path):
+    """
+    :param path: Bundle file
+    :return: header dictionary, byte offset of the data section
+    """
+    with open(path, "rb") as infile:
+        magic = infile.read(len(BUNDLE_MAGIC))
+        if magic != BUNDLE_MAGIC:
+            raise ValueError(f"{path} is not a model bundle")
+        (header_len,) = struct.unpack("<Q", infile.read(8))
+        header = json.loads(infile.read(header_len))
+    if header["version"] > BUNDLE_VERSION:
+        raise ValueError(f"Bundle version {header['version']} is newer than supported version {BUNDLE_VERSION}")
+    return header, len(BUNDLE_MAGIC) + 8 + header_len
+
+
+class ModelBundle:
+    """
+    Memory-mapped bundle. Tensors are views of the mapped file, read from disk as
+    they are used, and everything else comes from the JSON header
+    """
+    def __init__(self, path):
+        """
+
+        :param path: Bundle file written by export_bundle
+        """
+        self.path = path
+        self.header, data_offset = read_bundle_header(path)
+        # Copy on write, so tensors are writable without touching the file
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="c", offset=data_offset)
+        self.hyperparameters = self.header["hyperparameters"]
+        self.params = self.header["params"]
+
+    def tensor(self, name):
+        """
+        :param name: Tensor name
+        :return: Tensor backed by the memory map
+        """
+        entry = self.header["tensors"][name]
+        dtype = BUNDLE_DTYPES[entry["dtype"]]
+        data = self.buffer[entry["offset"]: entry["offset"] + entry["nbytes"]]
+        if dtype == torch.bool:
+            return torch.from_numpy(data).view(entry["shape"]).bool()
+        return torch.from_numpy(data).view(dtype).view(entry["shape"])
+
+    def tensors(self, prefix):
+        """
+        :param prefix: e.g. model.
+        :return: dictionary of name without prefix -> tensor
+        """
+        return {
+            name[len(prefix):]: self.tensor(name) for name in self.header["tensors"] if name.startswith(prefix)
+        }
+
+    def encoder(self, name):
+        """
+        :param name: One of ENCODER_NAMES, or CHAR_WORDS
+        :return: Vocabulary over the memory-mapped arrays, nothing is rebuilt
+        """
+        settings = self.header["encoders"][name]
+        if self.header["version"] < 2:
+            # Version 1 bundles hold the tokens as a UTF-8 string table
+            tokens = _read_string_table(self.tensor(f"{name}.offsets"), self.tensor(f"{name}.data"))
+            return Vocabulary.from_tokens(tokens, settings["kind"], settings["unknown_index"])
+        arrays = {}
+        for array_name in ("code_points", "offsets", "ids", "hashes", "slots"):
+            array = self.tensor(f"{name}.{array_name}").numpy()
+            if array_name in _VOCABULARY_VIEWS:
+                array = array.view(_VOCABULARY_VIEWS[array_name][1])
+            arrays[array_name] = array
+        return Vocabulary.from_arrays(arrays, settings)
+
+    def char_words(self):
+        """
+        :return: Vocabulary of the training words as is, None if not exported
+        """
+        if CHAR_WORDS not in self.header["encoders"]:
+            return None
+        return self.encoder(CHAR_WORDS)
+
+    def tag_to_index(self):
+        tags = _read_string_table(self.tensor("tag_to_index.offsets"), self.tensor("tag_to_index.data"))
+        return dict(zip(tags, self.tensor("tag_to_index.index").tolist()))
+
+    def test_index(self):
+        """
+        :return: list of test document indices, None if not exported
+        """
+        if "params.TEST_INDEX" not in self.header["tensors"]:
+            return None
+        return self.tensor("params.TEST_INDEX").tolist()
+
+    def token_feature_spec(self):
+        from token_features import TokenFeatureSpec
+        return TokenFeatureSpec(self.header["feature_spec"]["names"])
+
+    def model(self):
+        """
+        EntityExtraction built from the hyperparameters, its parameters and buffers
+        set to the memory-mapped tensors without copying
+        :return: EntityExtraction in eval mode
+        """
+        from train_cnn_rnn_crf import EntityExtraction
+        hyperparameters = dict(self.hyperparameters)
+        if hyperparameters["token_feature_dims"] is not None:
+            hyperparameters["token_feature_dims"] = tuple(hyperparameters["token_feature_dims"])
+        state = self.tensors("model.")
+        # The word embedding is the bulk of the weights, passing it skips its random init
+        model = EntityExtraction(
+            class_weights=self.tensor("class_weights"),
+            word_embedding_weights=state["word_embed.weight"],
+            **hyperparameters
+        )
+        expected = set(model.state_dict())
+        if expected != set(state):
+            raise ValueError(f"Bundle does not match EntityExtraction, differing tensors {expected ^ set(state)}")
+        for name, tensor in list(model.named_parameters()) + list(model.named_buffers()):
+            tensor.data = state[name]
+        return model.eval()
+
+
+def export_run_bundle(experiment_id, run_id, path):
+    """
+    Exports a run of the mlflow tracking store, unpickling its model one last time.
+    Encoders of runs saved before vocabularies are migrated from dill
+    :param experiment_id:
+    :param run_id:
+    :param path: Output file
+    :return: path
+    """
+    import mlflow.pytorch
+    from inference import run_paths
+    from token_features import TokenFeatureSpec
+
+    params_location, files_location, model_location = run_paths(experiment_id, run_id)
+    params = {}
+    for name in ("MAX_SENTENCE_LEN", "MAX_WORD_LENGTH", "TEST_INDEX"):
+        if os.path.isfile(os.path.join(params_location, name)):
+            with open(os.path.join(params_location, name), "r") as infile:
+                params[name] = ast.literal_eval(infile.read())
+
+    objects, objects["tag_to_index"] = load_run_vocabularies(files_location)
+    model = mlflow.pytorch.load_model(model_location, map_location="cpu")
+    return export_bundle(
+        path,
+        model,
+        token_feature_spec=TokenFeatureSpec.load(files_location),
+        params=params,
+        source={"experiment_id": str(experiment_id), "run_id": str(run_id)},
+        **objects,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "--experiment-id", dest="EXPERIMENT_ID", required=True, type=str, help="Id of the experiment"
+    )
+    parser.add_argument("--run-id", dest="RUN_ID", required=True, type=str, help="MLFLOW Run Id")
+    parser.add_argument("--output", dest="OUTPUT", required=True, type=str, help="Bundle file to write")
+    args = parser.parse_args()
+
+    export_run_bundle(args.EXPERIMENT_ID, args.RUN_ID, args.OUTPUT)
+    print(f"Bundle written to {args.OUTPUT} ({os.path.getsize(args.OUTPUT) / 2 ** 20:.1f} MB)")
@@ -0,0 +1,205 @@
+"""
+POS tagging engine
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import threading
+from functools import lru_cache
+import nltk
+
+
+def prepare_tokens(document):
+    """
+    Replaces blank words the same way as nltk tagging inputs always did
+    :param document: list of words
+    :return: list of words
+    """
+    return [word if word.strip() != "" else "<OOS>" for word in document]
+
+
+class POSTagger:
+    """
+    Wraps a single NLTK perceptron tagger. nltk.pos_tag builds a new tagger on every
+    call, this loads it once and tags many documents per call
+    """
+    def __init__(self, tagger=None):
+        """
+
+        :param tagger: NLTK tagger, defaults to nltk PerceptronTagger
+        """
+        self.tagger = tagger if tagger is not None else nltk.tag.PerceptronTagger()
+
+    @property
+    def tags(self):
+        """
+        :return: All tags the tagger can emit
+        """
+        return sorted(self.tagger.classes)
+
+    def tag_sents(self, documents):
+        """
+        Tags a batch of documents
+        :param documents: list of list of words
+        :return: list of list of tags
+        """
+        return [
+            [tag for _, tag in tagged]
+            for tagged in self.tagger.tag_sents([prepare_tokens(doc) for doc in documents])
+        ]
+
+    def tag_documents(self, documents, batch_size=256, cache=None):
+        """
+        Tags documents in batches
+        :param documents: list of list of words
+        :param batch_size: Documents per batch, defaults to 256
+        :param cache: POSTagCache, only documents missing from it are tagged. Defaults to None
+        :return: list of list of tags
+        """
+        documents = [list(doc) for doc in documents]
+        if cache is not None:
+            keys = [cache.key(doc) for doc in documents]
+            cached = cache.get_many(keys)
+            missing = [ind for ind, key in enumerate(keys) if key not in cached]
+            tagged = self.tag_documents([documents[ind] for ind in missing], batch_size=batch_size)
+            cache.put_many([(keys[ind], tags) for ind, tags in zip(missing, tagged)])
+            tagged = dict(zip(missing, tagged))
+            return [tagged[ind] if ind in tagged else cached[key] for ind, key in enumerate(keys)]
+
+        return [
+            tags
+            for i in range(0, len(documents), batch_size)
+            for tags in self.tag_sents(documents[i: i + batch_size])
+        ]
+
+
+class POSTagCache:
+    """
+    Persistent POS tag cache in SQLite keyed by a hash of the token sequence, least
+    recently used documents are evicted beyond max_entries. Safe to share between
+    threads, e.g. those of inference_server
+    """
+    def __init__(self, path, max_entries=200000, namespace=f"nltk-{nltk.__version__}"):
+        """
+
+        :param path: SQLite database file path
+        :param max_entries: Documents to keep, defaults to 200000
+        :param namespace: Tagger identity, part of every key. Defaults to nltk version
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.namespace = namespace
+        self.hits = 0
+        self.misses = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # One connection for all threads, every use of it holds the lock
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS pos_tags "
+            "(key BLOB PRIMARY KEY, tags TEXT NOT NULL, last_used INTEGER NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS pos_tags_last_used ON pos_tags (last_used)"
+        )
+        self.connection.commit()
+        self._clock = self.connection.execute(
+            "SELECT COALESCE(MAX(last_used), 0) FROM pos_tags"
+        ).fetchone()[0]
+
+    def key(self, tokens):
+        """
+        :param tokens: list of words
+        :return: Cache key bytes
+        """
+        return hashlib.sha1(
+            json.dumps([self.namespace, list(tokens)], ensure_ascii=False).encode("utf-8")
+        ).digest()
+
+    def _tick(self):
+        self._clock += 1
+        return self._clock
+
+    def get_many(self, keys, chunk_size=500):
+        """
+        Looks up keys and marks found entries as recently used
+        :param keys: list of keys
+        :param chunk_size: keys per query, defaults to 500
+        :return: Dictionary of key to tags for found keys
+        """
+        found = dict()
+        unique_keys = list(dict.fromkeys(keys))
+        with self.lock:
+            for i in range(0, len(unique_keys), chunk_size):
+                chunk = unique_keys[i: i + chunk_size]
+                rows = self.connection.execute(
+                    f"SELECT key, tags FROM pos_tags WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update({bytes(key): tags.split(" ") if tags else [] for key, tags in rows})
+
+            now = self._tick()
+            self.connection.executemany(
+                "UPDATE pos_tags SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found.keys()],
+            )
+            self.connection.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        """
+        Stores tags and evicts least recently used entries beyond max_entries
+        :param items: list of (key, tags)
+        :return:
+        """
+        if len(items) == 0:
+            return
+        with self.lock:
+            now = self._tick()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO pos_tags (key, tags, last_used) VALUES (?, ?, ?)",
+                [(key, " ".join(tags), now) for key, tags in items],
+            )
+            overflow = len(self) - self.max_entries
+            if overflow > 0:
+                self.connection.execute(
+                    "DELETE FROM pos_tags WHERE key IN "
+                    "(SELECT key FROM pos_tags ORDER BY last_used LIMIT ?)",
+                    (overflow,),
+                )
+            self.connection.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM pos_tags").fetchone()[0]
+
+    def stats(self):
+        """
+        :return: Dictionary of hits, misses, hit_rate and entries
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self),
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+@lru_cache(maxsize=None)
+def default_tagger():
+    """
+    Process wide tagger, loaded on first use
+    :return: POSTagger
+    """
+    return POSTagger()
@@ -6,6 +6,7 @@ import argparse
 import pickle
 import json
 from utils import clean_text, read_json_data
+from columnar_dataset import write_columnar_dataset
 
 class CleanPrepareDataset:
 
@@ -36,6 +37,17 @@ class CleanPrepareDataset:
         with open(os.path.join(save_dir_path, filename), "wb") as out_file:
             pickle.dump(self.trianable_dataset, out_file, protocol=pickle_protocol)
 
+    def save_columnar(self, dirname:str="data_ready_columnar", save_dir_path:str=None):
+        """
+        Saves dataset in memory-mapped columnar format
+        :param dirname: Name of directory to be created
+        :param save_dir_path: Parent directory, defaults to dir_path
+        :return: Columnar dataset directory path
+        """
+        if not save_dir_path:
+            save_dir_path = self.dir_path
+
+        return write_columnar_dataset(self.trianable_dataset, os.path.join(save_dir_path, dirname))
 
     def get_file_list(self):
         """
@@ -197,8 +209,20 @@ if __name__ == "__main__":
         help="Pickle Protocol",
     )
 
+    parser.add_argument(
+        "--columnar",
+        dest="COLUMNAR",
+        action="store_true",
+        help="Also save dataset in memory-mapped columnar format",
+    )
+
     args = parser.parse_args()
 
     cpd = CleanPrepareDataset(dir_path=args.DATA_PATH, file_extension=args.FILE_EXTENSION)
     dataset = cpd.prepare_ner_dataset()
     cpd.save(filename=args.filename, save_dir_path=args.SAVE_DIR_PATH)
+    if args.COLUMNAR:
+        cpd.save_columnar(
+            dirname=f"{os.path.splitext(args.filename)[0]}_columnar",
+            save_dir_path=args.SAVE_DIR_PATH,
+        )
@@ -0,0 +1,98 @@
+"""
+Entity span extraction from decoded tag tensors
+"""
+from collections import namedtuple
+import torch
+from crf_decoding import parse_bio_label
+
+# One entry per span, tensors of equal length
+Spans = namedtuple("Spans", ["doc", "start", "end", "entity", "score"])
+
+
+class SpanExtractor:
+    """
+    Finds <entity>-B / <entity>-I spans over a whole batch of integer tags. Labels are
+    parsed once into tag -> (entity id, is begin) tables, span boundaries come from
+    comparing every tag with the previous one and span scores from a segment sum
+    """
+    def __init__(self, labels):
+        """
+
+        :param labels: Tag index to label, e.g. y_ner_encoder.index_to_token
+        """
+        self.entity_names = []
+        entity_ids = []
+        is_begin = []
+        for label in labels:
+            entity, suffix = parse_bio_label(label)
+            if entity is not None and entity not in self.entity_names:
+                self.entity_names.append(entity)
+            entity_ids.append(self.entity_names.index(entity) if entity is not None else -1)
+            is_begin.append(suffix == "B")
+        self.entity_ids = torch.LongTensor(entity_ids)
+        self.is_begin = torch.BoolTensor(is_begin)
+
+    def spans(self, tags, proba, mask=None, restrict_if_no_begining=True, add_factor=.5):
+        """
+        A span starts at <entity>-B, or at an <entity>-I that does not follow the same
+        entity, and runs over the following <entity>-I tags
+        :param tags: N, L LongTensor
+        :param proba: N, L confidence of each tag
+        :param mask: N, L, defaults to None
+        :param restrict_if_no_begining: Drop spans not starting with <entity>-B, defaults to True
+        :param add_factor: Added to the span length when averaging, defaults to .5
+        :return: Spans, in document then position order
+        """
+        tags = tags.to("cpu")
+        entity = self.entity_ids[tags]
+        is_begin = self.is_begin[tags]
+        if mask is not None:
+            entity = entity.masked_fill(~mask.to("cpu").bool(), -1)
+
+        in_span = entity >= 0
+        previous = torch.cat((entity.new_full((entity.size(0), 1), -1), entity[:, :-1]), dim=1)
+        starts = in_span & (is_begin | (previous != entity))
+
+        # Span index of every in span tag over the flattened batch
+        span_index = starts.flatten().long().cumsum(0) - 1
+        in_span = in_span.flatten()
+        num_spans = int(starts.sum())
+        lengths = torch.zeros(num_spans, dtype=torch.long).index_add_(
+            0, span_index[in_span], torch.ones(int(in_span.sum()), dtype=torch.long)
+        )
+        totals = torch.zeros(num_spans, dtype=torch.double).index_add_(
+            0, span_index[in_span], proba.to("cpu").flatten()[in_span].double()
+        )
+
+        doc, start = starts.nonzero(as_tuple=True)
+        keep = is_begin[doc, start] if restrict_if_no_begining else torch.ones(num_spans, dtype=torch.bool)
+        return Spans(
+            doc=doc[keep],
+            start=start[keep],
+            end=(start + lengths - 1)[keep],
+            entity=entity[doc, start][keep],
+            score=(totals / (lengths + add_factor))[keep],
+        )
+
+    def entities(self, tags, proba, sentences, mask=None, restrict_if_no_begining=True, add_factor=.5):
+        """
+        Entities of every document from the spans above. Unlike
+        utils.get_entities_values_joint_probas, which joins every run of non O tags into
+        one value, each <entity>-B and each <entity>-I after a different entity starts
+        a new value, so adjacent spans are not merged
+        :param tags: N, L LongTensor
+        :param proba: N, L confidence of each tag
+        :param sentences: Words of each document
+        :param mask: N, L, defaults to None
+        :param restrict_if_no_begining: defaults to True
+        :param add_factor: defaults to .5
+        :return: list of tuples of (entity, value, confidence), one per document
+        """
+        spans = self.spans(tags, proba, mask, restrict_if_no_begining, add_factor)
+        final_out_list = [[] for _ in range(len(sentences))]
+        for doc, start, end, entity, score in zip(*(values.tolist() for values in spans)):
+            if doc < len(sentences):
+                final_out_list[doc].append(
+                    (self.entity_names[entity], " ".join(sentences[doc][start: end + 1]), score)
+                )
+        return [tuple(entities) for entities in final_out_list]
@@ -0,0 +1,400 @@
+"""
+Streaming training data over sharded columnar datasets
+"""
+import os
+import zlib
+import random
+from collections import Counter
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
+from torchnlp.encoders import LabelEncoder
+from torchnlp.encoders.text import pad_tensor
+from torchnlp.encoders.text import StaticTokenizerEncoder, CharacterEncoder
+import dill
+import mlflow
+from batching import trim_collate
+from columnar_dataset import ColumnarDataset, list_columnar_shards
+from pos_tagging import default_tagger
+from token_features import TokenFeatureSpec
+from vocabulary import save_run_vocabularies
+from train_cnn_rnn_crf import (
+    build_char_matrix,
+    tokenize_pos_tags,
+)
+
+CHAR_PAD_TOKEN = "<end>"
+
+
+def test_document_mask(shard_path, num_documents, split_size=0.2, seed=0):
+    """
+    Deterministic test split for a shard, same documents are picked on every call
+    :param shard_path:
+    :param num_documents:
+    :param split_size: defaults to .2
+    :param seed: defaults to 0
+    :return: Boolean array, True for test documents
+    """
+    shard_hash = zlib.crc32(os.path.basename(os.path.normpath(shard_path)).encode("utf-8"))
+    rng = np.random.default_rng([seed, shard_hash])
+    return rng.random(num_documents) < split_size
+
+
+def load_test_documents(data_path, split_size=0.2, seed=0):
+    """
+    Test documents of a streaming run, rebuilt from the shards and split settings
+    the run logged as DATA_PATH, TEST_SPLIT and SPLIT_SEED
+    :param data_path: Columnar shards directory
+    :param split_size: defaults to .2
+    :param seed: defaults to 0
+    :return: X_list (as is), X_list (lower) and y_list of the test documents
+    """
+    X_text_list_as_is, X_text_list, y_ner_list = [], [], []
+    for shard_path in list_columnar_shards(data_path):
+        dataset = ColumnarDataset(shard_path)
+        words, lower, labels = dataset.words(), dataset.words(lower=True), dataset.ner_labels()
+        for ind in np.flatnonzero(test_document_mask(shard_path, len(dataset), split_size, seed)).tolist():
+            X_text_list_as_is.append(words[ind])
+            X_text_list.append(lower[ind])
+            y_ner_list.append(labels[ind])
+    return X_text_list_as_is, X_text_list, y_ner_list
+
+
+def _trimmed_token_index(offsets, documents, max_sentence_len):
+    """
+    Flat token positions of selected documents after trimming to max_sentence_len
+    :param offsets: Document offsets
+    :param documents: Document indices
+    :param max_sentence_len:
+    :return: Token position array
+    """
+    starts = np.asarray(offsets[:-1])[documents]
+    lengths = np.minimum(np.asarray(offsets[1:])[documents] - starts, max_sentence_len)
+    doc_starts_in_output = np.cumsum(lengths) - lengths
+    return np.repeat(starts - doc_starts_in_output, lengths) + np.arange(lengths.sum())
+
+
+def build_tag_to_index():
+    """
+    POS tag index from the full tag set of the NLTK tagger, so that tags do not
+    have to be collected from the whole corpus
+    :return: tag_to_index dictionary
+    """
+    all_tags = ["<pad>"] + default_tagger().tags + ["<UNK>"]
+    return {tag: i for i, tag in enumerate(all_tags)}
+
+
+def fit_streaming_encoders(shard_paths, max_sentence_len, split_size=0.2, seed=0):
+    """
+    Fits word, character and label encoders in a single pass over the shards using
+    only the flat id arrays, no document is featurized
+    :param shard_paths:
+    :param max_sentence_len:
+    :param split_size:
+    :param seed:
+    :return: x_encoder, x_char_encoder, y_ner_encoder, class_count_dict, max_word_length,
+             pad_count i.e. padded label positions of the training documents padded to the
+             longest one, char_words i.e. training words as is
+    """
+    train_words = dict()
+    char_words = dict()
+    label_counts = Counter()
+    num_train_documents = 0
+    num_train_tokens = 0
+    longest_train_document = 0
+
+    for shard_path in shard_paths:
+        dataset = ColumnarDataset(shard_path)
+        test_mask = test_document_mask(shard_path, len(dataset), split_size, seed)
+        train_documents = np.flatnonzero(~test_mask)
+        token_index = _trimmed_token_index(dataset.offsets, train_documents, max_sentence_len)
+
+        string_ids = np.unique(dataset.tokens[token_index])
+        for ind in np.unique(dataset.lower[string_ids]).tolist():
+            train_words.setdefault(dataset.strings[ind])
+        for ind in string_ids.tolist():
+            char_words.setdefault(dataset.strings[ind])
+
+        label_ids, counts = np.unique(dataset.labels[token_index], return_counts=True)
+        for label_id, count in zip(label_ids.tolist(), counts.tolist()):
+            label_counts[dataset.label_names[label_id]] += count
+
+        num_train_documents += len(train_documents)
+        num_train_tokens += len(token_index)
+        lengths = np.minimum(np.diff(np.asarray(dataset.offsets))[train_documents], max_sentence_len)
+        longest_train_document = max(longest_train_document, int(lengths.max(initial=0)))
+
+    x_encoder = StaticTokenizerEncoder(
+        sample=[list(train_words.keys())], append_eos=False, tokenize=lambda x: x,
+    )
+    x_char_encoder = CharacterEncoder(
+        sample=[" ".join(list(char_words.keys()) + [CHAR_PAD_TOKEN])], append_eos=False,
+    )
+    max_word_length = max([len(word) for word in char_words] + [len(CHAR_PAD_TOKEN)])
+
+    class_count_dict = dict(sorted(label_counts.items()))
+    y_ner_encoder = LabelEncoder(sample=class_count_dict.keys())
+    # The in memory label tensor is padded to the longest training document
+    pad_count = num_train_documents * longest_train_document - num_train_tokens
+    return x_encoder, x_char_encoder, y_ner_encoder, class_count_dict, max_word_length, pad_count, list(char_words)
+
+
+def calculate_streaming_sample_weights(class_count_dict, y_ner_encoder, pad_count):
+    """
+    Balanced class weights from label counts, same as calculate_sample_weights on
+    the label tensor of the training documents padded to the longest one
+    :param class_count_dict:
+    :param y_ner_encoder:
+    :param pad_count: Number of padded label positions, see fit_streaming_encoders
+    :return: array consisting of sample weight for each class
+    """
+    counts = {y_ner_encoder.token_to_index[label]: count for label, count in class_count_dict.items()}
+    if pad_count > 0:
+        counts[0] = pad_count
+    classes = sorted(counts.keys())
+    total = sum(counts.values())
+    return np.array([total / (len(classes) * counts[clas]) for clas in classes])
+
+
+class DocumentFeaturizer:
+    """
+    Featurizes one document into the same tensors the in memory training path builds
+    """
+    def __init__(
+        self,
+        x_encoder,
+        x_char_encoder,
+        y_ner_encoder,
+        tag_to_index,
+        max_sentence_len,
+        max_word_length,
+        token_feature_spec=None,
+    ):
+        self.x_encoder = x_encoder
+        self.x_char_encoder = x_char_encoder
+        self.y_ner_encoder = y_ner_encoder
+        self.tag_to_index = tag_to_index
+        self.max_sentence_len = max_sentence_len
+        self.max_word_length = max_word_length
+        self.token_feature_spec = (
+            token_feature_spec if token_feature_spec is not None else TokenFeatureSpec()
+        )
+
+    def __call__(self, words, labels):
+        """
+
+        :param words: Words as is
+        :param labels: NER labels
+        :return: Dictionary of feature tensors for a single document
+        """
+        words = list(words[: self.max_sentence_len])
+        labels = list(labels[: self.max_sentence_len])
+        lower_words = [word.lower() for word in words]
+
+        x_padded = pad_tensor(
+            torch.LongTensor(self.x_encoder.encode(lower_words)), self.max_sentence_len
+        )
+
+        x_char_padded, _ = build_char_matrix(
+            [words],
+            self.x_char_encoder,
+            self.max_sentence_len,
+            self.max_word_length,
+            pad_word=CHAR_PAD_TOKEN,
+        )
+        x_char_padded = x_char_padded[0]
+
+        postag = default_tagger().tag_sents([lower_words])[0]
+        tags = [self.tag_to_index.get(tag, self.tag_to_index["<UNK>"]) for tag in postag]
+        x_postag_padded = tokenize_pos_tags(
+            [tags], tag_to_index=self.tag_to_index, max_sen_len=self.max_sentence_len
+        )[0]
+
+        x_enriched_features = self.token_feature_spec.featurize(
+            [words], max_sentence_len=self.max_sentence_len
+        )[0]
+
+        y_ner_padded = pad_tensor(
+            torch.LongTensor([int(self.y_ner_encoder.encode(label)) for label in labels]),
+            self.max_sentence_len,
+        )
+
+        return {
+            "x_padded": x_padded,
+            "x_char_padded": x_char_padded,
+            "x_postag_padded": x_postag_padded,
+            "x_enriched_features": x_enriched_features,
+            "y_ner_padded": y_ner_padded,
+        }
+
+
+class StreamingNERDataset(IterableDataset):
+    """
+    Reads columnar shards lazily and featurizes documents on the fly. With DataLoader
+    workers shards are divided between workers, so featurization happens in the
+    worker processes and only one shard per worker is mapped at a time
+    """
+    def __init__(self, shard_paths, featurizer, split="train", split_size=0.2, seed=0, shuffle=True):
+        """
+
+        :param shard_paths: Columnar shard directories
+        :param featurizer: Callable taking words and labels of one document
+        :param split: train or test
+        :param split_size: Test split size, defaults to .2
+        :param seed: Split seed, defaults to 0
+        :param shuffle: Shuffle shards and documents within a shard, defaults to True
+        """
+        self.shard_paths = list(shard_paths)
+        self.featurizer = featurizer
+        self.split = split
+        self.split_size = split_size
+        self.seed = seed
+        self.shuffle = shuffle
+        self.num_documents = sum(
+            len(self._split_documents(shard_path, ColumnarDataset(shard_path)))
+            for shard_path in self.shard_paths
+        )
+
+    def _split_documents(self, shard_path, dataset):
+        test_mask = test_document_mask(shard_path, len(dataset), self.split_size, self.seed)
+        if self.split == "test":
+            return np.flatnonzero(test_mask)
+        return np.flatnonzero(~test_mask)
+
+    def __len__(self):
+        """
+        Documents of the split, exact for any number of workers. With num_workers > 1
+        every worker batches its own shards, so the DataLoader can yield up to
+        num_workers - 1 more, partial, batches than len(dataloader) reports
+        :return:
+        """
+        return self.num_documents
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            shard_paths = list(self.shard_paths)
+        else:
+            shard_paths = self.shard_paths[worker_info.id:: worker_info.num_workers]
+
+        if self.shuffle:
+            random.shuffle(shard_paths)
+
+        for shard_path in shard_paths:
+            dataset = ColumnarDataset(shard_path)
+            documents = self._split_documents(shard_path, dataset).tolist()
+            if self.shuffle:
+                random.shuffle(documents)
+
+            words = dataset.words()
+            labels = dataset.ner_labels()
+            for document in documents:
+                yield self.featurizer(words[document], labels[document])
+
+
+def build_streaming_dataloaders(args, artifacts_dir):
+    """
+    Streaming counterpart of the in memory data preparation in train_cnn_rnn_crf
+    :param args: Parsed training arguments
+    :param artifacts_dir: Directory to save encoders to
+    :return: Dictionary of dataloaders, encoders and model dimensions
+    """
+    shard_paths = list_columnar_shards(args.DATA_PATH)
+    if len(shard_paths) == 0:
+        raise ValueError(f"No columnar shards found at {args.DATA_PATH}")
+
+    mlflow.log_param("STREAMING_SHARDS", len(shard_paths))
+    mlflow.log_param("NUM_WORKERS", args.NUM_WORKERS)
+
+    tag_to_index = build_tag_to_index()
+    with open(os.path.join(artifacts_dir, "tag_to_index"), "wb") as inf:
+        dill.dump(tag_to_index, inf)
+
+    (
+        x_encoder,
+        x_char_encoder,
+        y_ner_encoder,
+        class_count_dict,
+        max_word_length,
+        pad_count,
+        char_words,
+    ) = fit_streaming_encoders(
+        shard_paths, args.MAX_SENTENCE_LEN, split_size=args.TEST_SPLIT, seed=args.SPLIT_SEED
+    )
+
+    for name, encoder in (
+        ("x_encoder", x_encoder),
+        ("x_char_encoder", x_char_encoder),
+        ("y_ner_encoder", y_ner_encoder),
+    ):
+        with open(os.path.join(artifacts_dir, name), "wb") as inf:
+            dill.dump(encoder, inf)
+    save_run_vocabularies(
+        artifacts_dir,
+        {
+            "x_encoder": x_encoder,
+            "x_char_encoder": x_char_encoder,
+            "y_ner_encoder": y_ner_encoder,
+            "char_words": char_words,
+        },
+        tag_to_index,
+    )
+
+    token_feature_spec = TokenFeatureSpec(args.TOKEN_FEATURES)
+    token_feature_spec.save(artifacts_dir)
+
+    featurizer = DocumentFeaturizer(
+        x_encoder,
+        x_char_encoder,
+        y_ner_encoder,
+        tag_to_index,
+        args.MAX_SENTENCE_LEN,
+        max_word_length,
+        token_feature_spec,
+    )
+    dataset_train = StreamingNERDataset(
+        shard_paths, featurizer, "train", split_size=args.TEST_SPLIT, seed=args.SPLIT_SEED
+    )
+    dataset_test = StreamingNERDataset(
+        shard_paths, featurizer, "test", split_size=args.TEST_SPLIT, seed=args.SPLIT_SEED, shuffle=False
+    )
+    dataloader_train = DataLoader(
+        dataset=dataset_train,
+        batch_size=args.BATCH_SIZE,
+        num_workers=args.NUM_WORKERS,
+        collate_fn=trim_collate,
+    )
+    dataloader_test = DataLoader(
+        dataset=dataset_test,
+        batch_size=args.BATCH_SIZE,
+        num_workers=args.NUM_WORKERS,
+        collate_fn=trim_collate,
+    )
+
+    num_classes = len(class_count_dict)
+    mlflow.log_param("DATA_SIZE", len(dataset_train) + len(dataset_test))
+    mlflow.log_param("NUM_POS_TAGS", len(tag_to_index))
+    mlflow.log_param("MAX_SENTENCE_LEN", args.MAX_SENTENCE_LEN)
+    mlflow.log_param("NUM_CLASSES", num_classes)
+    mlflow.log_param("ENRICH_FEAT_DIM", token_feature_spec.feature_dim)
+    mlflow.log_param("TOKEN_FEATURES", ",".join(token_feature_spec.feature_order))
+    mlflow.log_param("MAX_WORD_LENGTH", max_word_length)
+
+    mlflow.log_param("Y_O_INDEX", y_ner_encoder.token_to_index["O"])
+
+    return {
+        "dataloader_train": dataloader_train,
+        "dataloader_test": dataloader_test,
+        "ner_class_weights": calculate_streaming_sample_weights(
+            class_count_dict, y_ner_encoder, pad_count
+        ),
+        "num_classes": num_classes,
+        "y_o_index": y_ner_encoder.token_to_index["O"],
+        "num_pos_tags": len(tag_to_index),
+        "enrich_feat_dim": token_feature_spec.feature_dim,
+        "token_feature_dims": (
+            len(token_feature_spec.bool_names), len(token_feature_spec.ratio_names)
+        ),
+        "x_encoder": x_encoder,
+        "x_char_encoder": x_char_encoder,
+    }
@@ -0,0 +1,32 @@
+"""
+Shared fixtures. Run from a directory with config.yml, environment.yml and
+inference_config.yml, as train_cnn_rnn_crf and inference read them on import
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from tests.synthetic import log_untrained_run, synthetic_documents
+
+MAX_SENTENCE_LEN = 60
+
+
+@pytest.fixture(scope="session")
+def documents():
+    """
+    Documents of 5 to 60 words
+    """
+    return synthetic_documents(40, min_len=5, max_len=MAX_SENTENCE_LEN, seed=0)
+
+
+@pytest.fixture(scope="session")
+def logged_run(tmp_path_factory, documents):
+    """
+    Untrained run logged to a temporary file tracking store
+    :return: tracking directory, experiment id, run id
+    """
+    tracking_dir = str(tmp_path_factory.mktemp("tracking") / "mlruns")
+    experiment_id, run_id = log_untrained_run(tracking_dir, documents, MAX_SENTENCE_LEN)
+    return tracking_dir, experiment_id, run_id
@@ -0,0 +1,130 @@
+"""
+Implementations replaced by faster code, kept as references the tests compare
+against and benchmark.py times
+"""
+import pickle
+import torch
+import torch.nn.functional as F
+from torchnlp.encoders.text import CharacterEncoder
+
+# EntityExtraction attributes added after the first checkpoints were pickled
+CHECKPOINT_ADDED_ATTRIBUTES = ("num_pos_tags", "pos_embed", "token_feature_dims", "pack_sequences", "char_dedup")
+
+
+def legacy_tokenize_character(X_text_list_train, X_text_list_test, max_sent_len=800):
+    """
+    tokenize_character before build_char_matrix, per word encoding and padding
+    :param X_text_list_train:
+    :param X_text_list_test:
+    :param max_sent_len:
+    :return: x_char_encoder, x_char_padded_train, x_char_padded_test, max_word_length
+    """
+    X_text_list_train = [
+        lst[:max_sent_len] + (max_sent_len - len(lst)) * ["<end>"]
+        for lst in X_text_list_train
+    ]
+    X_text_list_test = [
+        lst[:max_sent_len] + (max_sent_len - len(lst)) * ["<end>"]
+        for lst in X_text_list_test
+    ]
+
+    x_char_encoder = CharacterEncoder(
+        sample=[" ".join(sent) for sent in X_text_list_train], append_eos=False,
+    )
+
+    x_char_encoded_train = [
+        [x_char_encoder.encode(char) for char in word] for word in X_text_list_train
+    ]
+    x_char_encoded_test = [
+        [x_char_encoder.encode(char) for char in word] for word in X_text_list_test
+    ]
+
+    max_word_length = max(
+        [
+            max([internal.shape[0] for internal in external])
+            for external in x_char_encoded_train
+        ]
+    )
+
+    outer_list = []
+    for lst in x_char_encoded_train:
+        inner_list = []
+        for ten in lst:
+            res = torch.zeros(max_word_length, dtype=torch.long)
+            res[: ten.shape[0]] = ten[:max_word_length]
+            inner_list.append(res)
+        outer_list.append(inner_list)
+
+    x_char_padded_train = torch.stack([torch.stack(lst) for lst in outer_list])
+
+    outer_list = []
+    for lst in x_char_encoded_test:
+        inner_list = []
+        for ten in lst:
+            res = torch.zeros(max_word_length, dtype=torch.long)
+            res[: ten.shape[0]] = ten[:max_word_length]
+            inner_list.append(res)
+        outer_list.append(inner_list)
+
+    x_char_padded_test = torch.stack([torch.stack(lst) for lst in outer_list])
+    return x_char_encoder, x_char_padded_train, x_char_padded_test, max_word_length
+
+
+def legacy_char_features(model, x_char):
+    """
+    Char branch of EntityExtraction.forward before _char_features, every word
+    position including padding goes through the CNN
+    """
+    batch_size = x_char.shape[0]
+    char_out = model.char_embed_drop(model.char_embed(x_char))
+    char_out = char_out.contiguous().view(
+        char_out.size(0) * char_out.size(1), char_out.size(3), char_out.size(2)
+    )
+    char_out = model.char_cnn(char_out)
+    char_out = F.max_pool1d(char_out, kernel_size=char_out.shape[-1]).squeeze(-1)
+    return char_out.contiguous().view(batch_size, -1, char_out.size(-1))
+
+
+def get_bio_entities_values_probas(result, sentence, proba, add_factor=.5):
+    """
+    Reference single pass span extraction for valid BIO sequences, e.g. from decoding
+    with crf_decoding.bio_constraints. A span starts at <entity>-B and runs over the
+    following <entity>-I labels, an <entity>-I with no open span of that entity starts one
+    :param result: Labels
+    :param sentence: Words
+    :param proba: Confidence of each label
+    :param add_factor: Added to the span length when averaging, defaults to .5
+    :return: tuple of (entity, value, confidence)
+    """
+    spans = []
+    open_entity = None
+    for ind, label in enumerate(map(str, result)):
+        entity, _, suffix = label.rpartition("-")
+        if suffix == "B" or (suffix == "I" and entity != open_entity):
+            spans.append([entity, [sentence[ind]], proba[ind]])
+            open_entity = entity
+        elif suffix == "I":
+            spans[-1][1].append(sentence[ind])
+            spans[-1][2] += proba[ind]
+        else:
+            open_entity = None
+
+    return tuple(
+        (entity, " ".join(values), total / (len(values) + add_factor))
+        for entity, values, total in spans
+    )
+
+
+def baseline_checkpoint(model):
+    """
+    Pickles and unpickles a one hot pos tag model the way checkpoints saved before
+    pos tag embeddings, token features, packed sequences and char dedup load, i.e.
+    without the attributes added for them
+    :param model: EntityExtraction with num_pos_tags None
+    :return: EntityExtraction
+    """
+    legacy = pickle.loads(pickle.dumps(model))
+    for name in CHECKPOINT_ADDED_ATTRIBUTES:
+        legacy.__dict__.pop(name, None)
+        legacy._modules.pop(name, None)
+    return legacy
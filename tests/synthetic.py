@@ -0,0 +1,186 @@
+"""
+Synthetic documents, model inputs and runs shared by the tests and benchmark.py
+"""
+import os
+import random
+import string
+from types import SimpleNamespace
+import dill
+import mlflow
+import mlflow.pytorch
+import numpy as np
+import torch
+from torchnlp.encoders import LabelEncoder
+from torchnlp.encoders.text import CharacterEncoder, StaticTokenizerEncoder
+import train_cnn_rnn_crf
+from inference import run_paths
+from token_features import TokenFeatureSpec
+from train_cnn_rnn_crf import EntityExtraction, get_POS_tags
+from vocabulary import save_run_vocabularies
+
+COMMON_WORDS = [
+    "experience", "manager", "engineer", "software", "python", "project", "team",
+    "university", "bachelor", "skills", "company", "limited", "sydney", "melbourne",
+    "the", "and", "of", "in", "at", "for", "with", "developed", "led", "data",
+    "email", "phone", "address", "date", "name", "amount", "total", "policy",
+]
+
+LABELS = ["O"] + [f"{entity}-{suffix}" for entity in ("ORG", "PER", "LOC", "DATE") for suffix in "BI"]
+
+
+def synthetic_documents(num_documents=10000, min_len=20, max_len=400, seed=0):
+    """
+    Resume like documents, mostly common words with some names, numbers and ids
+    :param num_documents:
+    :param min_len:
+    :param max_len:
+    :param seed:
+    :return: list of list of words
+    """
+    rng = random.Random(seed)
+
+    def word():
+        draw = rng.random()
+        if draw < 0.75:
+            return rng.choice(COMMON_WORDS)
+        if draw < 0.85:
+            return rng.choice(COMMON_WORDS).title()
+        if draw < 0.92:
+            return str(rng.randint(0, 100000))
+        return "".join(rng.choices(string.ascii_letters, k=rng.randint(2, 12)))
+
+    return [
+        [word() for _ in range(rng.randint(min_len, max_len))]
+        for _ in range(num_documents)
+    ]
+
+
+def synthetic_labelled_documents(num_documents, min_len=5, max_len=60, seed=0):
+    """
+    Synthetic documents with random BIO labels, in the data_ready_list.pkl format
+    :param num_documents:
+    :param min_len:
+    :param max_len:
+    :param seed:
+    :return: list of tuples of (word, label)
+    """
+    rng = random.Random(seed)
+    documents = []
+    for words in synthetic_documents(num_documents, min_len, max_len, seed):
+        labels = []
+        for _ in words:
+            previous = labels[-1] if labels else "O"
+            if previous != "O" and rng.random() < 0.5:
+                labels.append(previous.rpartition("-")[0] + "-I")
+            else:
+                labels.append(rng.choice(LABELS[::2]) if rng.random() < 0.2 else "O")
+        documents.append(tuple(zip(words, labels)))
+    return documents
+
+
+def synthetic_feature_tensors(num_documents, max_sentence_len, max_word_length=12, seed=0):
+    """
+    Padded model inputs with a skewed, log-normal document length distribution, most
+    documents short and a few near max_sentence_len
+    :param num_documents:
+    :param max_sentence_len:
+    :param max_word_length: defaults to 12
+    :param seed: defaults to 0
+    :return: Dictionary of padded tensors
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.clip(
+        rng.lognormal(mean=3.5, sigma=1.0, size=num_documents), 5, max_sentence_len
+    ).astype(np.int64)
+    mask = torch.from_numpy(np.arange(max_sentence_len) < lengths[:, None])
+    shape = (num_documents, max_sentence_len)
+    return {
+        "x_padded": torch.randint(1, 5000, shape) * mask,
+        "x_char_padded": torch.randint(1, 80, shape + (max_word_length,)),
+        "x_postag_padded": torch.randint(1, 40, shape) * mask,
+        "x_enriched_features": torch.randint(0, 256, shape + (2,), dtype=torch.uint8),
+        "y_ner_padded": torch.randint(1, 8, shape) * mask,
+    }
+
+
+def small_model(**kwargs):
+    """
+    Small EntityExtraction over a 5000 word and 80 character vocabulary
+    :return: EntityExtraction
+    """
+    train_cnn_rnn_crf.x_encoder = SimpleNamespace(vocab_size=5000)
+    train_cnn_rnn_crf.x_char_encoder = SimpleNamespace(vocab_size=80)
+    return EntityExtraction(**dict(
+        dict(
+            num_classes=8,
+            rnn_hidden_size=64,
+            rnn_stack_size=1,
+            word_embed_dim=64,
+            tag_embed_dim=16,
+            num_pos_tags=40,
+            token_feature_dims=(12, 0),
+            class_weights=[1.0] * 8,
+        ),
+        **kwargs
+    ))
+
+
+def log_untrained_run(tracking_dir, documents, max_sentence_len, extra_words=0, **model_kwargs):
+    """
+    Logs an untrained run with the params, encoders, feature spec and model layout
+    inference.py loads
+    :param tracking_dir: Directory of the file tracking store
+    :param documents: Words of each document the encoders are fit on
+    :param max_sentence_len:
+    :param extra_words: Random words added to the word vocabulary, defaults to 0
+    :param model_kwargs: EntityExtraction arguments overriding the small defaults
+    :return: experiment id, run id
+    """
+    X_text_list = [[word.lower() for word in doc] for doc in documents]
+    _, tag_to_index = get_POS_tags(X_text_list)
+    max_word_length = max(len(word) for doc in documents for word in doc)
+    token_feature_spec = TokenFeatureSpec()
+    rng = random.Random(0)
+    vocab_sample = X_text_list + [
+        ["".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 12))) for _ in range(1000)]
+        for _ in range(extra_words // 1000)
+    ]
+    objects = {
+        "x_encoder": StaticTokenizerEncoder(sample=vocab_sample, append_eos=False, tokenize=lambda x: x),
+        "x_char_encoder": CharacterEncoder(sample=[" ".join(doc) for doc in documents], append_eos=False),
+        "y_ner_encoder": LabelEncoder(sample=LABELS),
+        "tag_to_index": tag_to_index,
+    }
+
+    mlflow.set_tracking_uri(f"file:{tracking_dir}")
+    with mlflow.start_run() as run:
+        mlflow.log_param("MAX_SENTENCE_LEN", max_sentence_len)
+        mlflow.log_param("MAX_WORD_LENGTH", max_word_length)
+        _, files_location, model_location = run_paths(run.info.experiment_id, run.info.run_id)
+        os.makedirs(files_location)
+        for name, obj in objects.items():
+            with open(os.path.join(files_location, name), "wb") as outfile:
+                dill.dump(obj, outfile)
+        save_run_vocabularies(
+            files_location, dict(objects, char_words=list(dict.fromkeys(word for doc in documents for word in doc))),
+            tag_to_index,
+        )
+        token_feature_spec.save(files_location)
+
+        train_cnn_rnn_crf.x_encoder = objects["x_encoder"]
+        train_cnn_rnn_crf.x_char_encoder = objects["x_char_encoder"]
+        model = EntityExtraction(**dict(
+            dict(
+                num_classes=len(LABELS),
+                rnn_hidden_size=64,
+                rnn_stack_size=1,
+                word_embed_dim=64,
+                tag_embed_dim=16,
+                num_pos_tags=max(tag_to_index.values()) + 1,
+                token_feature_dims=(len(token_feature_spec.bool_names), len(token_feature_spec.ratio_names)),
+                class_weights=[1.0] * len(LABELS),
+            ),
+            **model_kwargs
+        ))
+        mlflow.pytorch.save_model(model, model_location)
+    return run.info.experiment_id, run.info.run_id
@@ -0,0 +1,50 @@
+import numpy as np
+import torch
+from torchnlp.encoders.text import CharacterEncoder
+from train_cnn_rnn_crf import build_char_matrix, tokenize_character
+from tests.reference import legacy_char_features, legacy_tokenize_character
+from tests.synthetic import small_model, synthetic_documents
+
+
+def test_char_matrix_matches_per_word_encoding():
+    documents = synthetic_documents(50, max_len=80)
+    train, test = documents[:40], documents[40:]
+    expected = legacy_tokenize_character(train, test, 60)
+    result = tokenize_character(train, test, 60)
+    assert expected[0].vocab == result[0].vocab
+    assert expected[3] == result[3]
+    assert torch.equal(expected[1], result[1])
+    assert torch.equal(expected[2], result[2])
+
+
+def test_char_features_of_real_words_match_all_positions():
+    torch.manual_seed(0)
+    model = small_model(char_dedup=False).eval()
+    lengths = np.random.default_rng(0).integers(5, 30, 8)
+    mask = torch.from_numpy(np.arange(60) < lengths[:, None]).type(torch.uint8)
+    x_char = torch.randint(1, 80, (8, 60, 12))
+    with torch.no_grad():
+        expected = legacy_char_features(model, x_char) * mask.unsqueeze(-1)
+        assert torch.allclose(expected, model._char_features(x_char, mask), atol=1e-6)
+
+
+def test_char_dedup_gradients_match_every_word():
+    torch.manual_seed(0)
+    documents = synthetic_documents(8, max_len=80)
+    max_sentence_len = max(len(document) for document in documents)
+    x_char_encoder = CharacterEncoder(sample=[" ".join(doc) for doc in documents], append_eos=False)
+    x_char, _ = build_char_matrix(documents, x_char_encoder, max_sentence_len, max_word_length=12)
+    lengths = np.array([len(document) for document in documents])
+    mask = torch.from_numpy(np.arange(max_sentence_len) < lengths[:, None]).type(torch.uint8)
+    # Dropout off so that both modes compute the same function. Gradients of repeated
+    # words are summed in a different order, compared in double precision
+    model = small_model().double().eval()
+
+    def gradients(char_dedup):
+        model.char_dedup = char_dedup
+        model.zero_grad()
+        model._char_features(x_char, mask).pow(2).sum().backward()
+        return [param.grad.clone() for param in (model.char_embed.weight, model.char_cnn.weight)]
+
+    for every_word, unique_words in zip(gradients(False), gradients(True)):
+        assert torch.allclose(every_word, unique_words)
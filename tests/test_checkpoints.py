@@ -0,0 +1,42 @@
+import torch
+from model_bundle import ModelBundle, export_bundle
+from token_features import TokenFeatureSpec
+from train_cnn_rnn_crf import pos_input_for_model
+from vocabulary import Vocabulary
+from tests.reference import baseline_checkpoint
+from tests.synthetic import small_model, synthetic_feature_tensors
+
+
+def test_legacy_checkpoint_predicts_like_the_saved_model(tmp_path):
+    torch.manual_seed(0)
+    tensors = synthetic_feature_tensors(8, 60)
+    mask = tensors["x_padded"] > 0
+    x_enrich = torch.rand(tensors["x_padded"].shape + (7,))
+    model = small_model(
+        num_pos_tags=None, tag_embed_dim=40, token_feature_dims=None, enrich_dim=7, pack_sequences=False,
+        char_dedup=False,
+    ).eval()
+    legacy = baseline_checkpoint(model)
+    bundle_path = export_bundle(
+        str(tmp_path / "model.nerb"),
+        legacy,
+        x_encoder=Vocabulary.from_tokens(["<pad>", "<unk>"], "tokens"),
+        x_char_encoder=Vocabulary.from_tokens(["<pad>", "<unk>"], "chars"),
+        y_ner_encoder=Vocabulary.from_tokens(["<unk>", "O"], "label"),
+        tag_to_index={"NN": 0},
+        token_feature_spec=TokenFeatureSpec(),
+        params={"MAX_SENTENCE_LEN": 60, "MAX_WORD_LENGTH": 12},
+    )
+
+    def predict(entity_extraction):
+        with torch.no_grad():
+            return entity_extraction.predict(
+                tensors["x_padded"], pos_input_for_model(entity_extraction, tensors["x_postag_padded"]),
+                tensors["x_char_padded"], x_enrich, mask,
+            )
+
+    expected = predict(model)
+    for checkpoint in (legacy, ModelBundle(bundle_path).model()):
+        emissions, tags = predict(checkpoint)[:2]
+        assert torch.allclose(expected[0], emissions)
+        assert torch.equal(expected[1], tags)
@@ -0,0 +1,120 @@
+import itertools
+import pytest
+import torch
+from torchcrf import CRF
+from crf_decoding import (
+    bio_constraints,
+    crf_kbest_decode,
+    crf_parameters,
+    crf_viterbi_decode,
+    forward_backward,
+)
+
+LABELS = ["<unk>", "O"] + [f"{entity}-{suffix}" for entity in ("ORG", "PER", "LOC", "DATE") for suffix in "BI"]
+
+
+def random_crf(num_tags, bound=1):
+    crf = CRF(num_tags, batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -bound, bound)
+    return crf
+
+
+def random_mask(batch_size, max_len):
+    lengths = torch.randint(max_len // 2, max_len + 1, (batch_size,))
+    return (torch.arange(max_len) < lengths.unsqueeze(1)).type(torch.uint8)
+
+
+@pytest.fixture(autouse=True)
+def seed():
+    torch.manual_seed(0)
+
+
+def test_viterbi_matches_torchcrf():
+    crf = random_crf(16)
+    emissions = torch.randn(8, 50, 16)
+    mask = random_mask(8, 50)
+    with torch.no_grad():
+        expected = crf.decode(emissions, mask)
+        tags, scores = crf_viterbi_decode(crf, emissions, mask)
+        expected_scores = crf._compute_score(emissions.transpose(0, 1), tags.transpose(0, 1), mask.transpose(0, 1))
+    assert [row[:length] for row, length in zip(tags.tolist(), mask.sum(dim=1).tolist())] == expected
+    assert (tags.masked_select(mask == 0) == 0).all()
+    assert torch.allclose(scores, expected_scores, atol=1e-4)
+
+
+def test_marginals_are_log_partition_gradient():
+    # Marginals are the gradient of the log partition with respect to the emissions
+    crf = random_crf(16).double()
+    emissions = torch.randn(8, 50, 16, dtype=torch.double)
+    mask = random_mask(8, 50)
+    emissions_grad = emissions.clone().requires_grad_()
+    log_partition_expected = crf._compute_normalizer(emissions_grad.transpose(0, 1), mask.transpose(0, 1))
+    log_partition_expected.sum().backward()
+    with torch.no_grad():
+        marginals, log_partition = forward_backward(emissions, mask, *crf_parameters(crf))
+    assert torch.allclose(log_partition, log_partition_expected)
+    assert torch.allclose(marginals, emissions_grad.grad)
+
+
+def test_kbest_matches_brute_force():
+    crf = random_crf(3)
+    emissions = torch.randn(4, 5, 3)
+    mask = torch.tensor([[1] * 5, [1] * 3 + [0] * 2, [1] * 2 + [0] * 3, [1] + [0] * 4]).type(torch.uint8)
+    with torch.no_grad():
+        kbest_tags, kbest_scores = crf_kbest_decode(crf, emissions, mask, k=5)
+        for doc, length in enumerate(mask.sum(dim=1).tolist()):
+            paths = torch.LongTensor(list(itertools.product(range(3), repeat=length)))
+            paths = torch.nn.functional.pad(paths, (0, 5 - length))
+            scores = crf._compute_score(
+                emissions[doc].expand(len(paths), -1, -1).transpose(0, 1),
+                paths.transpose(0, 1),
+                mask[doc].expand(len(paths), -1).transpose(0, 1),
+            )
+            expected_scores, order = scores.topk(min(5, len(paths)))
+            found = len(order)
+            assert torch.allclose(kbest_scores[doc, :found], expected_scores, atol=1e-5)
+            assert (kbest_tags[doc, :found] == paths[order]).all()
+
+
+def test_best_of_kbest_is_viterbi():
+    crf = random_crf(16)
+    emissions = torch.randn(8, 50, 16)
+    mask = random_mask(8, 50)
+    with torch.no_grad():
+        viterbi_tags, _ = crf_viterbi_decode(crf, emissions, mask)
+        assert (crf_kbest_decode(crf, emissions, mask, k=3)[0][:, 0] == viterbi_tags).all()
+
+
+def is_valid(constraints, path):
+    return (
+        bool(constraints.start[path[0]]) and bool(constraints.end[path[-1]])
+        and all(bool(constraints.transitions[a, b]) for a, b in zip(path, path[1:]))
+    )
+
+
+def test_bio_constrained_viterbi_matches_brute_force():
+    constraints = bio_constraints(LABELS)
+    crf = random_crf(len(LABELS), bound=2)
+    emissions = torch.randn(3, 4, len(LABELS))
+    paths = torch.LongTensor(
+        [path for path in itertools.product(range(len(LABELS)), repeat=4) if is_valid(constraints, path)]
+    )
+    with torch.no_grad():
+        tags, _ = crf_viterbi_decode(crf, emissions, constraints=constraints)
+        for doc in range(3):
+            scores = crf._compute_score(
+                emissions[doc].expand(len(paths), -1, -1).transpose(0, 1),
+                paths.transpose(0, 1),
+                torch.ones(4, len(paths), dtype=torch.uint8),
+            )
+            assert (tags[doc] == paths[scores.argmax()]).all()
+
+
+def test_bio_constrained_paths_are_valid():
+    constraints = bio_constraints(LABELS)
+    crf = random_crf(len(LABELS), bound=2)
+    emissions = torch.randn(16, 50, len(LABELS))
+    mask = torch.ones(16, 50, dtype=torch.uint8)
+    with torch.no_grad():
+        tags, _ = crf_viterbi_decode(crf, emissions, mask, constraints=constraints)
+    assert all(is_valid(constraints, row) for row in tags.tolist())
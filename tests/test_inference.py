@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import asyncio
+import subprocess
+import threading
+import urllib.request
+import numpy as np
+import pytest
+from batch_inference import run_batch_inference
+from inference import InferenceEngine
+from inference_server import build_server
+from micro_batching import MicroBatcher
+from model_bundle import export_run_bundle
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def engine(logged_run):
+    _, experiment_id, run_id = logged_run
+    engine = InferenceEngine(experiment_id, run_id)
+    yield engine
+    engine.close()
+
+
+def assert_same_entities(found, expected):
+    """
+    Same entities and values, confidences up to float noise of different batches
+    """
+    assert {k: v[0] for k, v in found.items()} == {k: v[0] for k, v in expected.items()}
+    assert np.allclose([v[1] for v in found.values()], [v[1] for v in expected.values()], atol=1e-4)
+
+
+def test_micro_batches_match_single_documents(engine, documents):
+    async def run(max_batch_size):
+        batcher = MicroBatcher(engine.predict, max_batch_size=max_batch_size, max_wait=0.005)
+        results = await asyncio.gather(*(batcher.predict(document) for document in documents))
+        await batcher.close()
+        return results
+
+    expected = asyncio.run(run(1))
+    for found, single in zip(asyncio.run(run(16)), expected):
+        assert_same_entities(found, single)
+
+
+def test_failing_document_fails_alone(engine, documents):
+    def failing_predict(batch):
+        if None in batch:
+            raise ValueError("Bad document")
+        return engine.predict(batch)
+
+    async def run():
+        batcher = MicroBatcher(failing_predict, max_batch_size=16, max_wait=0.05)
+        results = await asyncio.gather(
+            *(batcher.predict(document) for document in [documents[0], None, documents[1]]),
+            return_exceptions=True,
+        )
+        await batcher.close()
+        return results
+
+    first, failed, second = asyncio.run(run())
+    assert isinstance(failed, ValueError)
+    assert first == engine.predict([documents[0]])[0]
+    assert second == engine.predict([documents[1]])[0]
+
+
+def test_batch_inference_matches_and_resumes(engine, documents, tmp_path):
+    input_path = str(tmp_path / "documents.jsonl")
+    output_path = str(tmp_path / "entities.jsonl")
+    with open(input_path, "w") as outfile:
+        for i, doc in enumerate(documents):
+            outfile.write(json.dumps({"id": f"doc-{i}", "text": " ".join(doc)}) + "\n")
+
+    def read_output():
+        with open(output_path) as infile:
+            return {record["id"]: record["entities"] for record in map(json.loads, infile)}
+
+    run_batch_inference(engine, input_path, output_path, batch_size=8, workers=0, report_every=10 ** 9)
+    found = read_output()
+    assert len(found) == len(documents)
+    for i, doc in enumerate(documents):
+        assert_same_entities(found[f"doc-{i}"], engine.predict([" ".join(doc)])[0])
+
+    # Drop the last lines and leave a partly written one, as if interrupted
+    with open(output_path) as infile:
+        lines = infile.readlines()
+    with open(output_path, "w") as outfile:
+        outfile.writelines(lines[:len(lines) // 2])
+        outfile.write(lines[len(lines) // 2][:10])
+    resumed, _ = run_batch_inference(engine, input_path, output_path, batch_size=8, workers=0)
+    assert resumed == len(lines) - len(lines) // 2
+    resumed_output = read_output()
+    assert resumed_output.keys() == found.keys()
+    for key, entities in found.items():
+        assert_same_entities(resumed_output[key], entities)
+
+
+def test_bundle_predicts_like_run(logged_run, documents, tmp_path):
+    _, experiment_id, run_id = logged_run
+    bundle_path = export_run_bundle(experiment_id, run_id, str(tmp_path / "model.nerb"))
+    texts = [" ".join(doc) for doc in documents]
+    assert InferenceEngine(experiment_id, run_id).predict(texts) == \
+        InferenceEngine(bundle_path=bundle_path).predict(texts)
+
+
+def test_server_and_script_match_engine(logged_run, documents, tmp_path):
+    tracking_dir, experiment_id, run_id = logged_run
+    texts = [" ".join(doc) for doc in documents[:2]]
+    engine = InferenceEngine(experiment_id, run_id, pos_cache_path=str(tmp_path / "pos_cache.sqlite"))
+    server = build_server(engine, port=0, run_id=run_id)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        for text in texts:
+            expected = engine.predict([text])[0]
+            output = subprocess.run(
+                [sys.executable, os.path.join(REPO_DIR, "inference.py"), "--experiment-id", experiment_id,
+                 "--run-id", run_id, "--data-text", text],
+                env=dict(os.environ, MLFLOW_TRACKING_URI=f"file:{tracking_dir}"),
+                check=True, capture_output=True, text=True,
+            ).stdout
+            assert output.split("Output:\n")[1].splitlines()[0] == str(expected)
+
+            request = urllib.request.Request(
+                f"{url}/predict", data=json.dumps({"text": text}).encode("utf-8"),
+                headers={"Content-Type": "application/json"},
+            )
+            with urllib.request.urlopen(request) as response:
+                found = json.loads(response.read())["entities"][0]
+            assert {k: tuple(v) for k, v in found.items()} == {k: tuple(v) for k, v in expected.items()}
+        with urllib.request.urlopen(f"{url}/health") as response:
+            assert json.loads(response.read())["caches"]["pos_cache"]["hits"] > 0
+    finally:
+        server.shutdown()
+        server.server_close()
+        engine.close()
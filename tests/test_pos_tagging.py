@@ -0,0 +1,22 @@
+import nltk
+from pos_tagging import POSTagger, POSTagCache, prepare_tokens
+from tests.synthetic import synthetic_documents
+
+
+def test_batched_tags_match_pos_tag():
+    documents = synthetic_documents(50, max_len=80)
+    expected = [[tag for _, tag in nltk.pos_tag(prepare_tokens(doc))] for doc in documents]
+    assert POSTagger().tag_documents(documents, batch_size=16) == expected
+
+
+def test_cached_tags_match_uncached(tmp_path):
+    documents = synthetic_documents(50, max_len=80)
+    tagger = POSTagger()
+    expected = tagger.tag_documents(documents)
+    cache = POSTagCache(str(tmp_path / "pos_cache.sqlite"))
+    try:
+        assert tagger.tag_documents(documents, cache=cache) == expected
+        assert tagger.tag_documents(documents, cache=cache) == expected
+        assert cache.stats()["hits"] > 0
+    finally:
+        cache.close()
@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+from torchcrf import CRF
+from crf_decoding import bio_constraints, crf_viterbi_decode, tag_marginals
+from span_extraction import SpanExtractor
+from tests.reference import get_bio_entities_values_probas
+
+LABELS = ["<unk>", "O"] + [f"{entity}-{suffix}" for entity in ("ORG", "PER", "LOC", "DATE") for suffix in "BI"]
+
+
+def test_span_extractor_matches_single_pass_extraction():
+    torch.manual_seed(0)
+    crf = CRF(len(LABELS), batch_first=True)
+    torch.nn.init.uniform_(crf.transitions, -2, 2)
+    emissions = torch.randn(16, 50, len(LABELS))
+    # Mostly O, as in real documents
+    emissions[:, :, 1] += 3
+    lengths = torch.randint(25, 51, (16,))
+    mask = (torch.arange(50) < lengths.unsqueeze(1)).type(torch.uint8)
+    constraints = bio_constraints(LABELS)
+    with torch.no_grad():
+        tags, _ = crf_viterbi_decode(crf, emissions, mask, constraints=constraints)
+        proba = tag_marginals(crf, emissions, tags, mask, constraints)
+    sentences = [[f"w{i}" for i in range(length)] for length in lengths.tolist()]
+
+    expected = [
+        get_bio_entities_values_probas([LABELS[tag] for tag in row[:length]], sentence, doc_proba)
+        for row, length, sentence, doc_proba in zip(tags.tolist(), lengths.tolist(), sentences, proba.tolist())
+    ]
+    found = SpanExtractor(LABELS).entities(tags, proba, sentences, mask)
+    assert any(found)
+    assert [[(e, v) for e, v, _ in doc] for doc in expected] == [[(e, v) for e, v, _ in doc] for doc in found]
+    assert np.allclose([p for doc in expected for _, _, p in doc], [p for doc in found for _, _, p in doc])
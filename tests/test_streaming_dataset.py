@@ -0,0 +1,42 @@
+import pickle
+import numpy as np
+import pytest
+import streaming_dataset
+from columnar_dataset import ColumnarDataset, list_columnar_shards, write_columnar_shards
+from train_cnn_rnn_crf import calculate_sample_weights, encode_ner_y, load_data
+from tests.synthetic import synthetic_labelled_documents
+
+
+@pytest.fixture(scope="module")
+def shards_dir(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("shards"))
+    write_columnar_shards(synthetic_labelled_documents(80, max_len=40), path, shard_size=16)
+    return path
+
+
+def test_load_data_concatenates_shards(shards_dir, tmp_path):
+    pickle_path = str(tmp_path / "data_ready_list.pkl")
+    with open(pickle_path, "wb") as outfile:
+        pickle.dump(synthetic_labelled_documents(80, max_len=40), outfile)
+    expected = load_data(pickle_path)
+    found = load_data(shards_dir)
+    assert [[list(doc) for doc in part] for part in found] == [[list(doc) for doc in part] for part in expected]
+
+
+@pytest.mark.parametrize("max_sentence_len", [30, 1000])
+def test_streaming_sample_weights_match_padded_labels(shards_dir, max_sentence_len):
+    shard_paths = list_columnar_shards(shards_dir)
+    _, _, y_ner_encoder, class_count_dict, _, pad_count, _ = streaming_dataset.fit_streaming_encoders(
+        shard_paths, max_sentence_len, 0.25, 0
+    )
+    labels = []
+    for shard_path in shard_paths:
+        dataset = ColumnarDataset(shard_path)
+        test_mask = streaming_dataset.test_document_mask(shard_path, len(dataset), 0.25, 0)
+        ner_labels = dataset.ner_labels()
+        labels += [list(ner_labels[doc])[:max_sentence_len] for doc in np.flatnonzero(~test_mask)]
+    _, y_ner_padded_train, _ = encode_ner_y(labels, labels[:1], class_count_dict, max_sentence_len)
+    assert np.allclose(
+        streaming_dataset.calculate_streaming_sample_weights(class_count_dict, y_ner_encoder, pad_count),
+        calculate_sample_weights(y_ner_padded_train),
+    )
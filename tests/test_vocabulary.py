@@ -0,0 +1,25 @@
+import torch
+from torchnlp.encoders.text import CharacterEncoder, StaticTokenizerEncoder, pad_tensor
+from train_cnn_rnn_crf import build_char_matrix
+from vocabulary import Vocabulary
+from tests.synthetic import synthetic_documents
+
+
+def test_vocabulary_encodes_like_torchnlp(tmp_path):
+    documents = synthetic_documents(100, max_len=60)
+    X_text_list = [[word.lower() for word in doc] for doc in documents]
+    x_encoder = StaticTokenizerEncoder(sample=X_text_list[:80], append_eos=False, tokenize=lambda x: x)
+    x_char_encoder = CharacterEncoder(sample=[" ".join(doc) for doc in documents[:80]], append_eos=False)
+    x_vocabulary = Vocabulary.from_encoder(x_encoder)
+    x_char_vocabulary = Vocabulary.from_encoder(x_char_encoder)
+
+    expected = torch.stack([pad_tensor(x_encoder.encode(text), 60) for text in X_text_list])
+    assert torch.equal(expected, x_vocabulary.encode_batch(X_text_list, 60))
+    assert torch.equal(
+        build_char_matrix(documents, x_char_encoder, 60, pad_word=None)[0],
+        build_char_matrix(documents, x_char_vocabulary, 60, pad_word=None)[0],
+    )
+
+    loaded = Vocabulary.load(x_vocabulary.save(str(tmp_path / "x_encoder.npz")))
+    for text in X_text_list:
+        assert loaded.lookup(text).tolist() == x_encoder.encode(text).tolist()
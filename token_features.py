@@ -0,0 +1,280 @@
+"""
+Token feature registry
+"""
+import os
+import re
+import json
+from collections import namedtuple
+import numpy as np
+import torch
+
+BOOL = "bool"
+RATIO = "ratio"
+
+FEATURE_SPEC_FILENAME = "feature_spec.json"
+# Most bytes of the fixed width unicode array tokens are featurized in at a time
+FEATURIZE_CHUNK_BYTES = 1 << 24
+
+TokenFeature = namedtuple("TokenFeature", ["name", "kind", "function"])
+
+# name -> TokenFeature, in registration order
+FEATURE_REGISTRY = dict()
+
+
+def register_feature(name, kind=BOOL):
+    """
+    Registers a token feature. The function takes a numpy unicode array of a chunk of tokens and
+    returns an array of the same length, bool for BOOL features and floats in [0, 1]
+    for RATIO features
+    :param name: Feature name, saved with the run
+    :param kind: BOOL (bit-packed) or RATIO (quantized to a byte), defaults to BOOL
+    :return: decorator
+    """
+    if kind not in (BOOL, RATIO):
+        raise ValueError(f"Unknown feature kind {kind}")
+
+    def decorator(function):
+        FEATURE_REGISTRY[name] = TokenFeature(name, kind, function)
+        return function
+
+    return decorator
+
+
+def _match(pattern, tokens):
+    return np.fromiter(
+        (pattern.search(token) is not None for token in tokens.tolist()),
+        dtype=bool,
+        count=len(tokens),
+    )
+
+
+register_feature("alnum")(np.char.isalnum)
+register_feature("numeric")(np.char.isnumeric)
+register_feature("alpha")(np.char.isalpha)
+register_feature("digit")(np.char.isdigit)
+register_feature("lower")(np.char.islower)
+register_feature("title")(np.char.istitle)
+
+
+@register_feature("ascii")
+def is_ascii(tokens):
+    return np.fromiter(map(str.isascii, tokens.tolist()), dtype=bool, count=len(tokens))
+
+
+@register_feature("all_caps")
+def is_all_caps(tokens):
+    return np.char.isupper(tokens) & (np.char.str_len(tokens) > 1)
+
+
+CURRENCY_PATTERN = re.compile(r"[$€£¥₹]")
+DATE_PATTERN = re.compile(
+    r"^(\d{1,4}[/\-.]\d{1,2}[/\-.]\d{1,4}|\d{1,2}(st|nd|rd|th)?|\d{4})$", re.IGNORECASE
+)
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+
+@register_feature("has_currency")
+def has_currency(tokens):
+    return _match(CURRENCY_PATTERN, tokens)
+
+
+@register_feature("date_shape")
+def is_date_shape(tokens):
+    return _match(DATE_PATTERN, tokens)
+
+
+@register_feature("email_shape")
+def is_email_shape(tokens):
+    return _match(EMAIL_PATTERN, tokens)
+
+
+@register_feature("digit_ratio", kind=RATIO)
+def digit_ratio(tokens):
+    digits = np.fromiter(
+        (sum(char.isdigit() for char in token) for token in tokens.tolist()),
+        dtype=np.float32,
+        count=len(tokens),
+    )
+    return digits / np.maximum(np.char.str_len(tokens), 1)
+
+
+# Features of models trained before the registry, in their original order
+LEGACY_FEATURES = ("alnum", "numeric", "alpha", "digit", "lower", "title", "ascii")
+DEFAULT_FEATURES = LEGACY_FEATURES + (
+    "all_caps", "has_currency", "date_shape", "email_shape", "digit_ratio",
+)
+
+
+def unpack_token_features(x_packed, num_bool, num_ratio, mask=None, pad_value=-1):
+    """
+    Unpacks stored features to float, used inside the model forward
+    :param x_packed: uint8 tensor N, L, ceil(num_bool/8) + num_ratio
+    :param num_bool: Number of bit-packed bool features
+    :param num_ratio: Number of quantized ratio features
+    :param mask: N, L, positions where mask is 0 are set to pad_value. Defaults to None
+    :param pad_value: defaults to -1
+    :return: float tensor N, L, num_bool + num_ratio
+    """
+    num_bytes = (num_bool + 7) // 8
+    x_packed = x_packed.long()
+    shifts = torch.arange(8, device=x_packed.device)
+    bits = (x_packed[..., :num_bytes].unsqueeze(-1) >> shifts) & 1
+    bits = bits.flatten(start_dim=-2)[..., :num_bool].float()
+    ratios = x_packed[..., num_bytes: num_bytes + num_ratio].float() / 255
+
+    unpacked = torch.cat((bits, ratios), dim=-1)
+    if mask is not None:
+        unpacked = unpacked.masked_fill(~mask.bool().unsqueeze(-1), pad_value)
+    return unpacked
+
+
+def length_chunks(lengths, max_bytes=FEATURIZE_CHUNK_BYTES):
+    """
+    Splits tokens into chunks of similar length. A numpy unicode array is as wide as
+    its longest token, so one long OCR or URL token only widens its own chunk
+    :param lengths: int64 length of every token
+    :param max_bytes: Most bytes of a chunk's array, a longer token is a chunk of its own.
+                      Defaults to FEATURIZE_CHUNK_BYTES
+    :return: list of int64 arrays of token indices
+    """
+    order = np.argsort(lengths, kind="stable")
+    widths = np.maximum(lengths[order], 1) * 4
+    chunks = []
+    start = 0
+    while start < len(order):
+        # Widths are sorted, so a chunk's array takes count times its last width
+        window = widths[start: start + max(max_bytes // 4, 1)]
+        fits = np.arange(1, len(window) + 1) * window <= max_bytes
+        end = start + max(int(np.argmin(fits)) if not fits.all() else len(window), 1)
+        chunks.append(order[start:end])
+        start = end
+    return chunks
+
+
+class TokenFeatureSpec:
+    """
+    Ordered set of registered features. Bool features are bit-packed 8 to a byte and
+    ratio features quantized to a byte each, featurized as one uint8 array
+    """
+    def __init__(self, names=DEFAULT_FEATURES):
+        """
+
+        :param names: Registered feature names, defaults to DEFAULT_FEATURES
+        """
+        unknown = [name for name in names if name not in FEATURE_REGISTRY]
+        if unknown:
+            raise ValueError(
+                f"Unknown token features {unknown}, registered - {list(FEATURE_REGISTRY)}"
+            )
+        self.names = tuple(names)
+        self.bool_names = tuple(name for name in names if FEATURE_REGISTRY[name].kind == BOOL)
+        self.ratio_names = tuple(name for name in names if FEATURE_REGISTRY[name].kind == RATIO)
+
+    @property
+    def feature_order(self):
+        """
+        :return: Feature names in the order the model sees them after unpacking
+        """
+        return self.bool_names + self.ratio_names
+
+    @property
+    def feature_dim(self):
+        return len(self.bool_names) + len(self.ratio_names)
+
+    @property
+    def packed_dim(self):
+        return (len(self.bool_names) + 7) // 8 + len(self.ratio_names)
+
+    def featurize(self, txt_list, max_sentence_len=800):
+        """
+        Computes every feature over the tokens of all documents, in chunks of similar length
+        :param txt_list: Text list
+        :param max_sentence_len: defaults to 800
+        :return: uint8 tensor N, max_sentence_len, packed_dim. Padding is 0
+        """
+        documents = [list(map(str, document[:max_sentence_len])) for document in txt_list]
+        lengths = np.array([len(document) for document in documents], dtype=np.int64)
+        tokens = [token for document in documents for token in document]
+
+        features = np.zeros((len(tokens), self.packed_dim), dtype=np.uint8)
+        if self.packed_dim:
+            token_lengths = np.fromiter(map(len, tokens), dtype=np.int64, count=len(tokens))
+            for chunk in length_chunks(token_lengths):
+                features[chunk] = self._featurize_tokens(np.array([tokens[ind] for ind in chunk.tolist()], dtype=str))
+
+        packed = np.zeros((len(documents), max_sentence_len, self.packed_dim), dtype=np.uint8)
+        packed[np.arange(max_sentence_len) < lengths[:, None]] = features
+        return torch.from_numpy(packed)
+
+    def _featurize_tokens(self, tokens):
+        """
+        :param tokens: numpy unicode array
+        :return: uint8 array len(tokens), packed_dim
+        """
+        columns = []
+        if self.bool_names:
+            flags = np.stack(
+                [FEATURE_REGISTRY[name].function(tokens) for name in self.bool_names], axis=1
+            ).astype(bool)
+            columns.append(np.packbits(flags, axis=1, bitorder="little"))
+        for name in self.ratio_names:
+            ratio = np.asarray(FEATURE_REGISTRY[name].function(tokens), dtype=np.float32)
+            columns.append(np.rint(np.clip(ratio, 0, 1) * 255).astype(np.uint8)[:, None])
+        return np.concatenate(columns, axis=1)
+
+    def unpack(self, x_packed, mask=None, pad_value=-1):
+        """
+        :param x_packed: Output of featurize
+        :param mask: defaults to None
+        :param pad_value: defaults to -1
+        :return: float tensor N, L, feature_dim
+        """
+        return unpack_token_features(
+            x_packed, len(self.bool_names), len(self.ratio_names), mask, pad_value
+        )
+
+    def to_dict(self):
+        return {
+            "names": list(self.names),
+            "feature_order": list(self.feature_order),
+            "kinds": {name: FEATURE_REGISTRY[name].kind for name in self.names},
+        }
+
+    def save(self, dir_path):
+        """
+        Saves the spec as feature_spec.json
+        :param dir_path: Run artifacts directory
+        :return: file path
+        """
+        path = os.path.join(dir_path, FEATURE_SPEC_FILENAME)
+        with open(path, "w") as outfile:
+            json.dump(self.to_dict(), outfile, indent=2)
+        return path
+
+    @classmethod
+    def load(cls, dir_path):
+        """
+        Loads the spec saved with a run. Runs from before the registry get the
+        legacy features
+        :param dir_path: Run artifacts directory
+        :return: TokenFeatureSpec
+        """
+        path = os.path.join(dir_path, FEATURE_SPEC_FILENAME)
+        if not os.path.isfile(path):
+            return cls(LEGACY_FEATURES)
+        with open(path, "r") as infile:
+            return cls(json.load(infile)["names"])
+
+
+def token_features_for_model(model, spec, x_packed, mask):
+    """
+    Models trained before the registry take unpacked float features
+    :param model: EntityExtraction
+    :param spec: TokenFeatureSpec of the run
+    :param x_packed: Output of spec.featurize
+    :param mask: N, L
+    :return: token feature input the model expects
+    """
+    if getattr(model, "token_feature_dims", None) is None:
+        return spec.unpack(x_packed, mask)
+    return x_packed
@@ -17,7 +17,7 @@ from sklearn.utils.class_weight import compute_class_weight
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
-from torch.nn.utils.rnn import pad_sequence
+from torch.nn.utils.rnn import pad_sequence, pack_padded_sequence, pad_packed_sequence
 from torch.utils.data import DataLoader
 from torchcrf import CRF
 from torchnlp.datasets.dataset import Dataset
@@ -27,6 +27,7 @@ from torchnlp.encoders.text import StaticTokenizerEncoder, CharacterEncoder
 from torchnlp.word_to_vector import GloVe
 import nltk
 import random
+import time
 import pickle
 import dill
 import mlflow.pytorch
@@ -35,6 +36,16 @@ from datetime import datetime
 from pathlib import Path
 import yaml
 import warnings
+from collections import OrderedDict
+from collections.abc import Sequence
+from batching import BucketBatchSampler, document_lengths, trim_collate
+from columnar_dataset import ColumnarDataset, is_columnar_dataset, list_columnar_shards
+from crf_decoding import bio_constraints, crf_viterbi_decode
+from feature_store import FeatureStore, feature_cache_key
+from model_bundle import export_run_bundle
+from vocabulary import save_run_vocabularies
+from pos_tagging import default_tagger, POSTagCache
+from token_features import DEFAULT_FEATURES, TokenFeatureSpec, unpack_token_features
 warnings.filterwarnings('ignore')
 
 home = str(Path.home())
@@ -48,10 +59,25 @@ with open("environment.yml", "r") as fh:
 
 def load_data(fpath="data/data_ready_list.pkl"):
     """
-    Loads pickle list of list as per suggested format
+    Loads pickle list of list as per suggested format, a columnar dataset directory or a
+    directory of columnar shards, the latter concatenated in shard order. Columnar datasets
+    are memory-mapped and documents are returned as lazy views
     :param fpath: filepath
     :return: Returns X_list (as is), X_list (lower) and y_list
     """
+    if is_columnar_dataset(fpath):
+        dataset = ColumnarDataset(fpath)
+        return dataset.words(), dataset.words(lower=True), dataset.ner_labels()
+
+    shard_paths = list_columnar_shards(fpath)
+    if shard_paths:
+        datasets = [ColumnarDataset(shard_path) for shard_path in shard_paths]
+        return (
+            [doc for dataset in datasets for doc in dataset.words()],
+            [doc for dataset in datasets for doc in dataset.words(lower=True)],
+            [doc for dataset in datasets for doc in dataset.ner_labels()],
+        )
+
     with open(fpath, "rb") as in_file:
         dataset_ready = pickle.load(in_file)
 
@@ -61,22 +87,27 @@ def load_data(fpath="data/data_ready_list.pkl"):
 
     return X_text_list_as_is, X_text_list, y_ner_list
 
-def get_POS_tags(X_text_list):
+def get_POS_tags(X_text_list, tagger=None, cache=None, tag_to_index=None):
     """
     Generates pos tags from NLTK
     :param X_text_list:
+    :param tagger: POSTagger, defaults to process wide tagger loaded once
+    :param cache: POSTagCache checked before tagging, defaults to None
+    :param tag_to_index: Existing tag index e.g. from training, unseen tags map to <UNK>.
+                         Defaults to None i.e. build index from X_text_list
     :return: X_tags, tag_to_index dictionary
     """
-    X_tags = []
-    all_tags = ["<pad>"]
-    for lst in X_text_list:
-        postag = nltk.pos_tag([word if word.strip() != "" else "<OOS>" for word in lst])
-        X_tags.append([tag[1] for tag in postag])
-
-    _ = [
-        [all_tags.append(tag) for tag in sent if tag not in all_tags] for sent in X_tags
-    ]
-    all_tags.append("<UNK>")
+    tagger = tagger if tagger is not None else default_tagger()
+    X_tags = tagger.tag_documents(X_text_list, cache=cache)
+
+    if tag_to_index is not None:
+        unknown_index = tag_to_index["<UNK>"]
+        X_tags = [[tag_to_index.get(tag, unknown_index) for tag in sent] for sent in X_tags]
+        return X_tags, tag_to_index
+
+    all_tags = dict.fromkeys(["<pad>"])
+    _ = [[all_tags.setdefault(tag) for tag in sent] for sent in X_tags]
+    all_tags.setdefault("<UNK>")
     tag_to_index = {tag: i for i, tag in enumerate(all_tags)}
     X_tags = [[tag_to_index[tag] for tag in sent] for sent in X_tags]
     return X_tags, tag_to_index
@@ -89,6 +120,7 @@ def split_test_train(
     x_enriched_features,
     y_ner_list,
     split_size=0.3,
+    seed=None,
 ):
     """
     Splits x_text, x_tags, x_enriched and y to test and train
@@ -98,12 +130,14 @@ def split_test_train(
     :param x_enriched_features:
     :param y_ner_list:
     :param split_size: defaults to .3
+    :param seed: Random seed for the split, defaults to None
     :return: Tuples for test and train for each input list
     """
-    test_index = random.choices(
+    test_index = random.Random(seed).choices(
         range(len(X_text_list)), k=int(split_size * len(X_text_list))
     )
-    train_index = [ind for ind in range(len(X_text_list)) if ind not in test_index]
+    test_index_set = set(test_index)
+    train_index = [ind for ind in range(len(X_text_list)) if ind not in test_index_set]
 
     X_text_list_train = [X_text_list[ind] for ind in train_index]
     X_text_list_test = [X_text_list[ind] for ind in test_index]
@@ -164,6 +198,56 @@ def tokenize_sentence(X_text_list_train, X_text_list_test, max_sent_len=800):
     return x_encoder, x_padded_train, x_padded_test
 
 
+def build_char_matrix(
+    X_text_list, x_char_encoder, max_sent_len=800, max_word_length=None, pad_word="<end>"
+):
+    """
+    Character ids of every word. Each unique word is encoded once into a lookup table
+    whose rows are then gathered into place
+    :param X_text_list: Text list
+    :param x_char_encoder: CharacterEncoder or Vocabulary
+    :param max_sent_len: defaults to 800
+    :param max_word_length: Characters kept per word, defaults to None i.e. longest word
+    :param pad_word: Word sentences are padded with, None for all zero padding. Defaults to <end>
+    :return: char id tensor of shape N, max_sent_len, max_word_length and max_word_length
+    """
+    # Row 0 of the lookup table is all zeros, pad_word is row 1
+    word_to_row = {} if pad_word is None else {pad_word: 1}
+    word_rows = np.full(
+        (len(X_text_list), max_sent_len), 0 if pad_word is None else 1, dtype=np.int64
+    )
+    for i, sentence in enumerate(X_text_list):
+        sentence = sentence[:max_sent_len]
+        word_rows[i, : len(sentence)] = [
+            word_to_row.setdefault(word, len(word_to_row) + 1) for word in sentence
+        ]
+
+    if hasattr(x_char_encoder, "encode_batch"):
+        # Vocabulary encodes all unique words in one call, one id per character
+        words = list(word_to_row.keys())
+        if max_word_length is None:
+            used = np.bincount(word_rows.ravel(), minlength=len(words) + 1)[1:] > 0
+            lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+            max_word_length = int(lengths[used].max(initial=0))
+        char_table = np.zeros((len(words) + 1, max_word_length), dtype=np.int64)
+        char_table[1:] = x_char_encoder.encode_batch(words, max_word_length).numpy()
+        return torch.from_numpy(char_table[word_rows]), max_word_length
+
+    encoded = [x_char_encoder.encode(word) for word in word_to_row.keys()]
+    if max_word_length is None:
+        used = np.bincount(word_rows.ravel(), minlength=len(encoded) + 1)[1:] > 0
+        max_word_length = max(
+            (len(chars) for chars, is_used in zip(encoded, used) if is_used), default=0
+        )
+
+    char_table = np.zeros((len(encoded) + 1, max_word_length), dtype=np.int64)
+    for row, chars in enumerate(encoded, start=1):
+        chars = chars[:max_word_length]
+        char_table[row, : len(chars)] = chars.numpy()
+
+    return torch.from_numpy(char_table[word_rows]), max_word_length
+
+
 def tokenize_character(X_text_list_train, X_text_list_test, max_sent_len=800):
     """
     Tokenizes characters at word level
@@ -172,69 +256,55 @@ def tokenize_character(X_text_list_train, X_text_list_test, max_sent_len=800):
     :param max_sent_len:
     :return: x_char_encoder, x_char_padded_train, x_char_padded_test, max_word_length
     """
-    X_text_list_train = [
-        lst[:max_sent_len] + (max_sent_len - len(lst)) * ["<end>"]
-        for lst in X_text_list_train
-    ]
-    X_text_list_test = [
-        lst[:max_sent_len] + (max_sent_len - len(lst)) * ["<end>"]
-        for lst in X_text_list_test
-    ]
-
     x_char_encoder = CharacterEncoder(
-        sample=[" ".join(sent) for sent in X_text_list_train], append_eos=False,
+        sample=[
+            " ".join(list(sent[:max_sent_len]) + (max_sent_len - len(sent)) * ["<end>"])
+            for sent in X_text_list_train
+        ],
+        append_eos=False,
     )
 
-    x_char_encoded_train = [
-        [x_char_encoder.encode(char) for char in word] for word in X_text_list_train
-    ]
-    x_char_encoded_test = [
-        [x_char_encoder.encode(char) for char in word] for word in X_text_list_test
-    ]
-
-    max_word_length = max(
-        [
-            max([internal.shape[0] for internal in external])
-            for external in x_char_encoded_train
-        ]
+    x_char_padded_train, max_word_length = build_char_matrix(
+        X_text_list_train, x_char_encoder, max_sent_len
+    )
+    x_char_padded_test, _ = build_char_matrix(
+        X_text_list_test, x_char_encoder, max_sent_len, max_word_length
     )
-
-    outer_list = []
-    for lst in x_char_encoded_train:
-        inner_list = []
-        for ten in lst:
-            res = torch.zeros(max_word_length, dtype=torch.long)
-            res[: ten.shape[0]] = ten[:max_word_length]
-            inner_list.append(res)
-        outer_list.append(inner_list)
-
-    x_char_padded_train = torch.stack([torch.stack(lst) for lst in outer_list])
-
-    outer_list = []
-    for lst in x_char_encoded_test:
-        inner_list = []
-        for ten in lst:
-            res = torch.zeros(max_word_length, dtype=torch.long)
-            res[: ten.shape[0]] = ten[:max_word_length]
-            inner_list.append(res)
-        outer_list.append(inner_list)
-
-    x_char_padded_test = torch.stack([torch.stack(lst) for lst in outer_list])
     return x_char_encoder, x_char_padded_train, x_char_padded_test, max_word_length
 
 
-def tokenize_pos_tags(X_tags, tag_to_index, max_sen_len=800):
+def tokenize_pos_tags(X_tags, tag_to_index, max_sen_len=800, one_hot=False):
     """
-    One hot encodes pos tags
+    Pads pos tag indices, 0 being <pad>
     :param X_tags:
     :param tag_to_index:
     :param max_sen_len:
-    :return: One hot encoded vector
+    :param one_hot: Return one hot encoded vector as used by older models, defaults to False
+    :return: Padded index tensor of shape N, max_sen_len
     """
-    return torch.nn.functional.one_hot(
-        torch.stack([pad_tensor(torch.LongTensor(lst), max_sen_len) for lst in X_tags]),
-        num_classes=max(tag_to_index.values()) + 1,
-    )
+    x_postag_padded = torch.zeros(len(X_tags), max_sen_len, dtype=torch.long)
+    for i, lst in enumerate(X_tags):
+        lst = lst[:max_sen_len]
+        x_postag_padded[i, : len(lst)] = torch.LongTensor(lst)
+
+    if one_hot:
+        return torch.nn.functional.one_hot(
+            x_postag_padded, num_classes=max(tag_to_index.values()) + 1,
+        )
+    return x_postag_padded
+
+
+def pos_input_for_model(model, x_postag_padded):
+    """
+    Models trained before pos tag embeddings take one hot pos tags of width
+    tag_embed_dim, index tensors are expanded for them
+    :param model: EntityExtraction
+    :param x_postag_padded: Padded pos tag indices
+    :return: pos tag input the model expects
+    """
+    if getattr(model, "pos_embed", None) is None and x_postag_padded.dim() == 2:
+        return torch.nn.functional.one_hot(x_postag_padded, num_classes=model.tag_embed_dim)
+    return x_postag_padded
 
 
 def encode_ner_y(y_ner_list_train, y_ner_list_test, class_count_dict, max_sent_len):
@@ -280,31 +350,6 @@ def encode_ner_y(y_ner_list_train, y_ner_list_test, class_count_dict, max_sent_l
     return y_ner_encoder, y_ner_padded_train, y_ner_padded_test
 
 
-def enrich_data(txt_list: list):
-    """
-    Generates enrichments features for each word in sequence
-    :param txt_list: Text list
-    :return: lists like alnum, numeric, alpha, digit, lower, title, ascii
-    """
-    alnum = []
-    numeric = []
-    alpha = []
-    digit = []
-    lower = []
-    title = []
-    ascii = []
-
-    for document in txt_list:
-        alnum.append([int(str(word).isalnum()) for word in document])
-        numeric.append([int(str(word).isnumeric()) for word in document])
-        alpha.append([int(str(word).isalpha()) for word in document])
-        digit.append([int(str(word).isdigit()) for word in document])
-        lower.append([int(str(word).islower()) for word in document])
-        title.append([int(str(word).istitle()) for word in document])
-        ascii.append([int(str(word).isascii()) for word in document])
-    return alnum, numeric, alpha, digit, lower, title, ascii
-
-
 # Sample weights
 def calculate_sample_weights(y_ner_padded_train):
     """
@@ -340,6 +385,128 @@ def pad_and_stack_list_of_list(
     return stacked
 
 
+class CharFeatureCache:
+    """
+    Bounded LRU cache of char CNN outputs keyed by a word's character ids. In eval mode
+    the char CNN is a pure function of the word. EntityExtraction clears it when switching
+    between train and eval mode and on load_state_dict, weights changed any other way
+    need an explicit clear()
+    """
+    def __init__(self, max_entries=100000):
+        """
+
+        :param max_entries: Words to keep, defaults to 100000
+        """
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def char_features(self, model, x_char_words):
+        """
+        Char CNN features, computing only words missing from the cache
+        :param model: EntityExtraction
+        :param x_char_words: Character features Words, Max Char Len
+        :return: Char features Words, CNN out dim
+        """
+        if x_char_words.size(0) == 0:
+            return model._char_cnn(x_char_words)
+
+        keys = [row.tobytes() for row in x_char_words.to("cpu").numpy()]
+        missing = [ind for ind, key in enumerate(keys) if key not in self.entries]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            with torch.no_grad():
+                computed = model._char_cnn(
+                    x_char_words.index_select(
+                        0, torch.LongTensor(missing).to(x_char_words.device)
+                    )
+                )
+            for ind, features in zip(missing, computed):
+                self.entries[keys[ind]] = features
+
+        for key in keys:
+            self.entries.move_to_end(key)
+        char_out = torch.stack([self.entries[key] for key in keys])
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return char_out
+
+    def prewarm(self, model, x_char_words, batch_size=4096):
+        """
+        Fills the cache, e.g. with the training vocabulary. Puts the model in eval mode
+        :param model: EntityExtraction
+        :param x_char_words: Character features Words, Max Char Len
+        :param batch_size: Words per char CNN call, defaults to 4096
+        :return:
+        """
+        hits, misses = self.hits, self.misses
+        model.eval()
+        x_char_words = torch.unique(x_char_words, dim=0)
+        for i in range(0, x_char_words.size(0), batch_size):
+            self.char_features(model, x_char_words[i: i + batch_size])
+        self.hits, self.misses = hits, misses
+
+    def stats(self):
+        """
+        :return: Dictionary of hits, misses, hit_rate and entries
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+        }
+
+
+def attach_char_cache(model, max_entries=100000, prewarm_words=None, x_char_encoder=None, max_word_length=None):
+    """
+    Attaches a CharFeatureCache to the model, models saved before the cache existed
+    are left as is
+    :param model: EntityExtraction
+    :param max_entries: defaults to 100000
+    :param prewarm_words: Words as is to prewarm with, e.g. the run's char_words vocabulary.
+                          Defaults to None
+    :param x_char_encoder: Needed to prewarm
+    :param max_word_length: Needed to prewarm
+    :return: CharFeatureCache or None
+    """
+    if not hasattr(model, "_char_features"):
+        return None
+
+    model.char_cache = CharFeatureCache(max_entries)
+    if prewarm_words:
+        x_char_words, _ = build_char_matrix(
+            [list(prewarm_words)], x_char_encoder, len(prewarm_words), max_word_length, pad_word=None
+        )
+        model.char_cache.prewarm(model, x_char_words[0].to(next(model.parameters()).device))
+    return model.char_cache
+
+
+def attach_transition_constraints(model, y_ner_encoder):
+    """
+    Restricts decoding of the model to valid BIO spans. Models saved before
+    crf_decoding decode without them, their list output has to be decoded again
+    :param model: EntityExtraction
+    :param y_ner_encoder:
+    :return: TransitionConstraints
+    """
+    model.transition_constraints = bio_constraints(y_ner_encoder.index_to_token)
+    return model.transition_constraints
+
+
+# Forward compute modes
+LOSS = "loss"  # CRF loss only, for backward
+DECODE = "decode"  # Viterbi decoded tags only
+DECODE_LOSS = "decode_loss"  # Both, loss against decoded tags when y is not given
+
+
 # Model defintion
 # Build Model
 class EntityExtraction(nn.Module):
@@ -354,16 +521,22 @@ class EntityExtraction(nn.Module):
         rnn_bidirectional=True,
         word_embed_dim=256,
         tag_embed_dim=36,
+        num_pos_tags=None,
         char_embed_dim=124,
         rnn_type="LSTM",
         rnn_embed_dim=512,
         enrich_dim=7,
+        token_feature_dims=None,
         char_embedding=True,
         char_cnn_out_dim=32,
         dropout_ratio=0.3,
         class_weights=None,
         word_embedding_weights=None,
         word_embedding_freeze=True,
+        pack_sequences=False,
+        char_dedup=True,
+        word_vocab_size=None,
+        char_vocab_size=None,
     ):
         """
 
@@ -372,17 +545,25 @@ class EntityExtraction(nn.Module):
         :param rnn_stack_size:
         :param rnn_bidirectional:
         :param word_embed_dim:
-        :param tag_embed_dim:
+        :param tag_embed_dim: pos tag embedding dim, one hot width if num_pos_tags is None
+        :param num_pos_tags: Size of pos tag index. None for one hot pos tag input
         :param char_embed_dim:
         :param rnn_type:
         :param rnn_embed_dim:
-        :param enrich_dim:
+        :param enrich_dim: Float token feature dim, ignored if token_feature_dims is given
+        :param token_feature_dims: (bool, ratio) feature counts of bit-packed token
+                                   features. None for float token feature input
         :param char_embedding:
         :param char_cnn_out_dim:
         :param dropout_ratio:
         :param class_weights:
         :param word_embedding_weights:
         :param word_embedding_freeze:
+        :param pack_sequences: Run the RNN on packed sequences, skipping padding, in training
+                               and eval. Defaults to False
+        :param char_dedup: Run the char CNN once per unique word of a batch. Defaults to True
+        :param word_vocab_size: defaults to None i.e. x_encoder.vocab_size
+        :param char_vocab_size: defaults to None i.e. x_char_encoder.vocab_size
         """
         super().__init__()
         # self variables
@@ -390,33 +571,49 @@ class EntityExtraction(nn.Module):
         self.char_embed_dim = char_embed_dim
         self.char_cnn_out_dim = char_cnn_out_dim
         self.rnn_embed_dim = rnn_embed_dim
-        self.enrich_dim = enrich_dim
+        self.token_feature_dims = token_feature_dims
+        self.enrich_dim = sum(token_feature_dims) if token_feature_dims else enrich_dim
         self.dropout_ratio = dropout_ratio
         self.rnn_hidden_size = rnn_hidden_size
         self.rnn_stack_size = rnn_stack_size
         self.rnn_bidirectional = rnn_bidirectional
         self.class_weights = torch.FloatTensor(class_weights).to(device)
         self.tag_embed_dim = tag_embed_dim
+        self.num_pos_tags = num_pos_tags
         self.word_embedding_weights = word_embedding_weights
         self.word_embedding_freeze = word_embedding_freeze
+        self.pack_sequences = pack_sequences
+        self.char_dedup = char_dedup
         if self.word_embedding_weights is None:
             self.word_embed_dim = word_embed_dim
         else:
             self.word_embed_dim = word_embedding_weights.size(-1)
         # Embedding Layers
-        self.word_embed = nn.Embedding(
-            num_embeddings=x_encoder.vocab_size, embedding_dim=self.word_embed_dim
-        )
-        if self.word_embedding_weights is not None:
-            self.word_embed = self.word_embed.from_pretrained(
+        if self.word_embedding_weights is None:
+            self.word_embed = nn.Embedding(
+                num_embeddings=word_vocab_size if word_vocab_size is not None else x_encoder.vocab_size,
+                embedding_dim=self.word_embed_dim,
+            )
+        else:
+            self.word_embed = nn.Embedding.from_pretrained(
                 embeddings=self.word_embedding_weights,
                 freeze=self.word_embedding_freeze,
             )
 
         self.word_embed_drop = nn.Dropout(self.dropout_ratio)
 
+        if self.num_pos_tags is not None:
+            self.pos_embed = nn.Embedding(
+                num_embeddings=self.num_pos_tags,
+                embedding_dim=self.tag_embed_dim,
+                padding_idx=0,
+            )
+        else:
+            self.pos_embed = None
+
         self.char_embed = nn.Embedding(
-            num_embeddings=x_char_encoder.vocab_size, embedding_dim=self.char_embed_dim
+            num_embeddings=char_vocab_size if char_vocab_size is not None else x_char_encoder.vocab_size,
+            embedding_dim=self.char_embed_dim,
         )
         self.char_embed_drop = nn.Dropout(self.dropout_ratio)
 
@@ -458,47 +655,121 @@ class EntityExtraction(nn.Module):
         )  # +1 for padding 0
         self.crf = CRF(self.num_classes + 1, batch_first=True)
 
-    def forward(self, x_word, x_pos, x_char, x_enrich, mask, y_word=None, train=True):
+    def _char_cnn(self, x_char_words):
+        """
+        Character CNN for a flat batch of words
+        :param x_char_words: Character features Words, Max Char Len
+        :return: Char features Words, CNN out dim
+        """
+        char_out = self.char_embed(x_char_words)
+        char_out = self.char_embed_drop(
+            char_out
+        )  # Shape - Words, Max Char Len, Embedding dim
+        char_out = char_out.contiguous().view(
+            char_out.size(0), char_out.size(2), char_out.size(1)
+        )  # Shape - Words, Embedding dim, Max Char Len
+        char_out = self.char_cnn(char_out)  # Shape - Words, CNN out dim, Max Char Len
+        return F.max_pool1d(char_out, kernel_size=char_out.size(-1)).squeeze(
+            -1
+        )  # Shape - Words, CNN out dim
+
+    def _char_features(self, x_char, mask):
+        """
+        Character CNN features of the words in mask, padded words are left as zeros.
+        With char_dedup repeated words of the batch go through the CNN once, in eval
+        mode a char_cache attached to the model is used when set
+        :param x_char: Padded character features N, Max Sen Len, Max Char Len
+        :param mask: mask for padded values
+        :return: Char features N, Max Sen Len, CNN out dim
+        """
+        batch_size, max_sen_len = x_char.shape[:2]
+        positions = torch.nonzero(mask.reshape(-1), as_tuple=True)[0]
+        x_char = x_char.reshape(batch_size * max_sen_len, -1).index_select(0, positions)
+
+        char_cache = getattr(self, "char_cache", None)
+        dedup = getattr(self, "char_dedup", False) or char_cache is not None
+        if dedup:
+            x_char, word_index = torch.unique(x_char, dim=0, return_inverse=True)
+
+        if char_cache is not None and not self.training:
+            char_out = char_cache.char_features(self, x_char)
+        else:
+            char_out = self._char_cnn(x_char)
+
+        if dedup:
+            char_out = char_out.index_select(0, word_index)
+
+        return (
+            char_out.new_zeros(batch_size * max_sen_len, char_out.size(-1))
+            .index_copy(0, positions, char_out)
+            .view(batch_size, max_sen_len, -1)
+        )
+
+    def train(self, mode=True):
+        # Weights only change in training mode, cached char features are stale after it
+        char_cache = getattr(self, "char_cache", None)
+        if char_cache is not None and mode != self.training:
+            char_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        char_cache = getattr(self, "char_cache", None)
+        if char_cache is not None:
+            char_cache.clear()
+        return super().load_state_dict(state_dict, strict)
+
+    def forward(self, x_word, x_pos, x_char, x_enrich, mask, y_word=None, train=True, mode=DECODE_LOSS):
         """
 
         :param x_word: Padded word sequence
-        :param x_pos: Padded pos tag features
+        :param x_pos: Padded pos tag indices, or one hot pos tags for one hot models
         :param x_char: One hot encoded character features for each word
-        :param x_enrich: Binary enriched features for each word
+        :param x_enrich: Bit-packed token features, float features for models
+                         without token_feature_dims
         :param mask: mask for padded values
         :param y_word: y only for training step
-        :param train: True is training step
-        :return: emmission matrix, decoded sequence, crf loss
+        :param train: True is training step, the loss is against y_word. Otherwise
+                      against the decoded sequence
+        :param mode: LOSS, DECODE or DECODE_LOSS, defaults to DECODE_LOSS
+        :return: emmission matrix, decoded tags N, L with 0 for padding (None for LOSS),
+                 crf loss (None for DECODE)
         """
-        x_char_shape = x_char.shape
-        batch_size = x_char_shape[0]
+        if mode not in (LOSS, DECODE, DECODE_LOSS):
+            raise ValueError(f"Unknown mode {mode}, expected one of {LOSS}, {DECODE}, {DECODE_LOSS}")
+        if mode == LOSS and not (train and y_word is not None):
+            raise ValueError(f"Mode {LOSS} needs y_word and train=True")
 
         word_out = self.word_embed(x_word)
         word_out = self.word_embed_drop(word_out)
 
-        char_out = self.char_embed(x_char)
-        char_out = self.char_embed_drop(
-            char_out
-        )  # Shape - N, Max Sen Len, Max Char Len, Embedding dim
-        char_out = char_out.contiguous().view(
-            char_out.size(0) * char_out.size(1), char_out.size(3), char_out.size(2)
-        )  # Shape - N*Max Sen Len, Embedding dim, Max Char Len,
-        char_out = self.char_cnn(
-            char_out
-        )  # Shape - N*Max Sen Len, CNN out dim, Max Char Len
-        char_out_shape = char_out.shape
-        char_out = F.max_pool1d(char_out, kernel_size=char_out_shape[-1]).squeeze(
-            -1
-        )  # Shape - N*Max Sen Len, Max Char Len
-        char_out = char_out.contiguous().view(
-            batch_size, -1, char_out.size(-1)
-        )  # Shape - N, Max Sen Len, Max Char Len
+        char_out = self._char_features(x_char, mask)  # Shape - N, Max Sen Len, CNN out dim
+
+        x_pos = pos_input_for_model(self, x_pos)
+        # Models pickled before pos tag embeddings have no pos_embed
+        if getattr(self, "pos_embed", None) is not None:
+            tag_out = self.pos_embed(x_pos)
+        else:
+            tag_out = x_pos.type(word_out.dtype)
+
+        if getattr(self, "token_feature_dims", None) is not None:
+            x_enrich = unpack_token_features(x_enrich, *self.token_feature_dims, mask=mask)
 
-        # concat = torch.cat((word_out, char_out, tag_out), dim=2)
-        concat = torch.cat((word_out, x_pos, char_out, x_enrich), dim=2)
+        concat = torch.cat(
+            (word_out, tag_out, char_out, x_enrich.type(word_out.dtype)), dim=2
+        )
         concat = F.relu(concat)
-        # NER LSTM
-        ner_lstm_out, _ = self.lstm_ner(concat)
+        # NER LSTM, packed so that padding is skipped. Same path in training and eval, models
+        # pickled before pack_sequences ran padded
+        if getattr(self, "pack_sequences", False):
+            lengths = mask.sum(dim=1).clamp(min=1).to("cpu")
+            ner_lstm_out, _ = self.lstm_ner(
+                pack_padded_sequence(concat, lengths, batch_first=True, enforce_sorted=False)
+            )
+            ner_lstm_out, _ = pad_packed_sequence(
+                ner_lstm_out, batch_first=True, total_length=concat.size(1)
+            )
+        else:
+            ner_lstm_out, _ = self.lstm_ner(concat)
         ner_lstm_out = self.lstm_ner_drop(ner_lstm_out)
 
         # Linear
@@ -511,20 +782,23 @@ class EntityExtraction(nn.Module):
         # if self.class_weights is not None:
         #    ner_out = ner_out * self.class_weights
 
-        crf_out_decoded = self.crf.decode(ner_out)
+        crf_out_decoded = None
+        if mode != LOSS:
+            crf_out_decoded, _ = crf_viterbi_decode(
+                self.crf, ner_out, mask, constraints=getattr(self, "transition_constraints", None)
+            )
 
-        if train:
+        crf_out = None
+        if mode != DECODE:
+            tags = y_word if train else crf_out_decoded
             crf_out = -1 * self.crf(
-                emissions=ner_out, tags=y_word, mask=mask, reduction="token_mean"
+                emissions=ner_out, tags=tags, mask=mask, reduction="token_mean"
             )
-        else:
-            crf_out = -1 * self.crf(emissions=ner_out, tags=torch.LongTensor(crf_out_decoded), mask=mask, reduction="token_mean"
-                               )
         return ner_out, crf_out_decoded, crf_out
 
     def predict(self, x_word, x_pos, x_char, x_enrich, mask):
         self.eval()
-        return self(x_word, x_pos, x_char, x_enrich, mask, train=False)
+        return self(x_word, x_pos, x_char, x_enrich, mask, train=False, mode=DECODE)
 
 
 def git_commit_push(commit_message, add=True, push=False):
@@ -554,11 +828,263 @@ def trim_list_of_lists_upto_max_len(lst_of_lst, max_len):
     :param max_len:
     :return: Trimmed list of list
     """
-    if isinstance(lst_of_lst, list):
+    if isinstance(lst_of_lst, Sequence) and not isinstance(lst_of_lst, str):
         return [lst[:max_len] for lst in lst_of_lst]
     return None
 
 
+def featurize_dataset(args):
+    """
+    Loads data, featurizes it and splits it in test and train
+    :param args: Parsed training arguments
+    :return: tensors dictionary, objects dictionary (encoders and metadata)
+    """
+    # Load Data
+    X_text_list_as_is, X_text_list, y_ner_list = load_data(args.DATA_PATH)
+    data_size = len(X_text_list)
+
+    # Get POS tags
+    pos_cache = POSTagCache(args.POS_CACHE_PATH) if args.POS_CACHE_PATH else None
+    X_tags, tag_to_index = get_POS_tags(X_text_list, cache=pos_cache)
+    if pos_cache is not None:
+        print(f"POS cache - {pos_cache.stats()}")
+        pos_cache.close()
+
+    # SENTENCE_LEN_LIST = [len(sentence) for sentence in X_text_list]
+
+    X_text_list = trim_list_of_lists_upto_max_len(
+        X_text_list, args.MAX_SENTENCE_LEN
+    )
+    X_text_list_as_is = trim_list_of_lists_upto_max_len(
+        X_text_list_as_is, args.MAX_SENTENCE_LEN
+    )
+    y_ner_list = trim_list_of_lists_upto_max_len(y_ner_list, args.MAX_SENTENCE_LEN)
+    X_tags = trim_list_of_lists_upto_max_len(X_tags, args.MAX_SENTENCE_LEN)
+    print(
+        f"Max sentence len after trimming upto {args.MAX_SENTENCE_LEN} words is {max([len(sentence) for sentence in X_text_list])}"
+    )
+
+    x_enriched_features = TokenFeatureSpec(args.TOKEN_FEATURES).featurize(
+        X_text_list_as_is, max_sentence_len=args.MAX_SENTENCE_LEN
+    )
+
+    # Split data in test and train plus return segregate as input lists
+
+    (
+        (X_text_list_train, X_text_list_test),
+        (X_text_list_as_is_train, X_text_list_as_is_test),
+        (X_tags_train, X_tags_test),
+        (x_enriched_features_train, x_enriched_features_test),
+        (y_ner_list_train, y_ner_list_test),
+        (train_index, test_index),
+    ) = split_test_train(
+        X_text_list,
+        X_text_list_as_is,
+        X_tags,
+        x_enriched_features,
+        y_ner_list,
+        split_size=args.TEST_SPLIT,
+        seed=args.SPLIT_SEED,
+    )
+
+    # Set some important parameters values
+    all_labels = []
+    _ = [[all_labels.append(label) for label in lst] for lst in y_ner_list_train]
+    class_count_out = np.unique(all_labels, return_counts=True)
+    class_count_dict = dict(zip(class_count_out[0], class_count_out[1]))
+
+    # Tokenize Sentences
+    x_encoder, x_padded_train, x_padded_test = tokenize_sentence(
+        X_text_list_train, X_text_list_test, args.MAX_SENTENCE_LEN
+    )
+
+    # Tokenize Characters
+    (
+        x_char_encoder,
+        x_char_padded_train,
+        x_char_padded_test,
+        max_word_length,
+    ) = tokenize_character(
+        X_text_list_as_is_train, X_text_list_as_is_test, args.MAX_SENTENCE_LEN
+    )
+
+    # Tokenize Pos tags
+    x_postag_padded_train = tokenize_pos_tags(
+        X_tags_train, tag_to_index=tag_to_index, max_sen_len=args.MAX_SENTENCE_LEN
+    )
+    x_postag_padded_test = tokenize_pos_tags(
+        X_tags_test, tag_to_index=tag_to_index, max_sen_len=args.MAX_SENTENCE_LEN
+    )
+
+    # Encode y NER
+    y_ner_encoder, y_ner_padded_train, y_ner_padded_test = encode_ner_y(
+        y_ner_list_train, y_ner_list_test, class_count_dict, args.MAX_SENTENCE_LEN
+    )
+
+    tensors = {
+        "x_padded_train": x_padded_train,
+        "x_padded_test": x_padded_test,
+        "x_char_padded_train": x_char_padded_train,
+        "x_char_padded_test": x_char_padded_test,
+        "x_postag_padded_train": x_postag_padded_train,
+        "x_postag_padded_test": x_postag_padded_test,
+        "x_enriched_features_train": x_enriched_features_train,
+        "x_enriched_features_test": x_enriched_features_test,
+        "y_ner_padded_train": y_ner_padded_train,
+        "y_ner_padded_test": y_ner_padded_test,
+    }
+    objects = {
+        "x_encoder": x_encoder,
+        "x_char_encoder": x_char_encoder,
+        "y_ner_encoder": y_ner_encoder,
+        "tag_to_index": tag_to_index,
+        "class_count_dict": class_count_dict,
+        "max_word_length": max_word_length,
+        # Words as is, the char CNN input, to prewarm the inference char cache with
+        "char_words": list(dict.fromkeys(word for doc in X_text_list_as_is_train for word in doc)),
+        "test_index": test_index,
+        "data_size": data_size,
+    }
+    return tensors, objects
+
+
+def feature_cache_settings(args):
+    """
+    Settings that change featurization output, used as part of the feature cache key
+    :param args: Parsed training arguments
+    :return: Dictionary of settings
+    """
+    return {
+        "MAX_SENTENCE_LEN": args.MAX_SENTENCE_LEN,
+        "TEST_SPLIT": args.TEST_SPLIT,
+        "SPLIT_SEED": args.SPLIT_SEED,
+        "X_ENCODER": {"class": StaticTokenizerEncoder.__name__, "append_eos": False},
+        "X_CHAR_ENCODER": {"class": CharacterEncoder.__name__, "append_eos": False},
+        "Y_NER_ENCODER": {"class": LabelEncoder.__name__},
+        "POS_TAGGER": f"nltk-{nltk.__version__}",
+        "TOKEN_FEATURES": list(args.TOKEN_FEATURES),
+    }
+
+
+def build_dataloaders(args, artifacts_dir):
+    """
+    Featurizes data in memory, or loads it from the feature cache, and builds train
+    and test dataloaders
+    :param args: Parsed training arguments
+    :param artifacts_dir: Directory to save encoders to
+    :return: Dictionary of dataloaders, encoders and model dimensions
+    """
+    if args.FEATURE_CACHE_DIR:
+        feature_store = FeatureStore(args.FEATURE_CACHE_DIR)
+        cache_key = feature_cache_key(args.DATA_PATH, feature_cache_settings(args))
+        mlflow.log_param("FEATURE_CACHE_KEY", cache_key)
+        if feature_store.exists(cache_key):
+            print(f"Feature cache hit - {cache_key}")
+            mlflow.set_tag("Feature Cache", "hit")
+            tensors, objects = feature_store.load(cache_key)
+        else:
+            print(f"Feature cache miss - {cache_key}")
+            mlflow.set_tag("Feature Cache", "miss")
+            tensors, objects = featurize_dataset(args)
+            feature_store.save(cache_key, tensors, objects)
+    else:
+        tensors, objects = featurize_dataset(args)
+
+    x_encoder = objects["x_encoder"]
+    x_char_encoder = objects["x_char_encoder"]
+    y_ner_encoder = objects["y_ner_encoder"]
+    tag_to_index = objects["tag_to_index"]
+    class_count_dict = objects["class_count_dict"]
+
+    for name in ("tag_to_index", "x_encoder", "x_char_encoder", "y_ner_encoder"):
+        with open(os.path.join(artifacts_dir, name), "wb") as inf:
+            dill.dump(objects[name], inf)
+    save_run_vocabularies(artifacts_dir, objects, tag_to_index)
+
+    token_feature_spec = TokenFeatureSpec(args.TOKEN_FEATURES)
+    token_feature_spec.save(artifacts_dir)
+
+    num_pos_tags = max(tag_to_index.values()) + 1
+    ENRICH_FEAT_DIM = token_feature_spec.feature_dim
+    num_classes = len([clas for clas in class_count_dict.keys()])
+    y_o_index = y_ner_encoder.token_to_index['O']
+    print(
+        f"Max sentence length - {args.MAX_SENTENCE_LEN}, Total Classes = {num_classes}"
+    )
+
+    mlflow.log_param("DATA_SIZE", objects["data_size"])
+    mlflow.log_param("NUM_POS_TAGS", num_pos_tags)
+    mlflow.log_param("TEST_INDEX", str(objects["test_index"]))
+    mlflow.log_param("MAX_SENTENCE_LEN", args.MAX_SENTENCE_LEN)
+    mlflow.log_param("NUM_CLASSES", num_classes)
+    mlflow.log_param("ENRICH_FEAT_DIM", ENRICH_FEAT_DIM)
+    mlflow.log_param("TOKEN_FEATURES", ",".join(token_feature_spec.feature_order))
+    mlflow.log_param("MAX_WORD_LENGTH", objects["max_word_length"])
+    mlflow.log_param("Y_O_INDEX", y_o_index)
+
+    # Create train dataloader
+    dataset_train = Dataset(
+        [
+            {
+                "x_padded": tensors["x_padded_train"][i],
+                "x_char_padded": tensors["x_char_padded_train"][i],
+                "x_postag_padded": tensors["x_postag_padded_train"][i],
+                "x_enriched_features": tensors["x_enriched_features_train"][i],
+                "y_ner_padded": tensors["y_ner_padded_train"][i],
+            }
+            for i in range(tensors["x_padded_train"].shape[0])
+        ]
+    )
+
+    # Batches are drawn from length buckets and padded only to their longest document
+    dataloader_train = DataLoader(
+        dataset=dataset_train,
+        batch_sampler=BucketBatchSampler(
+            document_lengths(tensors["x_padded_train"]), args.BATCH_SIZE, shuffle=True
+        ),
+        collate_fn=trim_collate,
+    )
+
+    # Create test dataloader
+    dataset_test = Dataset(
+        [
+            {
+                "x_padded": tensors["x_padded_test"][i],
+                "x_char_padded": tensors["x_char_padded_test"][i],
+                "x_postag_padded": tensors["x_postag_padded_test"][i],
+                "x_enriched_features": tensors["x_enriched_features_test"][i],
+                "y_ner_padded": tensors["y_ner_padded_test"][i],
+            }
+            for i in range(tensors["x_padded_test"].shape[0])
+        ]
+    )
+
+    dataloader_test = DataLoader(
+        dataset=dataset_test,
+        batch_sampler=BucketBatchSampler(
+            document_lengths(tensors["x_padded_test"]), args.BATCH_SIZE, shuffle=False
+        ),
+        collate_fn=trim_collate,
+    )
+
+    ner_class_weights = calculate_sample_weights(tensors["y_ner_padded_train"])
+
+    return {
+        "dataloader_train": dataloader_train,
+        "dataloader_test": dataloader_test,
+        "ner_class_weights": ner_class_weights,
+        "num_classes": num_classes,
+        "y_o_index": y_o_index,
+        "num_pos_tags": num_pos_tags,
+        "enrich_feat_dim": ENRICH_FEAT_DIM,
+        "token_feature_dims": (
+            len(token_feature_spec.bool_names), len(token_feature_spec.ratio_names)
+        ),
+        "x_encoder": x_encoder,
+        "x_char_encoder": x_char_encoder,
+    }
+
+
 class ClassificationModelUtils:
     """
 
@@ -578,10 +1104,14 @@ class ClassificationModelUtils:
         learning_rate=0.001,
         word_embed_dim=256,
         postag_embed_dim=36,
+        num_pos_tags=None,
         char_cnn_out_dim=32,
         enrich_dim=7,
+        token_feature_dims=None,
         word_embedding_weights=None,
         word_embedding_freeze=True,
+        pack_sequences=False,
+        char_dedup=True,
     ):
         """
 
@@ -598,10 +1128,14 @@ class ClassificationModelUtils:
         :param learning_rate:
         :param word_embed_dim:
         :param postag_embed_dim:
+        :param num_pos_tags: Size of pos tag index, None for one hot pos tags
         :param char_cnn_out_dim:
         :param enrich_dim:
+        :param token_feature_dims: (bool, ratio) counts of bit-packed token features
         :param word_embedding_weights:
         :param word_embedding_freeze:
+        :param pack_sequences: Run the RNN on packed sequences, defaults to False
+        :param char_dedup: Run the char CNN once per unique word of a batch, defaults to True
         """
         if cuda:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -627,10 +1161,14 @@ class ClassificationModelUtils:
             word_embed_dim=word_embed_dim,
             class_weights=self.ner_class_weights,
             tag_embed_dim=postag_embed_dim,
+            num_pos_tags=num_pos_tags,
             enrich_dim=enrich_dim,
+            token_feature_dims=token_feature_dims,
             char_cnn_out_dim=char_cnn_out_dim,
             word_embedding_weights=word_embedding_weights,
             word_embedding_freeze=word_embedding_freeze,
+            pack_sequences=pack_sequences,
+            char_dedup=char_dedup,
         )
         self.model = self.model.to(self.device)
         self.criterion_crossentropy = nn.CrossEntropyLoss(
@@ -646,6 +1184,7 @@ class ClassificationModelUtils:
         self.epoch_ner_recall = []
         self.epoch_ner_precision = []
         self.epoch_ner_f1s = []
+        self.epoch_step_times = []
 
         # Test metric result holders
         self.test_epoch_loss = []
@@ -766,14 +1305,16 @@ class ClassificationModelUtils:
                 test_losses.append(test_loss.item())
 
                 # Evaluation Metrics
-                test_ner_out_result = np.ravel(np.array(test_crf_out))
+                test_ner_out_result = torch.flatten(test_crf_out).to("cpu").numpy()
                 test_ner_truth_result = (
                     torch.flatten(data_test["y_ner_padded"]).to("cpu").numpy()
                 )
 
                 _ = [
                     self.test_epoch_prediction_all.append(out)
-                    for out in test_ner_out_result
+                    for out in np.where(
+                        test_ner_out_result == 0, self.y_o_index, test_ner_out_result
+                    )
                 ]
                 _ = [
                     self.test_epoch_truth_all.append(out)
@@ -811,13 +1352,17 @@ class ClassificationModelUtils:
             + f"Validation F1 - {self.test_epoch_ner_f1s[-1]:.2f}"
         )
 
-    def train(self, num_epochs=10):
+    def train(self, num_epochs=10, metric_every=1):
         """
         Runs training step
         :param num_epochs: defaults to 10
+        :param metric_every: Decode every metric_every-th batch for train metrics, other
+                             batches compute the CRF loss only. Defaults to 1
         :return:
         """
-        index_metric_append = int(len(dataloader_train) / 3)
+        if metric_every < 1:
+            raise ValueError(f"metric_every must be at least 1, got {metric_every}")
+        index_metric_append = max(int(len(self.dataloader_train) / 3), 1)
 
         for epoch in range(num_epochs):
             self.model.train()
@@ -833,8 +1378,11 @@ class ClassificationModelUtils:
 
             self.epoch_prediction_all = []
             self.epoch_truth_all = []
+            step_times = []
 
-            for batch_num, data in enumerate(dataloader_train):
+            for batch_num, data in enumerate(self.dataloader_train):
+                step_start = time.perf_counter()
+                decode = batch_num % metric_every == 0
                 self.optimizer.zero_grad()
                 self.crf_weights.append(
                     self.model.crf.state_dict()["transitions"].to("cpu").numpy()
@@ -860,42 +1408,51 @@ class ClassificationModelUtils:
                     data["x_enriched_features"],
                     mask,
                     data["y_ner_padded"],
+                    mode=DECODE_LOSS if decode else LOSS,
                 )
 
                 # Loss
                 # loss = self.criterion_crossentropy(ner_out.transpose(2, 1), data['y_ner_padded'])
                 batch_losses.append(loss.item())
 
-                # Evaluation Metric
-                test_ner_out_result = np.ravel(np.array(crf_out))
-                # test_ner_out_result = torch.flatten(torch.argmax(ner_out, dim=2)).to('cpu').numpy()
-                test_ner_truth_result = (
-                    torch.flatten(data["y_ner_padded"]).to("cpu").numpy()
-                )
-
-                _ = [
-                    self.epoch_prediction_all.append(out) for out in test_ner_out_result
-                ]
-                _ = [
-                    self.epoch_truth_all.append(out)
-                    for out in np.where(
-                        test_ner_truth_result == 0, self.y_o_index, test_ner_truth_result
+                loss.backward()
+                self.optimizer.step()
+                step_times.append(time.perf_counter() - step_start)
+
+                if decode:
+                    # Evaluation Metric, on decoded batches only
+                    test_ner_out_result = torch.flatten(crf_out).to("cpu").numpy()
+                    # test_ner_out_result = torch.flatten(torch.argmax(ner_out, dim=2)).to('cpu').numpy()
+                    test_ner_truth_result = (
+                        torch.flatten(data["y_ner_padded"]).to("cpu").numpy()
                     )
-                ]
 
-                (
-                    ner_accuracy,
-                    ner_precision,
-                    ner_recall,
-                    ner_f1,
-                ) = self.evaluate_classification_metrics(
-                    self.epoch_truth_all, self.epoch_prediction_all
-                )
+                    _ = [
+                        self.epoch_prediction_all.append(out)
+                        for out in np.where(
+                            test_ner_out_result == 0, self.y_o_index, test_ner_out_result
+                        )
+                    ]
+                    _ = [
+                        self.epoch_truth_all.append(out)
+                        for out in np.where(
+                            test_ner_truth_result == 0, self.y_o_index, test_ner_truth_result
+                        )
+                    ]
+
+                    (
+                        ner_accuracy,
+                        ner_precision,
+                        ner_recall,
+                        ner_f1,
+                    ) = self.evaluate_classification_metrics(
+                        self.epoch_truth_all, self.epoch_prediction_all
+                    )
 
-                batch_ner_accuracy.append(ner_accuracy)
-                batch_ner_precisions.append(ner_precision)
-                batch_ner_recalls.append(ner_recall)
-                batch_ner_f1s.append(ner_f1)
+                    batch_ner_accuracy.append(ner_accuracy)
+                    batch_ner_precisions.append(ner_precision)
+                    batch_ner_recalls.append(ner_recall)
+                    batch_ner_f1s.append(ner_f1)
 
                 if batch_num % index_metric_append == 0 and batch_num != 0:
                     print(
@@ -907,10 +1464,9 @@ class ClassificationModelUtils:
                         + f"F1 - {ner_f1:.2f}"
                     )
 
-                loss.backward()
-                self.optimizer.step()
-
             self.epoch_losses.append(np.array(batch_losses).mean())
+            self.epoch_step_times.append(np.array(step_times).mean())
+            print(f"--> Mean step time - {self.epoch_step_times[-1]:.3f}s")
 
             self.epoch_ner_accuracy.append(ner_accuracy)
             self.epoch_ner_precision.append(ner_precision)
@@ -933,7 +1489,7 @@ if __name__ == "__main__":
         dest="DATA_PATH",
         default=config['data_path'],
         type=str,
-        help="Data file path - pickle format",
+        help="Data file path - pickle format, columnar dataset directory or directory of columnar shards",
     )
     parser.add_argument(
         "--comment",
@@ -1024,6 +1580,22 @@ if __name__ == "__main__":
         help="Word embedding dimension. Ignore if providing a pre-trained word embedding",
     )
 
+    parser.add_argument(
+        "--postag-embed-dim",
+        dest="POSTAG_EMBED_DIM",
+        default=config.get('postag_embed_dim', 36),
+        type=int,
+        help="POS tag embedding dimension",
+    )
+
+    parser.add_argument(
+        "--token-features",
+        dest="TOKEN_FEATURES",
+        default=config.get('token_features', ",".join(DEFAULT_FEATURES)),
+        type=lambda value: tuple(name.strip() for name in value.split(",") if name.strip()),
+        help="Comma separated registered token features, see token_features.py",
+    )
+
     parser.add_argument(
         "--char-cnn-out-dim",
         dest="CHAR_CNN_OUT_DIM",
@@ -1048,7 +1620,97 @@ if __name__ == "__main__":
         help="LSTM hidden size",
     )
 
+    parser.add_argument(
+        "--pack-sequences",
+        dest="PACK_SEQUENCES",
+        default=ast.literal_eval(str(config.get('pack_sequences', None))),
+        action="store_true",
+        help="Run the RNN over packed instead of padded sequences, saved with the model and used "
+             "for predictions too. Defaults to packed when streaming and padded otherwise, as length "
+             "bucketed batches have little padding",
+    )
+
+    parser.add_argument(
+        "--no-pack-sequences",
+        dest="PACK_SEQUENCES",
+        default=ast.literal_eval(str(config.get('pack_sequences', None))),
+        action="store_false",
+        help="Run the RNN over padded instead of packed sequences",
+    )
+
+    parser.add_argument(
+        "--no-char-dedup",
+        dest="CHAR_DEDUP",
+        default=ast.literal_eval(str(config.get('char_dedup', True))),
+        action="store_false",
+        help="Run the char CNN for every word instead of once per unique word of a batch",
+    )
+
+    parser.add_argument(
+        "--metric-every",
+        dest="METRIC_EVERY",
+        default=config.get('metric_every', 10),
+        type=int,
+        help="Decode every n-th training batch for train metrics, other batches compute the loss only. "
+             "Must be at least 1",
+    )
+
+    parser.add_argument(
+        "--streaming",
+        dest="STREAMING",
+        default=ast.literal_eval(str(config.get('streaming', False))),
+        action="store_true",
+        help="Stream documents from columnar shards at --data-path instead of loading "
+             "the whole corpus in memory",
+    )
+
+    parser.add_argument(
+        "--no-streaming",
+        dest="STREAMING",
+        default=ast.literal_eval(str(config.get('streaming', False))),
+        action="store_false",
+        help="Load the whole corpus in memory, overrides streaming: True in the config file",
+    )
+
+    parser.add_argument(
+        "--num-workers",
+        dest="NUM_WORKERS",
+        default=config.get('num_workers', 2),
+        type=int,
+        help="DataLoader worker processes featurizing documents in streaming mode",
+    )
+
+    parser.add_argument(
+        "--split-seed",
+        dest="SPLIT_SEED",
+        default=config.get('split_seed', 0),
+        type=int,
+        help="Seed for test train split",
+    )
+
+    parser.add_argument(
+        "--feature-cache-dir",
+        dest="FEATURE_CACHE_DIR",
+        default=config.get('feature_cache_dir', 'data/feature_cache'),
+        type=str,
+        help="Directory to cache featurized tensors in, pass '' to disable caching",
+    )
+
+    parser.add_argument(
+        "--pos-cache-path",
+        dest="POS_CACHE_PATH",
+        default=config.get('pos_cache_path', 'data/pos_cache.sqlite'),
+        type=str,
+        help="SQLite POS tag cache file, pass '' to disable",
+    )
+
     args = parser.parse_args()
+    if args.METRIC_EVERY < 1:
+        parser.error(f"--metric-every must be at least 1, got {args.METRIC_EVERY}")
+    if args.PACK_SEQUENCES is None:
+        # Packed CPU kernels cost more than the little padding of length bucketed batches,
+        # streaming batches are not bucketed
+        args.PACK_SEQUENCES = args.STREAMING
 
     mlflow.set_experiment(args.EXPERIMENT_NAME)
     experiment = mlflow.get_experiment_by_name(args.EXPERIMENT_NAME)
@@ -1066,6 +1728,7 @@ if __name__ == "__main__":
         mlflow.log_param("EPOCHS", args.EPOCHS)
         mlflow.log_param("DROPOUT", args.DROPOUT)
         mlflow.log_param("CHAR_CNN_OUT_DIM", args.CHAR_CNN_OUT_DIM)
+        mlflow.log_param("POSTAG_EMBED_DIM", args.POSTAG_EMBED_DIM)
         mlflow.log_param("RNN_STACK_SIZE", args.RNN_STACK_SIZE)
         mlflow.log_param("LEARNING_RATE", args.LEARNING_RATE)
         mlflow.log_param("TEST_SPLIT", args.TEST_SPLIT)
@@ -1073,6 +1736,12 @@ if __name__ == "__main__":
         mlflow.log_param("RNN_HIDDEN_SIZE", args.RNN_HIDDEN_SIZE)
         mlflow.log_param("BATCH_SIZE", args.BATCH_SIZE)
         mlflow.log_param("DATA_PATH", args.DATA_PATH)
+        mlflow.log_param("STREAMING", args.STREAMING)
+        mlflow.log_param("PACK_SEQUENCES", args.PACK_SEQUENCES)
+        mlflow.log_param("CHAR_DEDUP", args.CHAR_DEDUP)
+        mlflow.log_param("METRIC_EVERY", args.METRIC_EVERY)
+        mlflow.log_param("SPLIT_SEED", args.SPLIT_SEED)
+        mlflow.log_param("FEATURE_CACHE_DIR", args.FEATURE_CACHE_DIR)
 
         commit_id = git_commit_push(commit_message=args.COMMENT)
         mlflow.log_param("COMMIT ID", commit_id)
@@ -1092,124 +1761,24 @@ if __name__ == "__main__":
         mlflow.log_param("WORD_EMBED_FREEZE", args.WORD_EMBED_FREEZE)
         mlflow.log_param("WORD_EMBED_NAME", args.WORD_EMBED_NAME)
 
-        # Load Data
-        X_text_list_as_is, X_text_list, y_ner_list = load_data(args.DATA_PATH)
-
-        # Get POS tags
-        X_tags, tag_to_index = get_POS_tags(X_text_list)
-        with open(os.path.join(ARTIFACTS_DIR, "tag_to_index"), "wb") as inf:
-            dill.dump(tag_to_index, inf)
-
-        POSTAG_EMBED_DIM = max(tag_to_index.values()) + 1
-        mlflow.log_param("DATA_SIZE", len(X_text_list))
-        mlflow.log_param("POSTAG_EMBED_DIM", POSTAG_EMBED_DIM)
-
-        # SENTENCE_LEN_LIST = [len(sentence) for sentence in X_text_list]
-
-        X_text_list = trim_list_of_lists_upto_max_len(
-            X_text_list, args.MAX_SENTENCE_LEN
-        )
-        X_text_list_as_is = trim_list_of_lists_upto_max_len(
-            X_text_list_as_is, args.MAX_SENTENCE_LEN
-        )
-        y_ner_list = trim_list_of_lists_upto_max_len(y_ner_list, args.MAX_SENTENCE_LEN)
-        X_tags = trim_list_of_lists_upto_max_len(X_tags, args.MAX_SENTENCE_LEN)
-        print(
-            f"Max sentence len after trimming upto {args.MAX_SENTENCE_LEN} words is {max([len(sentence) for sentence in X_text_list])}"
-        )
-
-        alnum, numeric, alpha, digit, lower, title, ascii = enrich_data(
-            X_text_list_as_is
-        )
-
-        alnum = pad_and_stack_list_of_list(
-            alnum,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        numeric = pad_and_stack_list_of_list(
-            numeric,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        alpha = pad_and_stack_list_of_list(
-            alpha,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        digit = pad_and_stack_list_of_list(
-            digit,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        lower = pad_and_stack_list_of_list(
-            lower,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        title = pad_and_stack_list_of_list(
-            title,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-        ascii = pad_and_stack_list_of_list(
-            ascii,
-            max_sentence_len=args.MAX_SENTENCE_LEN,
-            pad_value=-1,
-            tensor_type=torch.FloatTensor,
-        )
-
-        x_enriched_features = torch.stack(
-            (alnum, numeric, alpha, digit, lower, title, ascii), dim=2
-        )
-        ENRICH_FEAT_DIM = x_enriched_features.size(-1)
-
-        # Split data in test and train plus return segregate as input lists
-
-        (
-            (X_text_list_train, X_text_list_test),
-            (X_text_list_as_is_train, X_text_list_as_is_test),
-            (X_tags_train, X_tags_test),
-            (x_enriched_features_train, x_enriched_features_test),
-            (y_ner_list_train, y_ner_list_test),
-            (train_index, test_index),
-        ) = split_test_train(
-            X_text_list,
-            X_text_list_as_is,
-            X_tags,
-            x_enriched_features,
-            y_ner_list,
-            split_size=args.TEST_SPLIT,
-        )
-
-        # Set some important parameters values
-        all_labels = []
-        _ = [[all_labels.append(label) for label in lst] for lst in y_ner_list_train]
-        class_count_out = np.unique(all_labels, return_counts=True)
-        class_count_dict = dict(zip(class_count_out[0], class_count_out[1]))
-        num_classes = len([clas for clas in class_count_dict.keys()])
-        print(
-            f"Max sentence length - {args.MAX_SENTENCE_LEN}, Total Classes = {num_classes}"
-        )
-
-        mlflow.log_param("TEST_INDEX", str(test_index))
-        mlflow.log_param("MAX_SENTENCE_LEN", args.MAX_SENTENCE_LEN)
-        mlflow.log_param("NUM_CLASSES", num_classes)
-        mlflow.log_param("ENRICH_FEAT_DIM", ENRICH_FEAT_DIM)
-
-        # Tokenize Sentences
-        x_encoder, x_padded_train, x_padded_test = tokenize_sentence(
-            X_text_list_train, X_text_list_test, args.MAX_SENTENCE_LEN
-        )
-
-        with open(os.path.join(ARTIFACTS_DIR, "x_encoder"), "wb") as inf:
-            dill.dump(x_encoder, inf)
+        # Load data and build dataloaders
+        if args.STREAMING:
+            from streaming_dataset import build_streaming_dataloaders
+            training_data = build_streaming_dataloaders(args, ARTIFACTS_DIR)
+        else:
+            training_data = build_dataloaders(args, ARTIFACTS_DIR)
+
+        # Encoders are read as globals by EntityExtraction
+        x_encoder = training_data["x_encoder"]
+        x_char_encoder = training_data["x_char_encoder"]
+        dataloader_train = training_data["dataloader_train"]
+        dataloader_test = training_data["dataloader_test"]
+        ner_class_weights = training_data["ner_class_weights"]
+        num_classes = training_data["num_classes"]
+        y_o_index = training_data["y_o_index"]
+        NUM_POS_TAGS = training_data["num_pos_tags"]
+        ENRICH_FEAT_DIM = training_data["enrich_feat_dim"]
+        TOKEN_FEATURE_DIMS = training_data["token_feature_dims"]
 
         if vectors is not None:
             x_embed_weights = torch.stack([vectors[word] for word in x_encoder.vocab])
@@ -1221,79 +1790,9 @@ if __name__ == "__main__":
 
         mlflow.log_param("WORD_EMBED_DIM", args.WORD_EMBED_DIM)
 
-        # Tokenize Characters
-        (
-            x_char_encoder,
-            x_char_padded_train,
-            x_char_padded_test,
-            max_word_length,
-        ) = tokenize_character(
-            X_text_list_as_is_train, X_text_list_as_is_test, args.MAX_SENTENCE_LEN
-        )
-        mlflow.log_param("MAX_WORD_LENGTH", max_word_length)
-
-        with open(os.path.join(ARTIFACTS_DIR, "x_char_encoder"), "wb") as inf:
-            dill.dump(x_char_encoder, inf)
-
-        # Tokenize Pos tags
-        x_postag_padded_train = tokenize_pos_tags(
-            X_tags_train, tag_to_index=tag_to_index, max_sen_len=args.MAX_SENTENCE_LEN
-        )
-        x_postag_padded_test = tokenize_pos_tags(
-            X_tags_train, tag_to_index=tag_to_index, max_sen_len=args.MAX_SENTENCE_LEN
-        )
-
-        # Encode y NER
-        y_ner_encoder, y_ner_padded_train, y_ner_padded_test = encode_ner_y(
-            y_ner_list_train, y_ner_list_test, class_count_dict, args.MAX_SENTENCE_LEN
-        )
-        with open(os.path.join(ARTIFACTS_DIR, "y_ner_encoder"), "wb") as inf:
-            dill.dump(y_ner_encoder, inf)
-
-        y_o_index = y_ner_encoder.token_to_index['O']
-        mlflow.log_param("Y_O_INDEX", y_o_index)
-
         mlflow.log_artifacts('artifacts', 'files')
 
-        # Create train dataloader
-        dataset_train = Dataset(
-            [
-                {
-                    "x_padded": x_padded_train[i],
-                    "x_char_padded": x_char_padded_train[i],
-                    "x_postag_padded": x_postag_padded_train[i],
-                    "x_enriched_features": x_enriched_features_train[i],
-                    "y_ner_padded": y_ner_padded_train[i],
-                }
-                for i in range(x_padded_train.shape[0])
-            ]
-        )
-
-        dataloader_train = DataLoader(
-            dataset=dataset_train, batch_size=args.BATCH_SIZE, shuffle=True
-        )
-
-        # Create test dataloader
-        dataset_test = Dataset(
-            [
-                {
-                    "x_padded": x_padded_test[i],
-                    "x_char_padded": x_char_padded_test[i],
-                    "x_postag_padded": x_postag_padded_test[i],
-                    "x_enriched_features": x_enriched_features_test[i],
-                    "y_ner_padded": y_ner_padded_test[i],
-                }
-                for i in range(x_padded_test.shape[0])
-            ]
-        )
-
-        dataloader_test = DataLoader(
-            dataset=dataset_test, batch_size=args.BATCH_SIZE, shuffle=False
-        )
-
         # Build model
-        ner_class_weights = calculate_sample_weights(y_ner_padded_train)
-
         model_utils = ClassificationModelUtils(
             dataloader_train,
             dataloader_test,
@@ -1304,20 +1803,29 @@ if __name__ == "__main__":
             rnn_stack_size=args.RNN_STACK_SIZE,
             word_embed_dim=args.WORD_EMBED_DIM,
             enrich_dim=ENRICH_FEAT_DIM,
-            postag_embed_dim=POSTAG_EMBED_DIM,
+            token_feature_dims=TOKEN_FEATURE_DIMS,
+            postag_embed_dim=args.POSTAG_EMBED_DIM,
+            num_pos_tags=NUM_POS_TAGS,
             learning_rate=args.LEARNING_RATE,
             word_embedding_weights=x_embed_weights,
             word_embedding_freeze=args.WORD_EMBED_FREEZE,
+            pack_sequences=args.PACK_SEQUENCES,
+            char_dedup=args.CHAR_DEDUP,
             char_cnn_out_dim=args.CHAR_CNN_OUT_DIM,
             rnn_hidden_size=args.RNN_HIDDEN_SIZE,
             rnn_type=args.RNN_TYPE,
         )
-        model_utils.train(args.EPOCHS)
+        model_utils.train(args.EPOCHS, metric_every=args.METRIC_EVERY)
 
         mlflow.pytorch.log_model(model_utils.model, "model", conda_env=conda_environment)
+        bundle_path = export_run_bundle(
+            experiment.experiment_id, run.info.run_id, os.path.join(ARTIFACTS_DIR, "model.nerb")
+        )
+        mlflow.log_artifact(bundle_path, 'files')
 
         mlflow.log_metric("Loss-Test", model_utils.test_epoch_loss[-1])
         mlflow.log_metric("Loss-Train", model_utils.epoch_losses[-1])
+        mlflow.log_metric("Step-Time-Train", model_utils.epoch_step_times[-1])
 
         mlflow.log_metric("Accuracy-Test", model_utils.test_epoch_ner_accuracy[-1])
         mlflow.log_metric("Accuracy-Train", model_utils.epoch_ner_accuracy[-1])
@@ -0,0 +1,477 @@
+"""
+Pickle-free vocabularies for the word, character and label encoders
+"""
+import argparse
+import json
+import os
+from collections.abc import Mapping
+import dill
+import numpy as np
+import torch
+
+VOCABULARY_VERSION = 1
+VOCABULARY_KINDS = ("tokens", "chars", "label")
+ENCODER_KINDS = {"x_encoder": "tokens", "x_char_encoder": "chars", "y_ner_encoder": "label"}
+# Training words as is, x_encoder only holds them lowercased
+CHAR_WORDS = "char_words"
+_HASH_BASE = 0x100000001B3
+_HASH_MIX = 0xBF58476D1CE4E5B9
+
+
+def _pack(strings):
+    """
+    :param strings: list of str
+    :return: uint32 code points of all strings, int64 start offsets with a final end offset
+    """
+    lengths = np.fromiter(map(len, strings), dtype=np.int64, count=len(strings))
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return np.frombuffer("".join(strings).encode("utf-32-le"), dtype=np.uint32), offsets
+
+
+def _hash(code_points, offsets):
+    """
+    Polynomial hash of every string over its code points, computed for all strings at once
+    :param code_points: uint32 code points of all strings
+    :param offsets: int64 start offsets with a final end offset
+    :return: uint64 hash of each string
+    """
+    lengths = np.diff(offsets)
+    max_len = int(lengths.max(initial=0))
+    powers = np.cumprod(np.full(max(max_len, 1), _HASH_BASE, dtype=np.uint64))
+    position = np.arange(len(code_points), dtype=np.int64) - np.repeat(offsets[:-1], lengths)
+    terms = (code_points.astype(np.uint64) + np.uint64(1)) * powers[position]
+
+    hashes = np.zeros(len(lengths), dtype=np.uint64)
+    nonempty = lengths > 0
+    if nonempty.any():
+        hashes[nonempty] = np.add.reduceat(terms, offsets[:-1][nonempty])
+    # Mix in the length and spread the high bits down to the slot bits
+    hashes ^= lengths.astype(np.uint64) * np.uint64(_HASH_MIX)
+    hashes ^= hashes >> np.uint64(31)
+    hashes *= np.uint64(_HASH_MIX)
+    hashes ^= hashes >> np.uint64(29)
+    return hashes
+
+
+def _strings_equal(code_points, offsets, indices, other_code_points, other_offsets, other_indices):
+    """
+    Compares strings pairwise, lengths of each pair must be equal
+    :return: bool array, True where the strings are equal
+    """
+    lengths = other_offsets[other_indices + 1] - other_offsets[other_indices]
+    pair = np.repeat(np.arange(len(indices)), lengths)
+    within = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    differs = code_points[offsets[indices][pair] + within] != other_code_points[other_offsets[other_indices][pair] + within]
+    return np.bincount(pair[differs], minlength=len(indices)) == 0
+
+
+class _TokenIndex(Mapping):
+    """
+    Read only token -> index mapping over a Vocabulary, for code using
+    encoder.token_to_index
+    """
+    def __init__(self, vocabulary):
+        self.vocabulary = vocabulary
+
+    def __getitem__(self, token):
+        index = self.vocabulary.index_of(token)
+        if index is None:
+            raise KeyError(token)
+        return index
+
+    def __iter__(self):
+        return iter(self.vocabulary.index_to_token)
+
+    def __len__(self):
+        return len(self.vocabulary)
+
+
+class Vocabulary:
+    """
+    Token vocabulary held in flat arrays: a string table of UTF-32 code points sorted
+    by token, the token index of every row, and an open addressing hash index of
+    rows. Encodes whole batches with numpy, loads from npz or JSON without
+    unpickling and encodes like the torchnlp encoder it replaces
+    """
+    def __init__(self, code_points, offsets, ids, hashes, slots, kind="tokens", unknown_index=1, padding_index=0):
+        """
+        Use from_tokens, from_encoder or load
+
+        :param code_points: uint32 code points of the sorted tokens
+        :param offsets: int64 row start offsets with a final end offset
+        :param ids: int64 token index of each row
+        :param hashes: uint64 hash of each row
+        :param slots: int64 row of each hash slot, -1 for empty. Power of two size
+        :param kind: "tokens" encodes lists of words, "chars" the characters of a word and
+                     "label" a single label. Defaults to tokens
+        :param unknown_index: defaults to 1
+        :param padding_index: defaults to 0
+        """
+        if kind not in VOCABULARY_KINDS:
+            raise ValueError(f"Unknown vocabulary kind {kind}, expected one of {VOCABULARY_KINDS}")
+        self.code_points = code_points
+        self.offsets = offsets
+        self.ids = ids
+        self.hashes = hashes
+        self.slots = slots
+        self.kind = kind
+        self.unknown_index = unknown_index
+        self.padding_index = padding_index
+        self._index_to_token = None
+        self._char_table = None
+
+    @classmethod
+    def from_tokens(cls, tokens, kind="tokens", unknown_index=1, padding_index=0):
+        """
+        :param tokens: Index to token
+        :param kind: defaults to tokens
+        :param unknown_index: defaults to 1
+        :param padding_index: defaults to 0
+        :return: Vocabulary
+        """
+        tokens = list(tokens)
+        ids = np.array(sorted(range(len(tokens)), key=tokens.__getitem__), dtype=np.int64)
+        code_points, offsets = _pack([tokens[index] for index in ids])
+        hashes = _hash(code_points, offsets)
+        return cls(
+            code_points, offsets, ids, hashes, cls._build_slots(hashes), kind, unknown_index, padding_index
+        )
+
+    @classmethod
+    def from_encoder(cls, encoder, kind=None):
+        """
+        Migrates a torchnlp StaticTokenizerEncoder (with word list input), CharacterEncoder
+        or LabelEncoder
+        :param encoder:
+        :param kind: defaults to None i.e. from the encoder class
+        :return: Vocabulary
+        """
+        if kind is None:
+            name = type(encoder).__name__
+            kind = "chars" if name == "CharacterEncoder" else "label" if name == "LabelEncoder" else "tokens"
+        return cls.from_tokens(
+            encoder.index_to_token, kind, encoder.unknown_index, getattr(encoder, "padding_index", 0)
+        )
+
+    @staticmethod
+    def _build_slots(hashes):
+        """
+        Linear probing hash index with at least 2 slots per row, filled a probe step
+        at a time for all rows
+        :param hashes: uint64 hash of each row
+        :return: int64 slots
+        """
+        size = 8
+        while size < 2 * len(hashes):
+            size *= 2
+        slots = np.full(size, -1, dtype=np.int64)
+        pending = np.arange(len(hashes), dtype=np.int64)
+        position = (hashes & np.uint64(size - 1)).astype(np.int64)
+        while pending.size:
+            free = np.flatnonzero(slots[position] == -1)
+            # Of the rows probing the same free slot, the first takes it
+            taken, first = np.unique(position[free], return_index=True)
+            slots[taken] = pending[free[first]]
+            placed = np.zeros(pending.size, dtype=bool)
+            placed[free[first]] = True
+            pending = pending[~placed]
+            position = (position[~placed] + 1) & (size - 1)
+        return slots
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def vocab_size(self):
+        return len(self.ids)
+
+    @property
+    def index_to_token(self):
+        """
+        :return: list of tokens, decoded on first use
+        """
+        if self._index_to_token is None:
+            text = self.code_points.tobytes().decode("utf-32-le")
+            starts, ends = self.offsets[:-1].tolist(), self.offsets[1:].tolist()
+            tokens = [None] * len(self.ids)
+            for index, start, end in zip(self.ids.tolist(), starts, ends):
+                tokens[index] = text[start:end]
+            self._index_to_token = tokens
+        return self._index_to_token
+
+    @property
+    def vocab(self):
+        return self.index_to_token
+
+    @property
+    def token_to_index(self):
+        return _TokenIndex(self)
+
+    def lookup(self, tokens):
+        """
+        Index of every token, unknown_index for tokens not in the vocabulary
+        :param tokens: list of str
+        :return: int64 array
+        """
+        # Text repeats most words, each distinct token is looked up once
+        distinct = {}
+        inverse = np.fromiter(
+            (distinct.setdefault(token, len(distinct)) for token in tokens), dtype=np.int64, count=len(tokens)
+        )
+        return self._lookup_packed(*_pack(list(distinct)), self.unknown_index)[inverse]
+
+    def _lookup_packed(self, code_points, offsets, missing):
+        """
+        :param code_points: uint32 code points of the strings to look up
+        :param offsets: int64 start offsets with a final end offset
+        :param missing: Index of strings not in the vocabulary
+        :return: int64 index of each string
+        """
+        hashes = _hash(code_points, offsets)
+        lengths = np.diff(offsets)
+        row_lengths = np.diff(self.offsets)
+        mask = len(self.slots) - 1
+        found = np.full(len(lengths), missing, dtype=np.int64)
+        pending = np.arange(len(lengths), dtype=np.int64)
+        start = (hashes & np.uint64(mask)).astype(np.int64)
+        while pending.size:
+            # Probe on hash and length only, the code points of the candidates are compared once after
+            candidate_rows = np.full(len(pending), -1, dtype=np.int64)
+            candidate_slots = np.empty(len(pending), dtype=np.int64)
+            active = np.arange(len(pending), dtype=np.int64)
+            position = start
+            while active.size:
+                rows = self.slots[position]
+                occupied = rows >= 0
+                rows = np.where(occupied, rows, 0)
+                match = occupied & (self.hashes[rows] == hashes[pending[active]]) & (
+                    row_lengths[rows] == lengths[pending[active]]
+                )
+                candidate_rows[active[match]] = rows[match]
+                candidate_slots[active[match]] = position[match]
+                probe = occupied & ~match
+                active = active[probe]
+                position = (position[probe] + 1) & mask
+
+            candidates = np.flatnonzero(candidate_rows >= 0)
+            equal = _strings_equal(
+                self.code_points, self.offsets, candidate_rows[candidates], code_points, offsets, pending[candidates]
+            )
+            found[pending[candidates[equal]]] = self.ids[candidate_rows[candidates[equal]]]
+            # A full hash collision with another token, probe on past it
+            retry = candidates[~equal]
+            pending = pending[retry]
+            start = (candidate_slots[retry] + 1) & mask
+        return found
+
+    def index_of(self, token):
+        """
+        :param token:
+        :return: index of token, None if not in the vocabulary
+        """
+        code_points, offsets = _pack([token])
+        found = int(self._lookup_packed(code_points, offsets, -1)[0])
+        return found if found >= 0 else None
+
+    def _char_ids(self, code_points):
+        """
+        Single character tokens are looked up in a direct code point table
+        """
+        if self._char_table is None:
+            lengths = np.diff(self.offsets)
+            single = np.flatnonzero(lengths == 1)
+            single_code_points = self.code_points[self.offsets[single]]
+            self._char_table = np.full(int(single_code_points.max(initial=0)) + 2, self.unknown_index, dtype=np.int64)
+            self._char_table[single_code_points] = self.ids[single]
+        return self._char_table[np.minimum(code_points, len(self._char_table) - 1)]
+
+    def encode_flat(self, sequences):
+        """
+        :param sequences: Lists of words for tokens, words for chars
+        :return: int64 ids of all sequences, int64 length of each sequence
+        """
+        if self.kind == "chars":
+            code_points, offsets = _pack(sequences)
+            return self._char_ids(code_points), np.diff(offsets)
+        lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=len(sequences))
+        return self.lookup([token for sequence in sequences for token in sequence]), lengths
+
+    def encode_batch(self, sequences, max_len=None):
+        """
+        :param sequences: Lists of words for tokens, words for chars
+        :param max_len: Length to pad and trim to, defaults to None i.e. longest sequence
+        :return: LongTensor N, max_len padded with padding_index
+        """
+        ids, lengths = self.encode_flat(sequences)
+        max_len = int(lengths.max(initial=0)) if max_len is None else max_len
+        padded = np.full((len(sequences), max_len), self.padding_index, dtype=np.int64)
+        within = np.arange(len(ids), dtype=np.int64) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        keep = within < max_len
+        padded[np.repeat(np.arange(len(sequences)), lengths)[keep], within[keep]] = ids[keep]
+        return torch.from_numpy(padded)
+
+    def encode(self, sequence):
+        """
+        Same as the torchnlp encoder's encode
+        :param sequence: List of words for tokens, a word for chars, a label for label
+        :return: LongTensor of indices, a scalar for label
+        """
+        if self.kind == "label":
+            return torch.tensor(int(self.lookup([sequence])[0]))
+        return torch.from_numpy(self.encode_flat([sequence])[0])
+
+    def decode(self, encoded):
+        """
+        :param encoded: Indices
+        :return: list of tokens, a single token for label
+        """
+        if self.kind == "label":
+            return self.index_to_token[int(encoded)]
+        return [self.index_to_token[index] for index in torch.as_tensor(encoded).tolist()]
+
+    def metadata(self):
+        return {
+            "version": VOCABULARY_VERSION,
+            "kind": self.kind,
+            "unknown_index": self.unknown_index,
+            "padding_index": self.padding_index,
+        }
+
+    def arrays(self):
+        """
+        :return: dictionary of the flat arrays, e.g. to save in a bundle
+        """
+        return {
+            "code_points": self.code_points,
+            "offsets": self.offsets,
+            "ids": self.ids,
+            "hashes": self.hashes,
+            "slots": self.slots,
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, metadata):
+        """
+        :param arrays: Dictionary from arrays
+        :param metadata: Dictionary from metadata
+        :return: Vocabulary
+        """
+        if metadata["version"] > VOCABULARY_VERSION:
+            raise ValueError(f"Vocabulary version {metadata['version']} is newer than {VOCABULARY_VERSION}")
+        return cls(
+            *(arrays[name] for name in ("code_points", "offsets", "ids", "hashes", "slots")),
+            kind=metadata["kind"],
+            unknown_index=metadata["unknown_index"],
+            padding_index=metadata["padding_index"],
+        )
+
+    def save(self, path):
+        """
+        Saves as npz with the hash index, or as a JSON token list if path ends with .json
+        :param path:
+        :return: path
+        """
+        if path.lower().endswith(".json"):
+            with open(path, "w", encoding="utf-8") as outfile:
+                json.dump(dict(self.metadata(), tokens=self.index_to_token), outfile, ensure_ascii=False)
+        else:
+            with open(path, "wb") as outfile:
+                np.savez(outfile, metadata=np.array(json.dumps(self.metadata())), **self.arrays())
+        return path
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: npz or JSON file written by save
+        :return: Vocabulary
+        """
+        if path.lower().endswith(".json"):
+            with open(path, "r", encoding="utf-8") as infile:
+                saved = json.load(infile)
+            if saved["version"] > VOCABULARY_VERSION:
+                raise ValueError(f"Vocabulary version {saved['version']} is newer than {VOCABULARY_VERSION}")
+            return cls.from_tokens(saved["tokens"], saved["kind"], saved["unknown_index"], saved["padding_index"])
+        with np.load(path, allow_pickle=False) as saved:
+            return cls.from_arrays(
+                {name: saved[name] for name in saved.files if name != "metadata"}, json.loads(str(saved["metadata"]))
+            )
+
+
+def save_tag_to_index(tag_to_index, path):
+    with open(path, "w", encoding="utf-8") as outfile:
+        json.dump(tag_to_index, outfile, ensure_ascii=False)
+    return path
+
+
+def load_tag_to_index(path):
+    with open(path, "r", encoding="utf-8") as infile:
+        return json.load(infile)
+
+
+def save_run_vocabularies(dir_path, encoders, tag_to_index):
+    """
+    Saves x_encoder.npz, x_char_encoder.npz, y_ner_encoder.npz and tag_to_index.json, and
+    char_words.npz if encoders has char_words
+    :param dir_path: Run artifacts directory
+    :param encoders: Dictionary of encoder name -> torchnlp encoder or Vocabulary, optionally
+                     char_words -> training words as is or Vocabulary of them
+    :param tag_to_index:
+    :return: dictionary of name -> Vocabulary
+    """
+    vocabularies = {}
+    for name, kind in ENCODER_KINDS.items():
+        encoder = encoders[name]
+        vocabularies[name] = encoder if isinstance(encoder, Vocabulary) else Vocabulary.from_encoder(encoder, kind)
+        vocabularies[name].save(os.path.join(dir_path, f"{name}.npz"))
+    if encoders.get(CHAR_WORDS) is not None:
+        char_words = encoders[CHAR_WORDS]
+        vocabularies[CHAR_WORDS] = char_words if isinstance(char_words, Vocabulary) else Vocabulary.from_tokens(char_words)
+        vocabularies[CHAR_WORDS].save(os.path.join(dir_path, f"{CHAR_WORDS}.npz"))
+    save_tag_to_index(tag_to_index, os.path.join(dir_path, "tag_to_index.json"))
+    return vocabularies
+
+
+def load_run_vocabularies(dir_path):
+    """
+    Vocabularies of a run, migrated from the dill artifacts of runs saved before them
+    :param dir_path: Run artifacts directory
+    :return: dictionary of encoder name -> Vocabulary plus char_words if the run saved it,
+             tag_to_index
+    """
+    vocabularies = {}
+    for name, kind in ENCODER_KINDS.items():
+        path = os.path.join(dir_path, f"{name}.npz")
+        if os.path.isfile(path):
+            vocabularies[name] = Vocabulary.load(path)
+        else:
+            with open(os.path.join(dir_path, name), "rb") as infile:
+                vocabularies[name] = Vocabulary.from_encoder(dill.load(infile), kind)
+    path = os.path.join(dir_path, f"{CHAR_WORDS}.npz")
+    if os.path.isfile(path):
+        vocabularies[CHAR_WORDS] = Vocabulary.load(path)
+
+    path = os.path.join(dir_path, "tag_to_index.json")
+    if os.path.isfile(path):
+        tag_to_index = load_tag_to_index(path)
+    else:
+        with open(os.path.join(dir_path, "tag_to_index"), "rb") as infile:
+            tag_to_index = dill.load(infile)
+    return vocabularies, tag_to_index
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Get Input Values")
+    parser.add_argument(
+        "--artifacts-dir",
+        dest="ARTIFACTS_DIR",
+        required=True,
+        type=str,
+        help="Run artifacts files directory with the dill encoders, e.g. mlruns/0/<run-id>/artifacts/files",
+    )
+    args = parser.parse_args()
+
+    vocabularies, tag_to_index = load_run_vocabularies(args.ARTIFACTS_DIR)
+    save_run_vocabularies(args.ARTIFACTS_DIR, vocabularies, tag_to_index)
+    for name, vocabulary in vocabularies.items():
+        print(f"{name} - {len(vocabulary)} tokens")